@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""Micro-benchmark of the SysFSPWMController write path
+
+Measures edges per second for the old unbuffered file() writes and for the raw fd
+writes used by SysFSPWMController, against a temporary directory standing in for
+/sys/class/gpio (or a real one, if given).  On a real pin the numbers include the
+kernel's sysfs handling; on a temp dir they isolate the Python-side overhead.
+
+Usage: python benchmarks/bench_gpio_write.py [--edges N] [--sysfs-root DIR --gpio-id N]
+
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from pi_pwm import controllers
+
+
+class FileWriter(object):
+    """the previous SysFSPWMController write path, for comparison"""
+    def __init__(self, path):
+        self.gpio = file(path, "w+", buffering=0)
+
+    def _on(self):
+        self.gpio.write("1")
+
+    def _off(self):
+        self.gpio.write("0")
+
+
+def bench_controller(controller, edges):
+    on, off = controller._on, controller._off
+    start = time.time()
+    for i in xrange(edges // 2):
+        on()
+        off()
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--edges", type=int, default=200000)
+    parser.add_argument("--sysfs-root", default=None)
+    parser.add_argument("--gpio-id", type=int, default=24)
+    args = parser.parse_args()
+
+    root = args.sysfs_root
+    if root is None:
+        root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(root, "gpio{}".format(args.gpio_id)))
+        open(os.path.join(root, "gpio{}".format(args.gpio_id), "value"), "w").close()
+    try:
+        path = os.path.join(root, "gpio{}".format(args.gpio_id), "value")
+        results = [
+            ("file() write", bench_controller(FileWriter(path), args.edges)),
+            ("fd write", bench_controller(
+                controllers.SysFSPWMController(gpio_id=args.gpio_id, sysfs_root=root), args.edges)),
+            ("fd write + verify", bench_controller(
+                controllers.SysFSPWMController(gpio_id=args.gpio_id, sysfs_root=root, verify=True), args.edges)),
+        ]
+    finally:
+        if args.sysfs_root is None:
+            shutil.rmtree(root)
+    for name, elapsed in results:
+        print "{:<20} {:>12.0f} edges/s".format(name, args.edges / elapsed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""Benchmark of edge jitter under HTTP load, with the controller in a thread or a process
+
+Runs a controller at 50% duty while several threads hammer the webservice with
+GET / and POST requests, and records the time of every edge.  The jitter is how far
+each on/off period strays from interval * duty.  With --mode thread the controller
+runs in the webservice's process and competes with it for the GIL; with --mode process
+it runs in a ControllerProcess and the webservice only touches shared memory.
+
+The real-time options (see pi_pwm.realtime) apply to the controller thread in either
+mode, so the benchmark can be run with and without them; the settings that actually
+took effect are printed with the results.
+
+Usage: python benchmarks/bench_jitter.py [--mode thread|process|both] [--seconds N] [--clients N]
+           [--policy fifo|rr] [--priority N] [--cpus N,...] [--mlockall] [--prefault BYTES]
+
+"""
+
+import argparse
+import json
+import StringIO
+import threading
+import time
+
+import yaml
+
+from multiprocessing.sharedctypes import RawArray, RawValue
+
+import pi_pwm.webservice
+from pi_pwm import controllers
+from pi_pwm.processes import ControllerProcess
+from pi_pwm.realtime import Realtime
+
+MAX_EDGES = 100000
+
+
+class StampedController(controllers.BasePWMController):
+    """records the time of each edge into shared memory so it can be read from any process"""
+
+    def __init__(self, stamps, count, *args, **kwargs):
+        super(StampedController, self).__init__(*args, **kwargs)
+        self.stamps = stamps
+        self.count = count
+
+    def _stamp(self):
+        i = self.count.value
+        if i < len(self.stamps):
+            self.stamps[i] = time.time()
+            self.count.value = i + 1
+
+    _on = _off = _stamp
+
+
+def load(app, name, stop):
+    client = app.test_client()
+    while not stop.is_set():
+        client.get("/")
+        client.post("/" + name, content_type="application/json", data=json.dumps({"phase": None}))
+
+
+def bench(mode, seconds, clients, interval, rt=None):
+    stamps, count = RawArray("d", MAX_EDGES), RawValue("l", 0)
+    cargs = {"stamps": stamps, "count": count, "min_interval": .001, "interval": interval}
+    if mode == "process":
+        process = ControllerProcess("bench")
+        process.realtime = rt
+        shadow = controllers.BasePWMController(name="bench", min_interval=.001, interval=interval)
+        controller = process.add("bench", StampedController, cargs, shadow)
+    else:
+        controller = StampedController(name="bench", **cargs)
+        controller.realtime = rt
+    app = pi_pwm.webservice.create_app(StringIO.StringIO(yaml.dump({"controllers": {}})))
+    pi_pwm.webservice.controllers = {"bench": controller}
+    controller.duty = .5
+    controller.start()
+    stop = threading.Event()
+    threads = [threading.Thread(target=load, args=(app, "bench", stop)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    status = controller.realtime_status
+    controller.stop()
+    n = min(count.value, MAX_EDGES)
+    # the first edge starts the measurement
+    periods = [stamps[i + 1] - stamps[i] for i in range(n - 1)]
+    return sorted(abs(p - interval * .5) for p in periods), status
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=["thread", "process", "both"], default="both")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--interval", type=float, default=.02)
+    parser.add_argument("--policy", choices=["fifo", "rr"])
+    parser.add_argument("--priority", type=int, default=50)
+    parser.add_argument("--cpus", type=lambda s: [int(c) for c in s.split(",")])
+    parser.add_argument("--mlockall", action="store_true")
+    parser.add_argument("--prefault", type=int, default=0)
+    args = parser.parse_args()
+
+    rt = None
+    if args.policy or args.cpus or args.mlockall or args.prefault:
+        rt = Realtime(args.policy, args.priority, args.cpus, args.mlockall, args.prefault)
+        rt.apply_process()
+
+    modes = ["thread", "process"] if args.mode == "both" else [args.mode]
+    print "{:<8} {:>7} {:>10} {:>10} {:>10}  {}".format("mode", "edges", "mean ms", "p99 ms", "max ms", "realtime")
+    for mode in modes:
+        jitter, status = bench(mode, args.seconds, args.clients, args.interval, rt)
+        if not jitter:
+            print "{:<8} {:>7}".format(mode, 0)
+            continue
+        print "{:<8} {:>7d} {:>10.3f} {:>10.3f} {:>10.3f}  {}".format(
+            mode,
+            len(jitter) + 1,
+            sum(jitter) / len(jitter) * 1e3,
+            jitter[int(len(jitter) * .99)] * 1e3,
+            jitter[-1] * 1e3,
+            json.dumps(status, sort_keys=True),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""Load test of the webservice API against the timing of the controllers it serves
+
+Serves create_app() over HTTP on localhost and drives it with a mix of GET /,
+POST /<controller>/ and GET /<controller>/ping requests from a rising number of
+concurrent clients.  For each concurrency level it reports requests per second,
+latency percentiles (overall and per request type) and how far the controllers'
+edges strayed from where they should have been.  The controllers are
+BasePWMControllers, or SysFSPWMControllers writing to a simulated sysfs tree in a
+temporary directory.
+
+The results are written as JSON (to stdout or --output), so runs can be kept and
+compared to catch regressions; a summary line per level goes to stderr.
+
+Usage: python benchmarks/bench_load.py [--backend base|sysfs] [--controllers N]
+           [--levels 1,2,4,...] [--seconds N] [--mix get=1,post=1,ping=1] [--output FILE]
+
+"""
+
+import argparse
+import httplib
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import StringIO
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+
+from werkzeug.serving import make_server
+
+import pi_pwm.webservice
+from pi_pwm import controllers
+
+REQUESTS = ("get", "post", "ping")
+
+
+class EdgeRecorder(object):
+    """mixin recording the time of every output edge"""
+
+    def _stamp(self):
+        self.stamps.append(time.time())
+
+    def _on(self):
+        self._stamp()
+        super(EdgeRecorder, self)._on()
+
+    def _off(self):
+        self._stamp()
+        super(EdgeRecorder, self)._off()
+
+
+class RecordingPWMController(EdgeRecorder, controllers.BasePWMController):
+    pass
+
+
+class RecordingSysFSPWMController(EdgeRecorder, controllers.SysFSPWMController):
+    pass
+
+
+def make_controllers(backend, count, interval, sysfs_root):
+    cons = {}
+    for i in range(count):
+        name = "c{}".format(i)
+        kwargs = dict(name=name, min_interval=.001, interval=interval, dead_interval=3600)
+        if backend == "sysfs":
+            d = os.path.join(sysfs_root, "gpio{}".format(i))
+            os.mkdir(d)
+            open(os.path.join(d, "value"), "w").close()
+            c = RecordingSysFSPWMController(gpio_id=i, sysfs_root=sysfs_root, **kwargs)
+        else:
+            c = RecordingPWMController(**kwargs)
+        c.stamps = []
+        cons[name] = c
+    return cons
+
+
+def percentiles(values, scale=1e3):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(len(values) * p))] * scale
+    return {
+        "mean": sum(values) / len(values) * scale,
+        "p50": pick(.5),
+        "p90": pick(.9),
+        "p99": pick(.99),
+        "max": values[-1] * scale,
+    }
+
+
+def client(port, names, mix, deadline, results):
+    choices = [kind for kind, weight in mix for i in range(weight)]
+    body = json.dumps({"duty": .5})
+    while time.time() < deadline:
+        kind = random.choice(choices)
+        name = random.choice(names)
+        start = time.time()
+        try:
+            conn = httplib.HTTPConnection("127.0.0.1", port, timeout=10)
+            if kind == "get":
+                conn.request("GET", "/")
+            elif kind == "post":
+                conn.request("POST", "/{}/".format(name), body, {"Content-Type": "application/json"})
+            else:
+                conn.request("GET", "/{}/ping".format(name))
+            resp = conn.getresponse()
+            resp.read()
+            conn.close()
+            ok = resp.status == 200
+        except (IOError, httplib.HTTPException):
+            ok = False
+        results.append((kind, time.time() - start, ok))
+
+
+def run_level(port, cons, mix, concurrency, seconds, interval):
+    for c in cons.itervalues():
+        del c.stamps[:]
+    results = []
+    deadline = time.time() + seconds
+    threads = [
+        threading.Thread(target=client, args=(port, sorted(cons), mix, deadline, results))
+        for i in range(concurrency)
+    ]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    # at 50% duty every edge should come half an interval after the one before
+    errors = []
+    for c in cons.itervalues():
+        stamps = list(c.stamps)
+        errors.extend(abs(b - a - interval / 2) for a, b in zip(stamps, stamps[1:]))
+    ok = [r for r in results if r[2]]
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "rps": len(ok) / elapsed,
+        "latency_ms": percentiles([r[1] for r in ok]),
+        "by_type": dict(
+            (kind, percentiles([r[1] for r in ok if r[0] == kind]))
+            for kind in REQUESTS
+        ),
+        "edges": len(errors),
+        "edge_error_ms": percentiles(errors),
+    }
+
+
+def parse_mix(s):
+    mix = []
+    for part in s.split(","):
+        kind, weight = part.split("=")
+        if kind not in REQUESTS:
+            raise argparse.ArgumentTypeError("request type must be one of {}".format(", ".join(REQUESTS)))
+        mix.append((kind, int(weight)))
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", choices=["base", "sysfs"], default="base")
+    parser.add_argument("--controllers", type=int, default=4)
+    parser.add_argument("--interval", type=float, default=.05)
+    parser.add_argument("--levels", type=lambda s: [int(l) for l in s.split(",")], default=[1, 2, 4, 8, 16])
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("get=1,post=1,ping=1"))
+    parser.add_argument("--output", type=argparse.FileType("w"), default=sys.stdout)
+    args = parser.parse_args()
+    # the server logs every request otherwise
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    sysfs_root = tempfile.mkdtemp()
+    try:
+        cons = make_controllers(args.backend, args.controllers, args.interval, sysfs_root)
+        app = pi_pwm.webservice.create_app(StringIO.StringIO(yaml.dump({"controllers": {}})))
+        pi_pwm.webservice.controllers = cons
+        for c in cons.itervalues():
+            c.duty = .5
+            c.start()
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        levels = []
+        try:
+            for concurrency in args.levels:
+                level = run_level(server.server_port, cons, args.mix, concurrency, args.seconds, args.interval)
+                levels.append(level)
+                sys.stderr.write(
+                    "{concurrency:>4} clients {rps:>8.1f} req/s  p99 {p99:>8.2f} ms  "
+                    "edge error p99 {edge:>8.2f} ms\n".format(
+                        p99=level["latency_ms"]["p99"] if level["latency_ms"] else 0,
+                        edge=level["edge_error_ms"]["p99"] if level["edge_error_ms"] else 0,
+                        **level
+                    )
+                )
+        finally:
+            server.shutdown()
+            for c in cons.itervalues():
+                c.stop()
+    finally:
+        shutil.rmtree(sysfs_root)
+    json.dump({
+        "benchmark": "load",
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "backend": args.backend,
+        "controllers": args.controllers,
+        "interval": args.interval,
+        "seconds": args.seconds,
+        "mix": dict(args.mix),
+        "levels": levels,
+    }, args.output, indent=4, sort_keys=True)
+    args.output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
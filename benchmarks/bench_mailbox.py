@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Benchmark of a flood of duty updates with and without the setter mailbox
+
+Runs a BasePWMController while --threads threads set its duty as fast as they can,
+once applying every update directly and once through the mailbox, and reports the
+setter rate, how many updates the mailbox superseded and how far the controller's
+edges strayed from where they should have been.
+
+Usage: python benchmarks/bench_mailbox.py [--threads N] [--seconds N] [--interval S]
+
+"""
+
+import argparse
+import threading
+import time
+
+from pi_pwm import controllers
+
+
+class StampedController(controllers.BasePWMController):
+    def _on(self):
+        self.stamps.append(time.time())
+
+    def _off(self):
+        self.stamps.append(time.time())
+
+
+def flood(c, deadline, counts):
+    n = 0
+    while time.time() < deadline:
+        # alternate so every update is a change
+        c.duty = .5 if n % 2 else .5 + 1e-6
+        n += 1
+    counts.append(n)
+
+
+def bench(mailbox, threads, seconds, interval):
+    c = StampedController(name="flooded", min_interval=.001, interval=interval, mailbox=mailbox)
+    c.stamps = []
+    c.duty = .5
+    c.start()
+    counts = []
+    deadline = time.time() + seconds
+    workers = [threading.Thread(target=flood, args=(c, deadline, counts)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    c.stop()
+    c.join()
+    errors = sorted(abs(b - a - interval / 2) for a, b in zip(c.stamps, c.stamps[1:]))
+    return sum(counts) / seconds, c.superseded, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=3)
+    parser.add_argument("--interval", type=float, default=.01)
+    args = parser.parse_args()
+
+    print "{:<10} {:>12} {:>12} {:>8} {:>14} {:>14}".format(
+        "mailbox", "updates/s", "superseded", "edges", "edge p50 ms", "edge p99 ms"
+    )
+    for mailbox in (False, True):
+        rate, superseded, errors = bench(mailbox, args.threads, args.seconds, args.interval)
+        pick = lambda p: errors[min(len(errors) - 1, int(len(errors) * p))] * 1e3 if errors else 0
+        print "{:<10} {:>12.0f} {:>12d} {:>8d} {:>14.3f} {:>14.3f}".format(
+            "on" if mailbox else "off", rate, superseded, len(errors), pick(.5), pick(.99)
+        )
+
+
+if __name__ == "__main__":
+    main()
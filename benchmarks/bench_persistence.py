@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""Benchmark of setter latency with and without state persistence
+
+Times duty updates on a BasePWMController with no journal, and with a StateJournal
+that is flushing in the background, to show that persistence adds no latency to
+setters (they only mark the journal dirty).
+
+Usage: python benchmarks/bench_persistence.py [--updates N]
+
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from pi_pwm import controllers
+from pi_pwm.persistence import StateJournal
+
+
+def bench(controller, updates):
+    start = time.time()
+    for i in xrange(updates):
+        controller.duty = (i % 100) / 100.0
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=100000)
+    parser.add_argument("--flush-interval", type=float, default=0.01)
+    args = parser.parse_args()
+
+    d = tempfile.mkdtemp()
+    try:
+        plain = controllers.BasePWMController(name="plain")
+        journaled = controllers.BasePWMController(name="journaled")
+        journal = StateJournal(os.path.join(d, "state.json"), flush_interval=args.flush_interval)
+        journal.register(journaled)
+        journal.start()
+        results = [
+            ("no journal", bench(plain, args.updates)),
+            ("journal", bench(journaled, args.updates)),
+        ]
+        journal.stop()
+        journal.join()
+    finally:
+        shutil.rmtree(d)
+    for name, elapsed in results:
+        print "{:<12} {:>8.2f} us/update".format(name, elapsed / args.updates * 1e6)
+    print "{:<12} {:>8d} writes".format("journal", journal.writes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Benchmark of GET / serialization cost per response format
+
+Builds an index of --controllers BasePWMControllers (not started) and, for each
+format the webservice can negotiate (pretty and compact JSON, and MessagePack and
+CBOR if msgpack and cbor2 are installed), with and without gzip, reports the size
+of the response, the time to encode it and the time for the whole GET / through
+the WSGI app.
+
+Usage: python benchmarks/bench_serialization.py [--controllers N] [--repeat N]
+
+"""
+
+import argparse
+import logging
+import StringIO
+import time
+
+import yaml
+
+import pi_pwm.webservice
+from pi_pwm import controllers, encoding
+
+FORMATS = [
+    ("json (pretty)", "*/*", encoding.dumps_pretty),
+    ("json (compact)", encoding.JSON, encoding.dumps_compact),
+] + [
+    (mimetype.split("/")[1], mimetype, encoding.ENCODERS[mimetype])
+    for mimetype in (encoding.MSGPACK, encoding.CBOR)
+    if mimetype in encoding.ENCODERS
+]
+
+
+def per_call(function, repeat):
+    start = time.time()
+    for i in xrange(repeat):
+        function()
+    return (time.time() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--controllers", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    app = pi_pwm.webservice.create_app(StringIO.StringIO(yaml.dump({"controllers": {}})))
+    for i in range(args.controllers):
+        c = controllers.BasePWMController(name="c{}".format(i), dead_interval=3600)
+        c.duty = .5
+        pi_pwm.webservice.controllers[c.name] = c
+    client = app.test_client()
+    index = dict((name, dict(c)) for name, c in pi_pwm.webservice.controllers.iteritems())
+
+    print "{:<16} {:>6} {:>10} {:>12} {:>12}".format("format", "gzip", "bytes", "encode us", "GET / us")
+    for name, accept, dumps in FORMATS:
+        for gzip in (False, True):
+            headers = {"Accept": accept}
+            if gzip:
+                headers["Accept-Encoding"] = "gzip"
+                encode = lambda: encoding.compress(dumps(index))
+            else:
+                encode = lambda: dumps(index)
+            size = len(client.get("/", headers=headers).data)
+            print "{:<16} {:>6} {:>10d} {:>12.1f} {:>12.1f}".format(
+                name, "yes" if gzip else "no", size,
+                per_call(encode, args.repeat) * 1e6,
+                per_call(lambda: client.get("/", headers=headers), args.repeat) * 1e6,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+import atexit
+import collections
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from contextlib import contextmanager
+
+DEFAULT_MAX_BYTES = 1024 * 1024
+DEFAULT_BACKUPS = 3
+DEFAULT_FLUSH_INTERVAL = 1
+
+# timestamp, event, source, controller name, old value, new value
+RECORD = struct.Struct("<dBB2x20sdd")
+
+EVENTS = (
+    "reload", "on", "off", "dead", "alive",
+    "duty", "interval", "phase", "max_edge_rate", "profile",
+    "setpoint", "kp", "ki", "kd",
+)
+SOURCES = ("local", "api", "config", "profile", "pid", "group", "journal", "mqtt")
+
+_EVENT_CODES = dict((e, i) for i, e in enumerate(EVENTS))
+_SOURCE_CODES = dict((s, i) for i, s in enumerate(SOURCES))
+_NAN = float("nan")
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+@contextmanager
+def source(name):
+    """attribute the audit records made by this thread inside the block to name"""
+    previous = getattr(_local, "source", "local")
+    _local.source = name
+    try:
+        yield
+    finally:
+        _local.source = previous
+
+
+def current_source():
+    return getattr(_local, "source", "local")
+
+
+def _value(v):
+    return _NAN if v is None else float(v)
+
+
+class AuditLog(threading.Thread):
+    """Append-only log of fixed-size binary records
+
+    record() only packs the record and appends it to an in-memory queue; the log's
+    own thread writes the queue out in batches every *flush_interval* seconds, so the
+    control threads never wait on the file.  When the file reaches *max_bytes* it is
+    rotated to <path>.1 (and <path>.1 to <path>.2 and so on, keeping *backups* files).
+
+    Parameters
+    ----------
+    path : str
+        The log file.
+    max_bytes : int
+        The size at which the file is rotated.
+    backups : int
+        The number of rotated files to keep.
+    flush_interval : float or int
+        The time, in seconds, between writes.
+
+    """
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, backups=DEFAULT_BACKUPS, flush_interval=DEFAULT_FLUSH_INTERVAL, *args, **kwargs):
+        super(AuditLog, self).__init__(*args, **kwargs)
+        self.path = path
+        # keep whole records in every file so the reader can index them
+        self.max_bytes = max(RECORD.size, max_bytes - max_bytes % RECORD.size)
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.daemon = True
+        self.shutdown = False
+        self._pending = collections.deque()
+        self._wake = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._record_lock = threading.Lock()
+
+    def record(self, event, name, old=None, new=None, source=None):
+        fields = (
+            _EVENT_CODES[event],
+            _SOURCE_CODES[source or current_source()],
+            name[:20],
+            _value(old),
+            _value(new),
+        )
+        # timestamped and queued in one step, so records stay in time order for read()
+        with self._record_lock:
+            self._pending.append(RECORD.pack(time.time(), *fields))
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists("{}.{}".format(self.path, i)):
+                os.rename("{}.{}".format(self.path, i), "{}.{}".format(self.path, i + 1))
+        if self.backups:
+            os.rename(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+
+    def flush(self):
+        """write out everything recorded so far"""
+        with self._flush_lock:
+            pending = self._pending
+            while pending:
+                try:
+                    size = os.path.getsize(self.path)
+                except OSError:
+                    size = 0
+                if size >= self.max_bytes:
+                    self._rotate()
+                    size = 0
+                chunk = []
+                room = (self.max_bytes - size) // RECORD.size
+                while pending and len(chunk) < room:
+                    chunk.append(pending.popleft())
+                with open(self.path, "ab") as f:
+                    f.write("".join(chunk))
+
+    def run(self):
+        atexit.register(self.stop)
+        while not self.shutdown:
+            self._wake.wait(self.flush_interval)
+            try:
+                self.flush()
+            except (IOError, OSError):
+                log.exception("|audit|unable to write %s", self.path)
+
+    def stop(self):
+        self.shutdown = True
+        self._wake.set()
+        self.flush()
+
+
+def _files(path):
+    """the log and its rotated files, oldest first"""
+    files = []
+    i = 1
+    while os.path.exists("{}.{}".format(path, i)):
+        files.insert(0, "{}.{}".format(path, i))
+        i += 1
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def _unpack(buf, offset):
+    t, event, src, name, old, new = RECORD.unpack_from(buf, offset)
+    return {
+        "time": t,
+        "event": EVENTS[event] if event < len(EVENTS) else event,
+        "source": SOURCES[src] if src < len(SOURCES) else src,
+        "controller": name.rstrip("\0"),
+        "old": None if old != old else old,
+        "new": None if new != new else new,
+    }
+
+
+def read(path, since=None, limit=None):
+    """Read records from an audit log (including its rotated files)
+
+    Each file is memory mapped and the first record at or after *since* is found by
+    binary search on the (fixed-size, time ordered) records, so reading the tail of a
+    large log doesn't scan it.
+
+    Parameters
+    ----------
+    path : str
+        The log file, as given to AuditLog.
+    since : float or None
+        Only return records with a timestamp at or after this (unix) time.
+    limit : int or None
+        The maximum number of records to return.
+
+    Returns
+    -------
+    list of dict
+
+    """
+    records = []
+    for name in _files(path):
+        with open(name, "rb") as f:
+            count = os.fstat(f.fileno()).st_size // RECORD.size
+            if not count:
+                continue
+            buf = mmap.mmap(f.fileno(), count * RECORD.size, access=mmap.ACCESS_READ)
+        try:
+            lo = 0
+            if since is not None:
+                hi = count
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if RECORD.unpack_from(buf, mid * RECORD.size)[0] < since:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+            for i in xrange(lo, count):
+                if limit is not None and len(records) >= limit:
+                    return records
+                records.append(_unpack(buf, i * RECORD.size))
+        finally:
+            buf.close()
+    return records
@@ -0,0 +1,492 @@
+#!/usr/bin/env python
+
+import httplib
+import json
+import logging
+import socket
+import threading
+import time
+import urlparse
+import Queue
+
+DEFAULT_TIMEOUT = 5
+DEFAULT_MAX_IDLE = 4
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 0.1
+DEFAULT_BATCH_WINDOW = 0.01
+DEFAULT_HEARTBEAT_INTERVAL = 10
+DEFAULT_RESULT_TIMEOUT = 60
+
+log = logging.getLogger(__name__)
+
+
+class ClientError(IOError):
+    """the webservice could not be reached or did not answer in time"""
+    pass
+
+
+class RemoteError(ValueError):
+    """the webservice refused a request, e.g. for an invalid duty cycle"""
+    def __init__(self, message, status):
+        super(RemoteError, self).__init__(message)
+        self.status = status
+
+
+class ConnectionPool(object):
+    """Reusable connections to one HTTP server
+
+    Connections are kept open (HTTP keep-alive, if the server supports it) and
+    reused, up to *max_idle* of them at a time.  A reused connection the server has
+    since closed is retried once on a new one.
+
+    Parameters
+    ----------
+    url : str
+        The base URL of the server, e.g. http://kettle.local:8080.
+    timeout : float or int
+        The time, in seconds, to wait for the server to answer.
+    max_idle : int
+        The maximum number of idle connections kept open.
+
+    """
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT, max_idle=DEFAULT_MAX_IDLE):
+        parsed = urlparse.urlsplit(url)
+        if parsed.scheme not in ("http", "https") or not parsed.hostname:
+            raise ValueError("url must be http(s)://host[:port][/path], not '{}'".format(url))
+        if float(timeout) <= 0:
+            raise ValueError("timeout must be positive")
+        self.url = url
+        self.timeout = float(timeout)
+        self._connection_class = httplib.HTTPSConnection if parsed.scheme == "https" else httplib.HTTPConnection
+        self._host = parsed.hostname
+        self._port = parsed.port
+        self.base = parsed.path.rstrip("/")
+        self._idle = Queue.LifoQueue(max_idle)
+        self.connections = 0
+
+    def _connection(self):
+        try:
+            return self._idle.get_nowait(), True
+        except Queue.Empty:
+            self.connections += 1
+            return self._connection_class(self._host, self._port, timeout=self.timeout), False
+
+    def _release(self, conn):
+        try:
+            self._idle.put_nowait(conn)
+        except Queue.Full:
+            conn.close()
+
+    def request(self, method, path, body=None, content_type=None, headers=None):
+        """make a request of the server
+
+        Returns
+        -------
+        tuple
+            The response status, content type and body.
+
+        Raises
+        ------
+        ClientError
+            If the server cannot be reached or did not answer in time.
+
+        """
+        headers = dict(headers or {}, Connection="keep-alive")
+        if content_type is not None:
+            headers["Content-Type"] = content_type
+        while True:
+            conn, reused = self._connection()
+            try:
+                conn.request(method, self.base + path, body, headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (socket.error, httplib.HTTPException) as e:
+                conn.close()
+                if reused and not isinstance(e, socket.timeout):
+                    # the server closed it while it was idle
+                    continue
+                raise ClientError("{} {} failed: {}".format(method, self.url + path, e or type(e).__name__))
+            if resp.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            return resp.status, resp.getheader("Content-Type"), data
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Queue.Empty:
+                return
+
+
+class Pending(object):
+    """The result of a call that is queued to be sent, like a future"""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def _set(self, result=None, error=None):
+        with self._lock:
+            self._result, self._error = result, error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                log.exception("exception in callback %s", callback)
+
+    def done(self):
+        return self._done.is_set()
+
+    def add_done_callback(self, callback):
+        """call callback(self) once the result is in (at once, if it already is)"""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def result(self, timeout=None):
+        """wait for the result and return it
+
+        Raises
+        ------
+        ClientError
+            If the request failed, or the result isn't in after timeout seconds.
+        RemoteError
+            If the webservice refused the update.
+
+        """
+        if not self._done.wait(timeout):
+            raise ClientError("no result after {} seconds".format(timeout))
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class Client(object):
+    """A pi_pwm.webservice, over HTTP
+
+    Updates and pings are not sent one by one: those made within *batch_window*
+    seconds of each other (from any number of threads) are combined into one bulk
+    POST /.  Updates to the same controller share a request only if they don't set a
+    parameter to different values; the others follow in order in further requests,
+    and if the webservice refuses a shared update, its parts are sent again one by
+    one, so every caller gets the result of its own update.  set() and ping() wait
+    (up to *result_timeout* seconds) for the result; set_async() and ping_async()
+    return a Pending straight away, so one thread can have updates to many
+    controllers in flight at once.
+
+    Connections are pooled and kept alive, and requests that fail to reach the
+    webservice are retried *retries* times, waiting *backoff* seconds and doubling
+    the wait each time.  Updates are absolute values, so sending one twice is
+    harmless.
+
+    Parameters
+    ----------
+    url : str
+        The base URL of the webservice, e.g. http://kettle.local:8080.
+    timeout : float or int
+        The time, in seconds, to wait for the webservice to answer.
+    batch_window : float or int
+        The time, in seconds, updates are collected before they are sent.
+    retries : int
+        The number of times a request that could not be sent is retried.
+    backoff : float or int
+        The time, in seconds, to wait before the first retry.
+    max_idle : int
+        The maximum number of idle connections kept open.
+    result_timeout : float or int
+        The time, in seconds, set() and ping() wait for their result.
+
+    """
+    def __init__(
+            self,
+            url,
+            timeout=DEFAULT_TIMEOUT,
+            batch_window=DEFAULT_BATCH_WINDOW,
+            retries=DEFAULT_RETRIES,
+            backoff=DEFAULT_BACKOFF,
+            max_idle=DEFAULT_MAX_IDLE,
+            result_timeout=DEFAULT_RESULT_TIMEOUT
+        ):
+        self.pool = ConnectionPool(url, timeout, max_idle)
+        self.batch_window = float(batch_window)
+        self.retries = retries
+        self.backoff = float(backoff)
+        self.result_timeout = float(result_timeout)
+        self.batches = 0
+        self._batch = []
+        self._batch_lock = threading.Condition(threading.Lock())
+        self._sender = None
+        self._closed = False
+
+    def request(self, method, path, body=None):
+        """make a JSON request, retrying if the webservice can't be reached
+
+        Returns
+        -------
+        dict
+            The decoded response.
+
+        Raises
+        ------
+        ClientError
+            If the webservice could not be reached after all the retries.
+        RemoteError
+            If the webservice answered with an error.
+
+        """
+        wait = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                status, content_type, data = self.pool.request(
+                    method, path,
+                    None if body is None else json.dumps(body),
+                    None if body is None else "application/json",
+                    # compact JSON
+                    {"Accept": "application/json"},
+                )
+                break
+            except ClientError as e:
+                if attempt == self.retries:
+                    raise
+                log.warn("%s; retrying in %s seconds", e, wait)
+                time.sleep(wait)
+                wait *= 2
+        try:
+            r = json.loads(data)
+        except ValueError:
+            raise RemoteError("{} {} returned {}: {}".format(method, path, status, data[:200]), status)
+        if status != 200:
+            raise RemoteError(r.get("error", status) if isinstance(r, dict) else status, status)
+        return r
+
+    def index(self):
+        """every controller's parameters, as GET / returns them"""
+        return self.request("GET", "/")
+
+    def get(self, name):
+        """the controller's parameters, as dict() of the controller returns them"""
+        return self.request("GET", "/{}/".format(name))
+
+    def __getitem__(self, name):
+        return RemoteController(self, name)
+
+    def _send_batches(self):
+        while True:
+            with self._batch_lock:
+                while not self._batch and not self._closed:
+                    self._batch_lock.wait()
+                if not self._batch:
+                    return
+            # collect whatever else arrives in the window, unless closing
+            if not self._closed:
+                time.sleep(self.batch_window)
+            with self._batch_lock:
+                batch, self._batch = self._batch, []
+            try:
+                self._send(batch)
+            except Exception as e:
+                # e.g. a value json can't encode; the sender must live on for the next batch
+                log.exception("unable to send a batch of %d updates", len(batch))
+                for name, values, pending in batch:
+                    if not pending.done():
+                        pending._set(error=e)
+
+    def _send(self, batch):
+        # (name, values, pending, alone): alone updates were refused as part of a shared
+        # update and are retried without company to find out whose they were
+        queue = [(name, values, pending, False) for name, values, pending in batch]
+        while queue:
+            body, members, deferred, blocked = {}, {}, [], set()
+            for item in queue:
+                name, values, pending, alone = item
+                merged = body.get(name)
+                if name in blocked or merged is not None and (
+                        alone or members[name][0][3] or
+                        any(k in merged and merged[k] != v for k, v in values.iteritems())):
+                    # later updates to the controller wait too, so they stay in order
+                    blocked.add(name)
+                    deferred.append(item)
+                    continue
+                body.setdefault(name, {}).update(values)
+                members.setdefault(name, []).append(item)
+            queue = self._post(body, members) + deferred
+
+    def _post(self, body, members):
+        """send one bulk update and set the results; returns the updates to send again"""
+        self.batches += 1
+        try:
+            results = self.request("POST", "/", body)
+            if not isinstance(results, dict):
+                raise RemoteError("bulk update returned {!r}".format(results)[:200], 500)
+        except (ClientError, RemoteError) as e:
+            for items in members.itervalues():
+                for name, values, pending, alone in items:
+                    pending._set(error=e)
+            return []
+        retry = []
+        for name, items in members.iteritems():
+            r = results.get(name)
+            if not isinstance(r, dict):
+                r = {"error": "no result", "status": 500}
+            status = r.get("status", 200)
+            if status != 200 and len(items) > 1:
+                retry.extend((n, v, p, True) for n, v, p, alone in items)
+                continue
+            for n, values, pending, alone in items:
+                if status != 200:
+                    pending._set(error=RemoteError(r.get("error"), status))
+                else:
+                    pending._set(_own_result(r, values))
+        return retry
+
+    def set_async(self, name, **values):
+        """queue an update to a controller
+
+        Returns
+        -------
+        Pending
+            Its result is {"old": {...}, "new": {...}}, as POST /<controller>/
+            returns.
+
+        """
+        pending = Pending()
+        with self._batch_lock:
+            if self._closed:
+                raise ClientError("client is closed")
+            self._batch.append((name, values, pending))
+            if self._sender is None:
+                self._sender = threading.Thread(target=self._send_batches, name="pi_pwm.client")
+                self._sender.daemon = True
+                self._sender.start()
+            self._batch_lock.notify()
+        return pending
+
+    def ping_async(self, name):
+        """queue a ping of a controller; the Pending's result includes the dead_timer"""
+        return self.set_async(name, ping=True)
+
+    def set(self, name, **values):
+        """update a controller and wait for the result (see set_async)"""
+        return self.set_async(name, **values).result(self.result_timeout)
+
+    def ping(self, name):
+        """ping a controller and return its new dead_timer"""
+        return self.ping_async(name).result(self.result_timeout)["dead_timer"]
+
+    def heartbeat(self, names, interval=DEFAULT_HEARTBEAT_INTERVAL, autostart=True):
+        """keep the dead timers of the named controllers from expiring (see Heartbeat)"""
+        heartbeat = Heartbeat(self, names, interval)
+        if autostart:
+            heartbeat.start()
+        return heartbeat
+
+    def close(self):
+        """send whatever is queued and close the connections"""
+        with self._batch_lock:
+            self._closed = True
+            sender = self._sender
+            self._batch_lock.notify()
+        if sender is not None:
+            sender.join()
+        self.pool.close()
+
+
+def _own_result(r, values):
+    """the part of a shared update's result that is about values"""
+    own = {}
+    for k in ("old", "new"):
+        if k in r:
+            own[k] = dict((p, v) for p, v in r[k].iteritems() if p in values)
+    if values.get("ping") and "dead_timer" in r:
+        own["dead_timer"] = r["dead_timer"]
+    return own
+
+
+class RemoteController(object):
+    """A controller on the webservice, with the same parameters as the controller
+
+    Reading a parameter fetches the controller's current state; setting one sends
+    an update (see Client) and raises RemoteError if the webservice refuses it.
+
+    """
+    def __init__(self, client, name):
+        self.__dict__["_client"] = client
+        self.__dict__["name"] = name
+
+    def __getattr__(self, k):
+        state = self._client.get(self.name)
+        try:
+            return state[k]
+        except KeyError:
+            raise AttributeError("controller {} has no parameter {}".format(self.name, k))
+
+    def __setattr__(self, k, v):
+        self._client.set(self.name, **{k: v})
+
+    def update(self, **values):
+        """set several parameters at once, all of them or none"""
+        return self._client.set(self.name, **values)
+
+    def ping(self):
+        return self._client.ping(self.name)
+
+    def __iter__(self):
+        return self._client.get(self.name).iteritems()
+
+
+class Heartbeat(threading.Thread):
+    """Pings many controllers every interval seconds, in one request
+
+    Parameters
+    ----------
+    client : Client
+    names : list
+        The controllers to keep alive.
+    interval : float or int
+        The time, in seconds, between pings; it should be well under the shortest
+        dead_interval of the controllers.
+
+    """
+    def __init__(self, client, names, interval=DEFAULT_HEARTBEAT_INTERVAL, *args, **kwargs):
+        super(Heartbeat, self).__init__(*args, **kwargs)
+        if float(interval) <= 0:
+            raise ValueError("interval must be positive")
+        self.client = client
+        self.names = list(names)
+        self.interval = float(interval)
+        self.daemon = True
+        self.shutdown = threading.Event()
+        self.beats = 0
+        self.errors = {}
+
+    def beat(self):
+        """ping them all now; returns the errors, keyed by controller name"""
+        pending = [(name, self.client.ping_async(name)) for name in self.names]
+        errors = {}
+        for name, p in pending:
+            try:
+                p.result(self.client.pool.timeout * (self.client.retries + 1) + self.interval)
+            except (ClientError, RemoteError) as e:
+                log.warn("|%s|heartbeat failed: %s", name, e)
+                errors[name] = e
+        self.errors = errors
+        self.beats += 1
+        return errors
+
+    def run(self):
+        while not self.shutdown.is_set():
+            start = time.time()
+            self.beat()
+            self.shutdown.wait(max(0, self.interval - (time.time() - start)))
+
+    def stop(self):
+        self.shutdown.set()
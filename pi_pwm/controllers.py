@@ -4,14 +4,29 @@ import logging
 import threading
 import time
 import sys
+import os
 import atexit
+import inspect
+
+from array import array
 
 import yaml
 
 from contextlib import closing
 
+from pi_pwm.profiles import Profile
+from pi_pwm.persistence import StateJournal
+from pi_pwm.processes import ControllerProcess
+from pi_pwm.realtime import Realtime
+from pi_pwm import audit
+
 DEFAULT_MIN_INTERVAL = 1
 DEFAULT_MAX_INTERVAL = 10
+DEFAULT_SYSFS_ROOT = "/sys/class/gpio"
+DEFAULT_EXPORT_TIMEOUT = 5
+DEFAULT_TICK = 0.1
+
+MODULATIONS = ("pwm", "sigma_delta")
 
 log = logging.getLogger(__name__)
 
@@ -39,6 +54,47 @@ class BasePWMController(threading.Thread):
         than zero, the controller will reset dead_timer every time ping() is called or duty
         is updated.  If dead_timer reaches zero, the controller will disable all outputs
         until dead_timer is reset.
+    phase : float or None
+        If set, where in each cycle (expressed as a fraction of interval) the output
+        turns on.  Phased cycles are aligned to multiples of interval since the epoch,
+        so controllers with the same interval and different phases stay staggered no
+        matter when they were started.  Ignored if the controller has a scheduler.
+    watts : float or int
+        The load switched by the output.  Only used by a LoadScheduler with max_watts.
+    modulation : string
+        "pwm" (the default) switches the output once on and once off per interval.
+        "sigma_delta" decides the output state every *tick* seconds and carries the
+        difference between the requested and delivered on-time forward, so the
+        long-run duty is accurate to a fraction of a tick.  interval and phase are
+        not used in this mode.
+    tick : float or int
+        The decision period, in seconds, for sigma_delta modulation.
+    min_on_time : float or int
+        The minimum time, in seconds, the output stays on once turned on in
+        sigma_delta mode.  Use this to protect relays from short pulses.
+    min_off_time : float or int
+        The minimum time, in seconds, the output stays off once turned off in
+        sigma_delta mode.
+    max_edge_rate : float or int or None
+        If set, the maximum number of output edges (on or off) per minute.  In pwm mode
+        the cycle is stretched beyond interval as needed (see effective_interval); in
+        sigma_delta mode the minimum on/off times are raised.  Either way the delivered
+        on-time still matches duty, just in fewer, longer pulses.
+    profile_keepalive : int
+        While a profile (see pi_pwm.profiles.Profile) is running, the dead timer is kept
+        alive for up to this many seconds after the last ping().  0 (the default) means
+        a running profile needs pings like any other client.
+    mailbox : bool
+        If True, duty updates made while the controller is running only leave the new
+        value in a single-slot mailbox, which the control loop empties at its next
+        decision point (each cycle, or each tick in sigma_delta mode).  However many
+        updates arrive in between, the loop applies (and audits, and counts as a ping)
+        only the newest, and the ones it replaced are counted in *superseded*.  Reading
+        duty returns the newest value straight away.
+
+    The controller's thread applies the real-time settings (see pi_pwm.realtime) in
+    its *realtime* attribute, if any, when it starts.  Its *feedback* attribute, if
+    set, is a pi_pwm.feedback.FeedbackInput told about every edge before it is made.
 
     """
     ITERABLES = [
@@ -48,7 +104,17 @@ class BasePWMController(threading.Thread):
         "interval", "min_interval", "max_interval",
         "duty",
         "dead_interval", "dead_timer",
+        "phase", "watts",
+        "modulation", "tick", "min_on_time", "min_off_time",
+        "max_edge_rate", "effective_interval", "edges",
+        "profile", "profile_keepalive",
+        "mailbox", "superseded",
+        ("group", "group.name"),
+        ("realtime", "realtime_status"),
+        ("feedback", "feedback_status"),
     ]
+    # parameters that can be updated through the webservice
+    SETTABLE = ["interval", "duty", "phase", "max_edge_rate", "profile"]
     def __init__(
             self,
             name='<unspecified>',
@@ -56,25 +122,69 @@ class BasePWMController(threading.Thread):
             max_interval=DEFAULT_MAX_INTERVAL,
             interval=1,
             dead_interval=0,
+            phase=None,
+            watts=0,
+            modulation="pwm",
+            tick=DEFAULT_TICK,
+            min_on_time=0,
+            min_off_time=0,
+            max_edge_rate=None,
+            profile_keepalive=0,
+            mailbox=False,
             *args,
             **kwargs
         ):
         super(BasePWMController, self).__init__(*args, **kwargs)
         self.name = name
-        # setters need this to go first
+        # setters need these to go first
         self.lock = threading.Lock()
+        self.mailbox = bool(mailbox)
+        self.superseded = 0
+        self._mailbox = None
+        self._mailbox_lock = threading.Lock()
+        self.journal = None
+        self.audit_log = None
+        self.realtime = None
+        self.feedback = None
         # same for these
         self.min_interval = min_interval
         self.max_interval = max_interval
         # other parameters
         self.interval = interval
         self.dead_interval = self._validate_integer("dead_interval", 0, float("inf"), dead_interval)
+        self.phase = phase
+        self.watts = self._validate_float("watts", 0, float("inf"), watts)
+        self.scheduler = None
+        self.group = None
+        if modulation not in MODULATIONS:
+            raise ValueError(
+                "modulation must be one of {}".format(", ".join(MODULATIONS))
+            )
+        self.modulation = modulation
+        self.tick = self._validate_float("tick", 0.001, self.max_interval, tick)
+        self.min_on_time = self._validate_float("min_on_time", 0, float("inf"), min_on_time)
+        self.min_off_time = self._validate_float("min_off_time", 0, float("inf"), min_off_time)
+        self.max_edge_rate = max_edge_rate
+        self.profile_keepalive = self._validate_integer("profile_keepalive", 0, float("inf"), profile_keepalive)
         # internals
         self.daemon = True
+        self._sd_error = 0.0
+        self._sd_state = False
+        self._sd_held = 0
+        self._sd_deadline = None
+        self._profile = None
+        self._profile_start = None
+        # the controller thread's lookup hint, and whether the finished profile's end
+        # duty has been applied (after which manual duty updates stick)
+        self._profile_segment = None
+        self._profile_done = False
+        self._last_ping = None
+        self._realtime_mask = None
         self._dead_time = None
         self._dead_logged = False
         self._shutdown = False
         self.is_on = False
+        self.edges = 0
         self._atexit_registered = False
         # must be set after the internals
         self.duty = 0
@@ -82,7 +192,8 @@ class BasePWMController(threading.Thread):
     def __iter__(self):
         for k in self.ITERABLES:
             if isinstance(k, tuple):
-                yield (k[0], reduce(getattr, k[1].split("."), self))
+                # the chain stops at None (e.g. group when not grouped)
+                yield (k[0], reduce(lambda o, a: None if o is None else getattr(o, a), k[1].split("."), self))
             else:
                 yield (k, getattr(self, k))
 
@@ -97,6 +208,10 @@ class BasePWMController(threading.Thread):
         """low level function to turn off the output (stub to be overridden by subclasses)"""
         pass
 
+    def _cleanup(self):  # pragma: no cover
+        """low level function to release the output when run() exits (stub to be overridden by subclasses)"""
+        pass
+
     def on(self):
         if not self.is_on:
             if self.dead_interval and self.dead_timer <= 0:
@@ -104,16 +219,28 @@ class BasePWMController(threading.Thread):
                 return self.is_on
             with self.lock:
                 self.is_on = True
+                self.edges += 1
+                if self.feedback is not None:
+                    self.feedback.commanded(True)
                 self._on()
+            self._audit("on")
         return self.is_on
 
     def off(self):
         if self.is_on:
             with self.lock:
                 self.is_on = False
+                self.edges += 1
+                if self.feedback is not None:
+                    self.feedback.commanded(False)
                 self._off()
+            self._audit("off")
         return self.is_on
 
+    def _audit(self, event, old=None, new=None):
+        if self.audit_log is not None:
+            self.audit_log.record(event, self.name, old, new)
+
     @staticmethod
     def _validate_float(name, low, high, value):
         value = float(value)
@@ -141,7 +268,11 @@ class BasePWMController(threading.Thread):
     def set_interval(self, interval):
         interval = self._validate_float("interval", self.min_interval, self.max_interval, interval)
         with self.lock:
-            self._interval = interval
+            old, self._interval = getattr(self, "_interval", None), interval
+        if self.journal is not None:
+            self.journal.dirty = True
+        if old != interval:
+            self._audit("interval", old, interval)
 
     interval = property(
         get_interval,
@@ -151,15 +282,53 @@ class BasePWMController(threading.Thread):
     )
 
     def get_duty(self):
+        pending = self._mailbox
+        if pending is not None:
+            return pending[0]
         with self.lock:
             return self._duty
 
-    def set_duty(self, duty):
+    def _apply_duty(self, duty):
+        """update duty without counting as a ping"""
         duty = self._validate_float("duty cycle", 0, 1, duty)
+        if self.group is not None and self.group._master is self:
+            return self.group._apply_duty(duty)
         with self.lock:
-            self._duty = duty
+            old, self._duty = getattr(self, "_duty", None), duty
+        if self.scheduler is not None:
+            self.scheduler.invalidate()
+        if self.journal is not None:
+            self.journal.dirty = True
+        if old != duty:
+            self._audit("duty", old, duty)
+
+    def set_duty(self, duty):
+        if self.mailbox and self.is_alive():
+            duty = self._validate_float("duty cycle", 0, 1, duty)
+            with self._mailbox_lock:
+                if self._mailbox is not None:
+                    self.superseded += 1
+                self._mailbox = (duty, audit.current_source())
+            return
+        self._apply_duty(duty)
         self.ping()
 
+    def _empty_mailbox(self):
+        """apply the newest duty left by set_duty(), if any"""
+        pending = self._mailbox
+        if pending is None:
+            return
+        duty, source = pending
+        with audit.source(source):
+            self._apply_duty(duty)
+            self.ping()
+        with self._mailbox_lock:
+            if self._mailbox is pending:
+                self._mailbox = None
+            else:
+                # a newer one arrived while this one was applied, so this wasn't superseded
+                self.superseded -= 1
+
     duty = property(
         get_duty,
         set_duty,
@@ -167,15 +336,158 @@ class BasePWMController(threading.Thread):
         "the percentage of time (expressed as float between 0.0 and 1.0) that the output should be on for each cycle"
     )
 
+    def get_max_edge_rate(self):
+        with self.lock:
+            return self._max_edge_rate
+
+    def set_max_edge_rate(self, max_edge_rate):
+        if max_edge_rate is not None:
+            max_edge_rate = self._validate_float("max_edge_rate", 0.001, float("inf"), max_edge_rate)
+        with self.lock:
+            old, self._max_edge_rate = getattr(self, "_max_edge_rate", None), max_edge_rate
+        if self.scheduler is not None:
+            self.scheduler.invalidate()
+        if old != max_edge_rate:
+            self._audit("max_edge_rate", old, max_edge_rate)
+
+    max_edge_rate = property(
+        get_max_edge_rate,
+        set_max_edge_rate,
+        None,
+        "the maximum number of output edges per minute, or None for no limit"
+    )
+
+    def _edge_spacing(self):
+        """the minimum time, in seconds, between edges allowed by the edge rate budgets"""
+        rates = [self.max_edge_rate]
+        if self.scheduler is not None:
+            rates.append(self.scheduler.edge_rate(self))
+        rates = [r for r in rates if r]
+        if not rates:
+            return 0
+        return 60.0 / min(rates)
+
+    @property
+    def effective_interval(self):
+        """the cycle length actually used in pwm mode
+
+        This is interval, stretched if necessary so that the two edges of each cycle stay
+        within the edge rate budget.
+
+        """
+        return max(self.interval, 2 * self._edge_spacing())
+
+    def get_phase(self):
+        if self.scheduler is not None and self.scheduler.staggers:
+            return self.scheduler.phase(self)
+        with self.lock:
+            return self._phase
+
+    def set_phase(self, phase):
+        if phase is not None:
+            # 1.0 is the same point in the cycle as 0.0
+            phase = self._validate_float("phase", 0, 1, phase) % 1.0
+        with self.lock:
+            old, self._phase = getattr(self, "_phase", None), phase
+        if old != phase:
+            self._audit("phase", old, phase)
+
+    phase = property(
+        get_phase,
+        set_phase,
+        None,
+        "the point in each cycle (expressed as a fraction of interval) where the output turns on, or None"
+    )
+
+    def get_profile(self):
+        with self.lock:
+            profile, start = self._profile, self._profile_start
+        if profile is None:
+            return None
+        elapsed = time.time() - start
+        duty, segment = profile.at(elapsed)
+        return dict(
+            profile.spec,
+            status="running" if segment is not None else "finished",
+            elapsed=min(elapsed, profile.duration),
+            duration=profile.duration,
+            segment=segment,
+            segments=profile.segments,
+        )
+
+    def set_profile(self, spec, ping=True):
+        if self.journal is not None:
+            self.journal.dirty = True
+        if spec is None:
+            with self.lock:
+                old, self._profile = self._profile, None
+                self._profile_start = None
+                self._profile_segment = None
+                self._profile_done = False
+            if old is not None:
+                self._audit("profile", old.segments, None)
+            return
+        spec = dict(spec)
+        # the progress fields reported by get_profile(); elapsed resumes a profile part way
+        elapsed = float(spec.pop("elapsed", 0))
+        for k in ("status", "duration", "segment", "segments"):
+            spec.pop(k, None)
+        profile = Profile(spec)
+        with self.lock:
+            old, self._profile = self._profile, profile
+            self._profile_start = time.time() - elapsed
+            self._profile_segment = None
+            self._profile_done = False
+        self._audit("profile", old.segments if old is not None else None, profile.segments)
+        self._run_profile()
+        if ping:
+            self.ping()
+
+    profile = property(
+        get_profile,
+        set_profile,
+        None,
+        "the duty profile being run with its progress, or None"
+    )
+
+    def _run_profile(self):
+        """set duty from the running profile and keep the dead timer alive within bounds"""
+        with self.lock:
+            profile, start, hint = self._profile, self._profile_start, self._profile_segment
+            if profile is None or self._profile_done:
+                return
+        now = time.time()
+        duty, segment = profile.at(now - start, hint)
+        with audit.source("profile"):
+            self._apply_duty(duty)
+        with self.lock:
+            if self._profile is profile:
+                self._profile_segment = segment
+                # the end duty is applied once; the profile stays around to report it finished
+                self._profile_done = segment is None
+        if segment is None or not self.profile_keepalive:
+            return
+        with self.lock:
+            if self.dead_interval and self._last_ping and now - self._last_ping < self.profile_keepalive:
+                self._dead_time = max(self._dead_time, min(
+                    now + self.dead_interval, self._last_ping + self.profile_keepalive
+                ))
+
     def ping(self):
+        if self.group is not None and self.group._master is self:
+            self.group._ping_members()
         with self.lock:
+            self._last_ping = time.time()
             if not self.dead_interval:
                 return None
-            self._dead_time = time.time() + self.dead_interval
-            if self._dead_logged:
+            self._dead_time = self._last_ping + self.dead_interval
+            revived = self._dead_logged
+            if revived:
                 log.info("|%s|ping received; going active", self.name)
                 self._dead_logged = False
-            return self.dead_interval
+        if revived:
+            self._audit("alive")
+        return self.dead_interval
 
     @property
     def dead_timer(self):
@@ -185,19 +497,106 @@ class BasePWMController(threading.Thread):
             return int(self._dead_time - time.time())
 
     def _calculate_durations(self):
-        on_duration = self.interval * self.duty
-        off_duration = self.interval - on_duration
+        interval = self.effective_interval
+        on_duration = interval * self.duty
+        off_duration = interval - on_duration
         return [on_duration, off_duration]
 
+    def _calculate_segments(self, phase):
+        """split a cycle into [(state, duration), ...] with the on-window starting at phase
+
+        If the on-window runs past the end of the cycle it wraps around to the start,
+        where it joins up with the previous cycle's window without an extra edge.
+
+        """
+        on_duration, off_duration = self._calculate_durations()
+        interval = on_duration + off_duration
+        start = phase * interval
+        end = start + on_duration
+        if end <= interval:
+            return [(False, start), (True, on_duration), (False, interval - end)]
+        return [(True, end - interval), (False, off_duration), (True, interval - start)]
+
+    def _body_phased(self, phase):
+        segments = self._calculate_segments(phase)
+        interval = sum(d for state, d in segments)
+        now = time.time()
+        deadline = now - now % interval
+        for state, duration in segments:
+            deadline += duration
+            # zero-length segments and segments that ended before we joined the cycle
+            if deadline <= now:
+                continue
+            if state:
+                self.on()
+            else:
+                self.off()
+            time.sleep(max(0, deadline - time.time()))
+
+    def _sigma_delta_step(self):
+        """advance the sigma-delta modulator by one tick and return the new output state
+
+        The error accumulator holds the on-time owed (in ticks).  The output turns on
+        once at least half a tick is owed and each tick spent on pays one back, which
+        keeps the accumulated error within a tick unless a minimum on/off time holds
+        the output in place, in which case the error is carried until it can be paid.
+
+        """
+        duty = self.duty
+        hold = max(
+            self.min_on_time if self._sd_state else self.min_off_time,
+            self._edge_spacing()
+        )
+        self._sd_held += 1
+        self._sd_error += duty
+        state = self._sd_error >= 0.5
+        if state != self._sd_state:
+            if self._sd_held * self.tick < hold - 1e-9:
+                state = self._sd_state
+            else:
+                self._sd_state = state
+                self._sd_held = 0
+        if state:
+            self._sd_error -= 1
+        # don't let a long hold wind the error up without bound
+        limit = max(self.min_on_time, self.min_off_time, self._edge_spacing()) / self.tick + 1
+        self._sd_error = max(-limit, min(limit, self._sd_error))
+        return state
+
+    def _body_sigma_delta(self):
+        tick = self.tick
+        now = time.time()
+        if self._sd_deadline is None or now - self._sd_deadline > tick:
+            # first tick, or we stalled; resynchronize rather than trying to catch up
+            self._sd_deadline = now
+        if self._sigma_delta_step():
+            self.on()
+        else:
+            self.off()
+        self._sd_deadline += tick
+        time.sleep(max(0, self._sd_deadline - time.time()))
+
     def _body(self):
+        self._empty_mailbox()
+        self._run_profile()
         if self.dead_interval and self.dead_timer <= 0:
             if self.is_on:
                 self.off()
             if not self._dead_logged:
                 log.warn("|%s|dead timer has expired", self.name)
                 self._dead_logged = True
+                self._audit("dead")
+            self._sd_error = 0.0
+            self._sd_state = False
+            self._sd_held = 0
+            self._sd_deadline = None
             time.sleep(self.interval)
             return
+        if self.modulation == "sigma_delta":
+            return self._body_sigma_delta()
+        phase = self.phase
+        if phase is not None:
+            return self._body_phased(phase)
         on_duration, off_duration = self._calculate_durations()
         if not on_duration:
             self.off()
@@ -211,17 +610,35 @@ class BasePWMController(threading.Thread):
             self.off()
             time.sleep(off_duration)
 
+    @property
+    def realtime_status(self):
+        """the real-time settings in effect for this controller's thread, or None"""
+        if self.realtime is None or self._realtime_mask is None:
+            return None
+        return self.realtime.describe(self._realtime_mask)
+
+    @property
+    def feedback_status(self):
+        """what the output's feedback input (see pi_pwm.feedback) reports, or None"""
+        if self.feedback is None:
+            return None
+        return dict(self.feedback)
+
     def run(self):
         log.info("|%s|starting", self.name)
         if not self._atexit_registered:
             atexit.register(self.stop)
+        if self.realtime is not None:
+            self._realtime_mask = self.realtime.apply_thread()
         self.shutdown = False
         self.ping()
         try:
             while not self.shutdown:
                 self._body()
         finally:
+            self._empty_mailbox()
             self.off()
+            self._cleanup()
 
     def stop(self):
         with self.lock:
@@ -229,6 +646,586 @@ class BasePWMController(threading.Thread):
         self.off()
 
 
+class LoadScheduler(object):
+    """Staggers controller on-windows and shares out an edge rate budget
+
+    Each registered controller is given a phase (see BasePWMController) so that the
+    on-windows are spread across the cycle instead of all starting together.  Windows
+    are placed greedily, largest first, at the earliest point in the cycle where they
+    fit under the cap; a window that can't fit anywhere goes where it overlaps the
+    least load and a warning is logged.  Each controller's duty is never altered.
+
+    Phases are fractions of each controller's own interval, so the cap is only exact
+    for controllers sharing the same interval.
+
+    If max_edge_rate is set, the budget is split evenly between the controllers that
+    are currently switching (0 < duty < 1) and applied on top of each controller's
+    own max_edge_rate.
+
+    Parameters
+    ----------
+    max_on : int or None
+        The maximum number of outputs that should be on at the same time.
+    max_watts : float or int or None
+        The maximum total of the watts parameter of outputs that are on at the same
+        time.  Takes precedence over max_on.
+    max_edge_rate : float or int or None
+        The maximum number of output edges per minute across all of the controllers.
+    resolution : int
+        The number of slots each cycle is divided into for placement.
+
+    """
+    def __init__(self, max_on=None, max_watts=None, max_edge_rate=None, resolution=100):
+        if max_on is None and max_watts is None and max_edge_rate is None:
+            raise ConfigurationError("scheduler requires max_on, max_watts or max_edge_rate")
+        self.max_on = max_on
+        self.max_watts = max_watts
+        self.max_edge_rate = max_edge_rate
+        self.staggers = max_on is not None or max_watts is not None
+        self.resolution = resolution
+        self.lock = threading.Lock()
+        self.controllers = []
+        self._phases = {}
+        self._switching = 0
+        self._dirty = True
+
+    def register(self, controller):
+        with self.lock:
+            self.controllers.append(controller)
+            self._dirty = True
+        controller.scheduler = self
+
+    def invalidate(self):
+        self._dirty = True
+
+    def _refresh(self):
+        if self._dirty:
+            # clear first so a duty change during the reschedule triggers another one
+            self._dirty = False
+            self._switching = sum(1 for c in self.controllers if 0 < c.duty < 1)
+            if self.staggers:
+                self._phases = self._schedule()
+
+    def phase(self, controller):
+        with self.lock:
+            self._refresh()
+            return self._phases.get(id(controller), 0.0)
+
+    def edge_rate(self, controller):
+        """the share of max_edge_rate available to controller, or None"""
+        if self.max_edge_rate is None:
+            return None
+        with self.lock:
+            self._refresh()
+            return self.max_edge_rate / max(self._switching, 1)
+
+    def _schedule(self):
+        res = self.resolution
+        if self.max_watts is not None:
+            cap, weight = self.max_watts, lambda c: c.watts
+        else:
+            cap, weight = self.max_on, lambda c: 1
+        windows = sorted(
+            ((int(round(c.duty * res)), weight(c), c) for c in self.controllers),
+            key=lambda w: (-w[0] * w[1], w[2].name)
+        )
+        load = [0] * res
+        phases = {}
+        candidates = [0]
+        for slots, w, c in windows:
+            if not slots or slots >= res or not w:
+                # nothing to place, or the output is on for the whole cycle anyway
+                phases[id(c)] = 0.0
+                if slots >= res:
+                    load = [l + w for l in load]
+                continue
+            best = None
+            for start in candidates:
+                peak = max(load[(start + i) % res] for i in xrange(slots))
+                if peak + w <= cap:
+                    best = start
+                    break
+                if best is None or peak < best_peak:
+                    best, best_peak = start, peak
+            else:
+                log.warn(
+                    "|%s|unable to schedule within a load of %s; overlapping at %s",
+                    c.name, cap, best_peak + w
+                )
+            for i in xrange(slots):
+                load[(best + i) % res] += w
+            candidates.append((best + slots) % res)
+            phases[id(c)] = float(best) / res
+        return phases
+
+
+class PIDBank(threading.Thread):
+    """Runs the PID loops of any number of PIDPWMControllers in one batched update
+
+    The state of every loop lives in one array per field rather than in per-loop
+    objects, and all of the loops are updated together once every *interval* seconds.
+    The resulting outputs are applied as each controller's duty; they don't count as
+    a ping(), so a controller whose measurements stop arriving still goes dead.
+
+    Parameters
+    ----------
+    interval : float or int
+        The time, in seconds, between updates.
+
+    """
+    FIELDS = ("setpoint", "kp", "ki", "kd", "measurement", "previous", "integral", "output")
+
+    def __init__(self, interval=1, *args, **kwargs):
+        super(PIDBank, self).__init__(*args, **kwargs)
+        self.interval = BasePWMController._validate_float("interval", 0.001, float("inf"), interval)
+        self.daemon = True
+        self.lock = threading.Lock()
+        self.controllers = []
+        self.shutdown = False
+        self._last_step = None
+        for f in self.FIELDS:
+            setattr(self, f, array("d"))
+
+    def register(self, controller, setpoint, kp, ki, kd):
+        """add a loop for controller and return its index"""
+        nan = float("nan")
+        with self.lock:
+            for f, v in zip(self.FIELDS, (setpoint, kp, ki, kd, nan, nan, 0, 0)):
+                getattr(self, f).append(float(v))
+            self.controllers.append(controller)
+            return len(self.controllers) - 1
+
+    def get(self, field, index):
+        with self.lock:
+            return getattr(self, field)[index]
+
+    def set(self, field, index, value):
+        with self.lock:
+            getattr(self, field)[index] = value
+
+    def step(self, dt):
+        """update every loop that has a measurement and apply the outputs"""
+        with self.lock:
+            sp, kp, ki, kd = self.setpoint, self.kp, self.ki, self.kd
+            pv, prev, integral, output = self.measurement, self.previous, self.integral, self.output
+            for i in xrange(len(sp)):
+                if pv[i] != pv[i]:
+                    # no measurement yet
+                    continue
+                error = sp[i] - pv[i]
+                # derivative on measurement avoids a kick when the setpoint changes
+                derivative = 0.0 if prev[i] != prev[i] else (pv[i] - prev[i]) / dt
+                prev[i] = pv[i]
+                i_term = integral[i] + ki[i] * error * dt
+                u = kp[i] * error + i_term - kd[i] * derivative
+                # anti-windup: stop integrating while the output is saturated in the
+                # direction the error is pushing it
+                if u > 1:
+                    u = 1.0
+                    if error < 0:
+                        integral[i] = i_term
+                elif u < 0:
+                    u = 0.0
+                    if error > 0:
+                        integral[i] = i_term
+                else:
+                    integral[i] = i_term
+                output[i] = u
+            updates = [
+                (c, output[i]) for i, c in enumerate(self.controllers)
+                if pv[i] == pv[i]
+            ]
+        with audit.source("pid"):
+            for c, u in updates:
+                c._apply_duty(u)
+
+    def run(self):
+        log.info("|pid|starting %d loops", len(self.controllers))
+        self.shutdown = False
+        deadline = time.time()
+        while not self.shutdown:
+            now = time.time()
+            self.step(now - self._last_step if self._last_step else self.interval)
+            self._last_step = now
+            deadline = max(deadline + self.interval, now)
+            time.sleep(max(0, deadline - time.time()))
+
+    def stop(self):
+        self.shutdown = True
+
+
+class PIDPWMController(BasePWMController):
+    """Closed-loop PWM controller that sets its own duty from a PID loop
+
+    The duty is driven from 0 to 1 by a PID loop that compares *measurement* against
+    *setpoint*.  Every measurement counts as a ping(), so if the readings stop the
+    dead timer expires and the output is disabled.  The loops of all PIDPWMControllers
+    sharing a PIDBank are updated together.
+
+    Parameters
+    ----------
+    setpoint : float or int
+        The target value for measurement.
+    kp, ki, kd : float or int
+        The proportional, integral and derivative gains (per unit of duty).
+    pid_bank : PIDBank or None
+        The bank running this controller's loop.  If None, the controller creates its
+        own bank, which is started and stopped along with the controller.
+    pid_interval : float or int
+        The update interval for a bank created by the controller.
+
+    See Also
+    --------
+    BasePWMController
+    PIDBank
+
+    """
+    ITERABLES = BasePWMController.ITERABLES + ["setpoint", "kp", "ki", "kd", "measurement"]
+    SETTABLE = BasePWMController.SETTABLE + ["setpoint", "kp", "ki", "kd", "measurement"]
+
+    def __init__(self, setpoint=0, kp=0, ki=0, kd=0, pid_bank=None, pid_interval=1, *args, **kwargs):
+        super(PIDPWMController, self).__init__(*args, **kwargs)
+        self._own_bank = pid_bank is None
+        if pid_bank is None:
+            pid_bank = PIDBank(interval=pid_interval)
+        self.pid_bank = pid_bank
+        self._pid_index = pid_bank.register(self, setpoint, kp, ki, kd)
+
+    def _pid_property(field, doc):
+        def getter(self):
+            v = self.pid_bank.get(field, self._pid_index)
+            return None if v != v else v
+        def setter(self, value):
+            value = float(value)
+            old = getter(self)
+            self.pid_bank.set(field, self._pid_index, value)
+            if old != value:
+                self._audit(field, old, value)
+        return property(getter, setter, None, doc)
+
+    setpoint = _pid_property("setpoint", "the target value for measurement")
+    kp = _pid_property("kp", "the proportional gain")
+    ki = _pid_property("ki", "the integral gain")
+    kd = _pid_property("kd", "the derivative gain")
+    del _pid_property
+
+    def get_measurement(self):
+        v = self.pid_bank.get("measurement", self._pid_index)
+        return None if v != v else v
+
+    def set_measurement(self, value):
+        if value is None:
+            # forget the reading; the loop holds its output until the next one
+            self.pid_bank.set("measurement", self._pid_index, float("nan"))
+            return
+        self.pid_bank.set("measurement", self._pid_index, float(value))
+        self.ping()
+
+    measurement = property(
+        get_measurement,
+        set_measurement,
+        None,
+        "the latest sensor reading; setting it counts as a ping()"
+    )
+
+    def run(self):
+        if self._own_bank and not self.pid_bank.is_alive():
+            self.pid_bank.start()
+        try:
+            super(PIDPWMController, self).run()
+        finally:
+            if self._own_bank:
+                self.pid_bank.stop()
+
+
+class ControllerGroup(object):
+    """A master controller whose duty and pings are passed on to linked members
+
+    Every duty update on the master, whether it comes from a client, a profile or a
+    PID loop, sets the duty of the master and of all members in a single step with
+    every controller's lock held, so the bank is never seen half-updated.  Pings of
+    the master are passed on to the members.  Members can still be updated on their
+    own; the next update of the master overrides them.
+
+    Parameters
+    ----------
+    name : string
+        The group name.
+    master : BasePWMController
+        The controller that drives the group.
+    members : list of (BasePWMController, string, float)
+        The members as (controller, mode, value), where mode is one of
+        "mirror" (duty = master duty), "ratio" (duty = master duty * value) or
+        "offset" (duty = master duty + value).  Results are clamped to 0..1.
+
+    """
+    MODES = ("mirror", "ratio", "offset")
+    ITERABLES = [
+        ("class", "__class__.__name__"),
+        "name", "master", "members", "duty", "dead_interval", "dead_timer",
+    ]
+    SETTABLE = ["duty"]
+
+    def __init__(self, name, master, members):
+        self.name = name
+        for c, mode, value in members:
+            if mode not in self.MODES:
+                raise ConfigurationError(
+                    "group '{}' member '{}' mode must be one of {}"
+                    .format(name, c.name, ", ".join(self.MODES))
+                )
+        for c in [master] + [m[0] for m in members]:
+            if c.group is not None:
+                raise ConfigurationError(
+                    "controller '{}' is already in group '{}'"
+                    .format(c.name, c.group.name)
+                )
+        self._master = master
+        self._members = [(c, mode, float(value)) for c, mode, value in members]
+        # always take the locks in the same order so two groups can't deadlock
+        self._ordered = sorted([master] + [m[0] for m in members], key=lambda c: c.name)
+        for c in self._ordered:
+            c.group = self
+
+    def __iter__(self):
+        for k in self.ITERABLES:
+            if isinstance(k, tuple):
+                yield (k[0], reduce(getattr, k[1].split("."), self))
+            else:
+                yield (k, getattr(self, k))
+
+    @property
+    def master(self):
+        return self._master.name
+
+    @property
+    def members(self):
+        return dict(
+            (c.name, {"mode": mode, "value": value, "duty": c.duty})
+            for c, mode, value in self._members
+        )
+
+    @property
+    def dead_interval(self):
+        return self._master.dead_interval
+
+    @property
+    def dead_timer(self):
+        return self._master.dead_timer
+
+    @staticmethod
+    def _member_duty(mode, value, duty):
+        if mode == "ratio":
+            duty *= value
+        elif mode == "offset":
+            duty += value
+        return max(0.0, min(1.0, duty))
+
+    def _apply_duty(self, duty):
+        duties = [(self._master, duty)] + [
+            (c, self._member_duty(mode, value, duty)) for c, mode, value in self._members
+        ]
+        changes = []
+        for c in self._ordered:
+            c.lock.acquire()
+        try:
+            for c, d in duties:
+                if c._duty != d:
+                    changes.append((c, c._duty, d))
+                c._duty = d
+        finally:
+            for c in reversed(self._ordered):
+                c.lock.release()
+        for c in self._ordered:
+            if c.scheduler is not None:
+                c.scheduler.invalidate()
+            if c.journal is not None:
+                c.journal.dirty = True
+        for c, old, new in changes:
+            if c is self._master:
+                c._audit("duty", old, new)
+            else:
+                with audit.source("group"):
+                    c._audit("duty", old, new)
+
+    def _ping_members(self):
+        for c, mode, value in self._members:
+            c.ping()
+
+    def get_duty(self):
+        return self._master.duty
+
+    def set_duty(self, duty):
+        self._master.duty = duty
+
+    duty = property(get_duty, set_duty, None, "the master controller's duty")
+
+    def ping(self):
+        return self._master.ping()
+
+
+def groups_from_config(config, controllers):
+    """Link controllers into the groups defined in the ``groups`` section of a configuration
+
+    The section looks like::
+
+        groups:
+            boil_bank:
+                master: boil1
+                members:
+                    boil2: {mode: mirror}
+                    boil3: {mode: ratio, value: 0.6}
+
+    Parameters
+    ----------
+    config : dict
+        The configuration, as returned by load_config().
+    controllers : dict
+        The controllers returned by from_config().
+
+    Returns
+    -------
+    dict
+        The groups, keyed by name.
+
+    Raises
+    ------
+    ConfigurationError
+        If a content problem is encountered in the groups section.
+
+    """
+    gcfgs = config.get('groups') or {}
+    if not isinstance(gcfgs, dict):
+        raise ConfigurationError(
+            "groups must be a dict, not '{:s}'"
+            .format(type(gcfgs))
+        )
+    def lookup(gname, cname):
+        if cname not in controllers:
+            raise ConfigurationError(
+                "group '{}' controller '{}' not found"
+                .format(gname, cname)
+            )
+        if not isinstance(controllers[cname], BasePWMController):
+            raise ConfigurationError(
+                "group '{}' controller '{}' runs in its own process and can't be grouped"
+                .format(gname, cname)
+            )
+        return controllers[cname]
+    groups = {}
+    for gname, gcfg in sorted(gcfgs.iteritems()):
+        if gname in controllers:
+            raise ConfigurationError(
+                "group '{}' has the same name as a controller"
+                .format(gname)
+            )
+        if not isinstance(gcfg, dict) or 'master' not in gcfg or not isinstance(gcfg.get('members'), dict):
+            raise ConfigurationError(
+                "group '{}' must be a dict with a 'master' and a 'members' dict"
+                .format(gname)
+            )
+        members = []
+        for cname, mcfg in sorted(gcfg['members'].iteritems()):
+            mcfg = mcfg or {}
+            members.append((lookup(gname, cname), mcfg.get('mode', 'mirror'), mcfg.get('value', 1)))
+        groups[gname] = ControllerGroup(gname, lookup(gname, gcfg['master']), members)
+    return groups
+
+
+def _gpio_path(sysfs_root, gpio_id, *parts):
+    return os.path.join(sysfs_root, "gpio{}".format(gpio_id), *parts)
+
+
+def _sysfs_write(path, value):
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        os.write(fd, str(value))
+    finally:
+        os.close(fd)
+
+
+def export_gpios(gpio_ids, sysfs_root=DEFAULT_SYSFS_ROOT, timeout=DEFAULT_EXPORT_TIMEOUT, initial_value=0):
+    """Export one or more GPIO pins through sysfs and configure them as outputs
+
+    All of the pins are written to the export file first, after which the function polls
+    (for at most *timeout* seconds) until udev has made every pin's value and direction
+    files writable.  Each pin is then set as an output driven to *initial_value*.
+
+    Parameters
+    ----------
+    gpio_ids : iterable of int
+        The GPIO pin ids to export.  Pins that are already exported are left in place and
+        will not be unexported by unexport_gpios().
+    sysfs_root : str
+        The sysfs GPIO directory (normally /sys/class/gpio).
+    timeout : float or int
+        The maximum number of seconds to wait for the pins to become writable.
+    initial_value : int
+        The value (0 or 1) the outputs are driven to when direction is set.
+
+    Returns
+    -------
+    list
+        The ids of the pins that were exported by this call.
+
+    Raises
+    ------
+    IOError
+        If the pins do not become writable within *timeout* seconds.
+
+    """
+    gpio_ids = sorted(set(int(g) for g in gpio_ids))
+    exported = [g for g in gpio_ids if not os.path.exists(_gpio_path(sysfs_root, g))]
+    if exported:
+        log.info("exporting GPIO pins %s", ", ".join(str(g) for g in exported))
+        # the kernel only parses one pin id per write(), so reuse the fd for the whole batch
+        fd = os.open(os.path.join(sysfs_root, "export"), os.O_WRONLY)
+        try:
+            for g in exported:
+                os.write(fd, str(g))
+        finally:
+            os.close(fd)
+    # udev fixes up ownership asynchronously; poll with a backoff rather than a fixed sleep
+    deadline = time.time() + timeout
+    delay = 0.005
+    pending = list(gpio_ids)
+    while True:
+        pending = [
+            g for g in pending
+            if not all(
+                os.access(_gpio_path(sysfs_root, g, f), os.W_OK)
+                for f in ("value", "direction")
+            )
+        ]
+        if not pending:
+            break
+        if time.time() >= deadline:
+            raise IOError(
+                "GPIO pins {} not writable after {} seconds"
+                .format(", ".join(str(g) for g in pending), timeout)
+            )
+        time.sleep(delay)
+        delay = min(delay * 2, 0.25)
+    direction = "high" if initial_value else "low"
+    for g in gpio_ids:
+        # "high"/"low" set the direction to out and the initial value in a single step
+        _sysfs_write(_gpio_path(sysfs_root, g, "direction"), direction)
+    return exported
+
+
+def unexport_gpios(gpio_ids, sysfs_root=DEFAULT_SYSFS_ROOT):
+    """Unexport GPIO pins previously exported with export_gpios()
+
+    Errors are logged rather than raised since this is normally called during shutdown.
+
+    """
+    for g in gpio_ids:
+        try:
+            _sysfs_write(os.path.join(sysfs_root, "unexport"), g)
+        except (IOError, OSError):
+            log.exception("unable to unexport GPIO pin %s", g)
+
+
 class SysFSPWMController(BasePWMController):
     """PWM controller class for GPIO pins accessible through /sys/class/gpio/
 
@@ -237,16 +1234,28 @@ class SysFSPWMController(BasePWMController):
     Parameters
     ----------
     gpio_id : int
-        The GPIO pin id.  Must have been exported as /sys/class/gpio/gpio<id>
+        The GPIO pin id.  Must have been exported as /sys/class/gpio/gpio<id> unless
+        export is True.
+    export : bool
+        If True, export the pin (if necessary) and configure it as an output before
+        opening it.  A pin exported by the controller is unexported when run() exits.
+    export_timeout : float or int
+        The maximum number of seconds to wait for udev to make an exported pin writable.
+    sysfs_root : str
+        The sysfs GPIO directory.  Defaults to /sys/class/gpio.
+    verify : bool
+        If True, read the value back after every write and raise IOError if the pin
+        did not take the new state.
 
     See Also
     --------
     BasePWMController
+    export_gpios
 
     Notes
     -----
-    Exporting is left as an exercise to the operator.  Here's an example of how to
-    export GPIO pin #24:
+    If export is not set, exporting is left as an exercise to the operator.  Here's an
+    example of how to export GPIO pin #24:
 
     echo 24 | sudo tee /sys/class/gpio/export
     sudo chown -R *youruser* /sys/class/gpio/gpio24/
@@ -254,52 +1263,97 @@ class SysFSPWMController(BasePWMController):
 
     """
     ITERABLES = BasePWMController.ITERABLES + ["gpio_id"]
-    def __init__(self, gpio_id, *args, **kwargs):
+    def __init__(
+            self,
+            gpio_id,
+            export=False,
+            export_timeout=DEFAULT_EXPORT_TIMEOUT,
+            sysfs_root=DEFAULT_SYSFS_ROOT,
+            verify=False,
+            *args,
+            **kwargs
+        ):
         super(SysFSPWMController, self).__init__(*args, **kwargs)
         self.gpio_id = gpio_id
-        self.gpio = file(
-            "/sys/class/gpio/gpio{}/value".format(gpio_id),
-            "w+",
-            buffering=0
-        )
+        self.sysfs_root = sysfs_root
+        self.verify = verify
+        self._exported = []
+        if export:
+            self._exported = export_gpios([gpio_id], sysfs_root, export_timeout)
+        self.gpio_fd = os.open(_gpio_path(sysfs_root, gpio_id, "value"), os.O_RDWR)
+        # start from whatever is actually on the pin, so an output left on gets turned off
+        self.is_on = self._read() == "1"
+
+    def _read(self):
+        os.lseek(self.gpio_fd, 0, os.SEEK_SET)
+        return os.read(self.gpio_fd, 1) or None
 
+    def _write(self, value):
+        """write value to the pin and read it back"""
+        os.lseek(self.gpio_fd, 0, os.SEEK_SET)
+        os.write(self.gpio_fd, value)
+        actual = self._read()
+        if actual != value:
+            raise IOError(
+                "GPIO pin {} reads back {!r} after writing {!r}"
+                .format(self.gpio_id, actual, value)
+            )
+
+    # the unverified write is inlined since these run on every edge; python 2 has no
+    # os.pwrite()
     def _on(self):
-        self.gpio.write("1")
+        if self.verify:
+            self._write("1")
+        else:
+            os.lseek(self.gpio_fd, 0, os.SEEK_SET)
+            os.write(self.gpio_fd, "1")
 
     def _off(self):
-         self.gpio.write("0")
+        if self.verify:
+            self._write("0")
+        else:
+            os.lseek(self.gpio_fd, 0, os.SEEK_SET)
+            os.write(self.gpio_fd, "0")
 
+    def _cleanup(self):
+        if self._exported:
+            os.close(self.gpio_fd)
+            self.gpio_fd = None
+            unexport_gpios(self._exported, self.sysfs_root)
+            self._exported = []
+
+
+def _config_name(config_file):
+    if isinstance(config_file, basestring):
+        return config_file
+    return getattr(config_file, 'name', '<stream>')
 
-def from_config(config_file, autostart=True):
-    """Initialize one or more PWM controllers from a configuration file
+
+def load_config(config_file):
+    """Load a configuration file
 
     Parameters
     ----------
     config_file : str or file_like
         The file containing the configuration.  Can be a string (to be interpreted as the
         path to the file) or an open file handle.
-    autostart : bool
-        If True (the default), all controllers will be started automatically.
 
     Returns
     -------
     dict
-        A dictionary containing the controllers as defined in config_file
+        The parsed configuration.
 
     Raises
     ------
     IOError
         If config_file cannot be opened or read.
     ConfigurationError
-        If a syntax or content problem is encountered in config_file
-
-    Any errors encountered while initializing the controllers are sent through
-    unaltered.
+        If config_file is not valid YAML or its top level is not a dict.
 
     """
+    config_name = _config_name(config_file)
     if isinstance(config_file, basestring):
         config_file = file(config_file, 'r')
-    config_name = getattr(config_file, 'name', '<stream>')
     log.debug("using configuration from %s", config_name)
     with closing(config_file):
         try:
@@ -309,12 +1363,194 @@ def from_config(config_file, autostart=True):
                 "error while loading configuration from '{}': {:s}"
                 .format(config_name, e)
             )
-    controllers = {}
     if not isinstance(config, dict):
         raise ConfigurationError(
             "top level of configuration must be a dict, not '{:s}'"
             .format(type(config))
         )
+    return config
+
+
+def _shadow(cclass, cargs):
+    """a never-started controller for validating updates to a controller run elsewhere
+
+    It is a BasePWMController (or PIDPWMController) given whichever of cargs that class
+    takes, so it has the same limits without touching any hardware.
+
+    """
+    sclass = PIDPWMController if issubclass(cclass, PIDPWMController) else BasePWMController
+    names = set()
+    for klass in sclass.__mro__:
+        if '__init__' in vars(klass) and issubclass(klass, BasePWMController):
+            names.update(inspect.getargspec(klass.__init__).args)
+    return sclass(**dict((k, v) for k, v in cargs.iteritems() if k in names))
+
+
+def _build_controllers(config, specs, isolated, controllers):
+    """Create the PIDBank, ControllerProcesses and controllers for from_config()"""
+    pid_bank = None
+    if any(issubclass(cclass, PIDPWMController) for cname, cclass, cargs in specs if cname not in isolated):
+        pcfg = config.get('pid') or {}
+        if not isinstance(pcfg, dict):
+            raise ConfigurationError(
+                "pid must be a dict, not '{:s}'"
+                .format(type(pcfg))
+            )
+        try:
+            pid_bank = PIDBank(**pcfg)
+        except TypeError as e:
+            raise ConfigurationError(
+                "invalid pid configuration: {}".format(e)
+            )
+    processes = {}
+    for cname, cclass, cargs in specs:
+        if cname in isolated:
+            pname = isolated[cname]
+            if pname not in processes:
+                processes[pname] = ControllerProcess(pname)
+            controllers[cname] = processes[pname].add(cname, cclass, cargs, _shadow(cclass, dict(cargs, name=cname)))
+            continue
+        if issubclass(cclass, PIDPWMController):
+            cargs = dict(cargs, pid_bank=pid_bank)
+        if issubclass(cclass, SysFSPWMController) and cargs.get('export'):
+            # already exported and configured in the batch
+            cargs = dict((k, v) for k, v in cargs.iteritems() if k != 'export')
+        controllers[cname] = cclass(name=cname, **cargs)
+    return pid_bank, processes
+
+
+def _configure(config, local, processes):
+    """Set up the scheduler, audit log, journal and real-time settings for from_config()"""
+    if config.get('scheduler') is not None:
+        scfg = config['scheduler']
+        if not isinstance(scfg, dict):
+            raise ConfigurationError(
+                "scheduler must be a dict, not '{:s}'"
+                .format(type(scfg))
+            )
+        try:
+            scheduler = LoadScheduler(**scfg)
+        except TypeError as e:
+            raise ConfigurationError(
+                "invalid scheduler configuration: {}".format(e)
+            )
+        for cname in sorted(local):
+            scheduler.register(local[cname])
+    audit_log = None
+    if config.get('audit') is not None:
+        acfg = config['audit']
+        if not isinstance(acfg, dict) or 'path' not in acfg:
+            raise ConfigurationError("audit must be a dict with a 'path'")
+        try:
+            audit_log = audit.AuditLog(**acfg)
+        except TypeError as e:
+            raise ConfigurationError(
+                "invalid audit configuration: {}".format(e)
+            )
+        for cname in sorted(local):
+            local[cname].audit_log = audit_log
+            audit_log.record("reload", cname, source="config")
+    journal = None
+    if config.get('persistence') is not None:
+        jcfg = config['persistence']
+        if not isinstance(jcfg, dict) or 'path' not in jcfg:
+            raise ConfigurationError("persistence must be a dict with a 'path'")
+        try:
+            journal = StateJournal(**jcfg)
+        except TypeError as e:
+            raise ConfigurationError(
+                "invalid persistence configuration: {}".format(e)
+            )
+        state = journal.load()
+        for cname in sorted(local):
+            if cname in state:
+                log.info("|%s|restoring saved state", cname)
+                with audit.source("journal"):
+                    journal.restore(local[cname], state[cname])
+            journal.register(local[cname])
+    realtime = None
+    if config.get('realtime') is not None:
+        rcfg = config['realtime']
+        if not isinstance(rcfg, dict):
+            raise ConfigurationError(
+                "realtime must be a dict, not '{:s}'"
+                .format(type(rcfg))
+            )
+        try:
+            realtime = Realtime(**rcfg)
+        except (TypeError, ValueError) as e:
+            raise ConfigurationError(
+                "invalid realtime configuration: {}".format(e)
+            )
+        for c in local.itervalues():
+            c.realtime = realtime
+        for process in processes.itervalues():
+            process.realtime = realtime
+    return audit_log, journal, realtime
+
+
+def from_config(config_file, autostart=True):
+    """Initialize one or more PWM controllers from a configuration file
+
+    Parameters
+    ----------
+    config_file : str or file_like or dict
+        The file containing the configuration.  Can be a string (to be interpreted as the
+        path to the file), an open file handle or a configuration already loaded with
+        load_config().
+    autostart : bool
+        If True (the default), all controllers will be started automatically.
+
+    An optional top-level ``scheduler`` section holds the arguments for a LoadScheduler
+    that all of the controllers are registered with.
+
+    All PIDPWMControllers share a single PIDBank so their loops are updated together.
+    Its arguments can be given in an optional top-level ``pid`` section.
+
+    If there is a ``persistence`` section, its arguments are used for a StateJournal
+    (see pi_pwm.persistence) and the controllers' state is restored from it before they
+    are started.
+
+    If there is an ``audit`` section, its arguments are used for an AuditLog (see
+    pi_pwm.audit) that records every change made to the controllers.
+
+    If there is a ``realtime`` section, its arguments are used for the real-time
+    settings (see pi_pwm.realtime) of every controller thread and of the processes
+    running them.
+
+    SysFSPWMController entries with ``export: true`` in their args have their pins
+    exported in a single batch (see export_gpios()) before any controller is created.
+
+    A controller entry with a ``process`` name is run in a child process (see
+    pi_pwm.processes), together with any other controllers given the same name;
+    ``process: true`` gives the controller a process of its own.  The returned dict
+    holds ProcessPWMController handles for these.  They are left out of the
+    scheduler, the PIDBank, persistence and the audit log, which all live in this
+    process.
+
+    Returns
+    -------
+    dict
+        A dictionary containing the controllers as defined in config_file
+
+    Raises
+    ------
+    IOError
+        If config_file cannot be opened or read.
+    ConfigurationError
+        If a syntax or content problem is encountered in config_file
+
+    Any errors encountered while initializing the controllers are sent through
+    unaltered.
+
+    """
+    if isinstance(config_file, dict):
+        config, config_name = config_file, '<dict>'
+    else:
+        config, config_name = load_config(config_file), _config_name(config_file)
+    controllers = {}
+    specs = []
+    isolated = {}
     if not 'controllers' in config:
         raise ConfigurationError(
             "'controllers' section missing from configuration file '{}'"
@@ -349,8 +1585,63 @@ def from_config(config_file, autostart=True):
                 "controler '{}' args must be a dict, not '{:s}'"
                 .format(cname, type(cargs))
             )
-        controllers[cname] = cclass(name=cname, **cargs)
-    if autostart:
+        specs.append((cname, cclass, cargs))
+        pname = ccfg.get('process')
+        if pname is True:
+            isolated[cname] = cname
+        elif isinstance(pname, basestring):
+            isolated[cname] = pname
+        elif pname not in (None, False):
+            raise ConfigurationError(
+                "controller '{}' process must be a name or true, not '{}'"
+                .format(cname, pname)
+            )
+    exports = {}
+    for cname, cclass, cargs in specs:
+        if cname in isolated:
+            # exported by the controller in its own process
+            continue
+        if issubclass(cclass, SysFSPWMController) and cargs.get('export'):
+            key = (
+                cargs.get('sysfs_root', DEFAULT_SYSFS_ROOT),
+                cargs.get('export_timeout', DEFAULT_EXPORT_TIMEOUT)
+            )
+            exports.setdefault(key, []).append(cargs['gpio_id'])
+    batch_exported = {}
+    try:
+        for (sysfs_root, timeout), gpio_ids in sorted(exports.iteritems()):
+            for g in export_gpios(gpio_ids, sysfs_root, timeout):
+                batch_exported[(sysfs_root, g)] = True
+        pid_bank, processes = _build_controllers(config, specs, isolated, controllers)
+        local = dict((n, c) for n, c in controllers.iteritems() if n not in isolated)
+        audit_log, journal, realtime = _configure(config, local, processes)
+    except Exception:
+        # nothing has been started, so the pins would otherwise stay exported and open
+        exc_info = sys.exc_info()
         for c in controllers.itervalues():
-            c.start()
+            if getattr(c, 'gpio_fd', None) is not None:
+                os.close(c.gpio_fd)
+                c.gpio_fd = None
+        for sysfs_root, g in sorted(batch_exported):
+            unexport_gpios([g], sysfs_root)
+        raise exc_info[0], exc_info[1], exc_info[2]
+    for c in controllers.itervalues():
+        # hand ownership of batch-exported pins to their controllers so they get unexported
+        if (getattr(c, 'sysfs_root', None), getattr(c, 'gpio_id', None)) in batch_exported:
+            c._exported = [c.gpio_id]
+    if autostart:
+        if realtime is not None:
+            # before any thread starts, so their stacks are sized and locked
+            realtime.apply_process()
+        # fork before any thread is running, so no child inherits a lock held by one
+        for pname in sorted(processes):
+            processes[pname].start()
+        if audit_log is not None:
+            audit_log.start()
+        if journal is not None:
+            journal.start()
+        if pid_bank is not None:
+            pid_bank.start()
+        for cname in sorted(local):
+            local[cname].start()
     return controllers
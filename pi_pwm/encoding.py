@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+import gzip
+import json
+import StringIO
+
+from werkzeug.wrappers import Response
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:  # pragma: no cover
+    cbor2 = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+CBOR = "application/cbor"
+
+ALIASES = {"application/x-msgpack": MSGPACK}
+
+# responses smaller than this aren't worth compressing
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+
+
+def dumps_pretty(obj):
+    return json.dumps(obj, indent=4)
+
+
+def dumps_compact(obj):
+    return json.dumps(obj, separators=(",", ":"))
+
+
+def _text(obj):
+    """obj with every str (bytes, in python 2) replaced by unicode"""
+    if isinstance(obj, str):
+        return obj.decode("utf-8", "replace")
+    if isinstance(obj, dict):
+        return dict((_text(k), _text(v)) for k, v in obj.iteritems())
+    if isinstance(obj, (list, tuple)):
+        return [_text(v) for v in obj]
+    return obj
+
+
+ENCODERS = {JSON: dumps_pretty}
+DECODERS = {JSON: json.loads}
+if msgpack is not None:
+    # the names and strings in our responses are str, which use_bin_type would send as
+    # bin rather than as text
+    ENCODERS[MSGPACK] = lambda obj: msgpack.packb(obj, use_bin_type=False)
+    DECODERS[MSGPACK] = lambda data: msgpack.unpackb(data, raw=False)
+if cbor2 is not None:
+    # cbor2 sends str as a byte string
+    ENCODERS[CBOR] = lambda obj: cbor2.dumps(_text(obj))
+    DECODERS[CBOR] = cbor2.loads
+
+# in order of preference, when the client accepts several equally
+FORMATS = [f for f in (JSON, MSGPACK, CBOR) if f in ENCODERS]
+
+
+def canonical(mimetype):
+    mimetype = (mimetype or "").split(";")[0].strip().lower()
+    return ALIASES.get(mimetype, mimetype)
+
+
+def negotiate(accept):
+    """choose the format of a response
+
+    JSON is pretty-printed unless the client names application/json in its Accept
+    header, as browsers and curl don't; the binary formats are only offered when
+    their package is installed.
+
+    Parameters
+    ----------
+    accept : werkzeug.datastructures.MIMEAccept
+        The request's Accept header.
+
+    Returns
+    -------
+    tuple
+        The mimetype and a function encoding an object in it.
+
+    """
+    best = canonical(accept.best_match(FORMATS + [a for a in ALIASES if ALIASES[a] in ENCODERS]))
+    if best in ENCODERS and best != JSON:
+        return best, ENCODERS[best]
+    if any(canonical(value) == JSON for value, quality in accept if quality > 0):
+        return JSON, dumps_compact
+    return JSON, dumps_pretty
+
+
+def decode(content_type, data):
+    """decode a request body
+
+    Raises
+    ------
+    KeyError
+        If content_type isn't a format that can be decoded.
+    ValueError
+        If the body isn't valid.
+
+    """
+    decoder = DECODERS[canonical(content_type)]
+    try:
+        return decoder(data)
+    except Exception as e:
+        raise ValueError("invalid {} body: {}".format(canonical(content_type), e))
+
+
+def compress(data):
+    buf = StringIO.StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=GZIP_LEVEL)
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+
+def response(obj, request, status=200):
+    """obj, as a werkzeug Response in the format the request prefers
+
+    Responses of GZIP_MIN_SIZE bytes or more are compressed if the client accepts
+    gzip.
+
+    """
+    mimetype, dumps = negotiate(request.accept_mimetypes)
+    data = dumps(obj)
+    resp = Response(data, status=status, mimetype=mimetype)
+    resp.vary.update(("Accept", "Accept-Encoding"))
+    if len(data) >= GZIP_MIN_SIZE and request.accept_encodings["gzip"]:
+        resp.set_data(compress(data))
+        resp.headers["Content-Encoding"] = "gzip"
+    return resp
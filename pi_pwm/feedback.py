@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+
+import errno
+import fcntl
+import logging
+import os
+import select
+import threading
+import time
+
+from pi_pwm.controllers import (
+    BasePWMController, ConfigurationError, DEFAULT_SYSFS_ROOT, _gpio_path, _sysfs_write
+)
+
+DEFAULT_FEEDBACK_TIMEOUT = 1
+DEFAULT_MAX_MISSED = 3
+
+log = logging.getLogger(__name__)
+
+
+class FeedbackInput(object):
+    """A GPIO input reporting the actual state of a controller's output
+
+    For example an SSR's status output or a current sensor, wired to a GPIO pin.  Every
+    edge the controller commands (see BasePWMController.on() and off()) is expected to
+    show up on the input within *timeout* seconds; the time it took is recorded as the
+    switching latency.  The output is reported stuck on or stuck off when the input
+    disagrees with the commanded state for longer than *timeout*, until they agree
+    again, or when it misses *max_missed* commanded edges in a row (an edge is missed
+    if the input hasn't followed it by the next one, as with a relay welded shut under
+    PWM cycles shorter than *timeout*), until the input follows an edge again.
+
+    Parameters
+    ----------
+    controller : BasePWMController
+        The controller whose output is fed back.
+    gpio_id : int or None
+        The GPIO pin id.  The pin must have been exported as an input; its edge is set
+        to "both" so that poll() reports its changes.
+    active_low : bool
+        If True, the input reads 0 while the output is on.
+    timeout : float or int
+        The time, in seconds, the input may take to follow the output.
+    max_missed : int
+        The number of consecutive missed edges that raise an alert.
+    sysfs_root : str
+        The sysfs GPIO directory.  Defaults to /sys/class/gpio.
+    fd : int or None
+        An open file descriptor to read instead of the pin's value file, e.g. the read
+        end of a pipe; each write to it is one reading ("0" or "1").
+    eventmask : int or None
+        The poll events that signal a new reading.  Defaults to POLLPRI for sysfs pins
+        (how the kernel signals an edge) and POLLIN otherwise.
+
+    """
+    ITERABLES = [
+        "gpio_id", "value", "commanded", "timeout",
+        "latency", "alert", "alerts", "missed", "unexpected",
+    ]
+
+    def __init__(
+            self,
+            controller,
+            gpio_id=None,
+            active_low=False,
+            timeout=DEFAULT_FEEDBACK_TIMEOUT,
+            max_missed=DEFAULT_MAX_MISSED,
+            sysfs_root=DEFAULT_SYSFS_ROOT,
+            fd=None,
+            eventmask=None
+        ):
+        self.controller = controller
+        self.gpio_id = gpio_id
+        self.active_low = bool(active_low)
+        self.timeout = BasePWMController._validate_float("timeout", 0.001, float("inf"), timeout)
+        self.max_missed = BasePWMController._validate_integer("max_missed", 1, float("inf"), max_missed)
+        if fd is None:
+            if gpio_id is None:
+                raise ValueError("feedback needs a gpio_id or an fd")
+            _sysfs_write(_gpio_path(sysfs_root, gpio_id, "edge"), "both")
+            fd = os.open(_gpio_path(sysfs_root, gpio_id, "value"), os.O_RDONLY | os.O_NONBLOCK)
+            if eventmask is None:
+                eventmask = select.POLLPRI | select.POLLERR
+        self.fd = fd
+        self.eventmask = select.POLLIN if eventmask is None else eventmask
+        # commanded() runs in the controller's thread, everything else in the monitor's
+        self.lock = threading.Lock()
+        self.alert = None
+        self.alerts = 0
+        self.missed = 0
+        self.unexpected = 0
+        self.monitor = None
+        self._latency_last = None
+        self._latency_count = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+        # (state, time) of the last commanded edge, and whether the input has followed it
+        self._command = (controller.is_on, time.time())
+        self._followed = True
+        # whether the alert was raised by missed edges, which only a followed edge clears
+        self._latched = False
+        self._changed = time.time()
+        self.value = self._read()
+
+    def _read(self):
+        """the latest reading, or None if there isn't one"""
+        try:
+            os.lseek(self.fd, 0, os.SEEK_SET)
+        except OSError as e:
+            # a pipe: every write is a reading, and only the newest matters
+            if e.errno != errno.ESPIPE:
+                raise
+        try:
+            data = os.read(self.fd, 4096).strip()
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+            return None
+        if not data:
+            return None
+        return (data[-1] == "1") != self.active_low
+
+    def _readings(self, value, now=None):
+        now = now or time.time()
+        with self.lock:
+            if value is None or value == self.value:
+                return
+            self.value = value
+            self._changed = now
+            state, commanded_at = self._command
+            if value == state and not self._followed:
+                self._followed = True
+                self.missed = 0
+                latency = now - commanded_at
+                self._latency_count += 1
+                self._latency_total += latency
+                self._latency_max = max(self._latency_max, latency)
+                self._latency_last = latency
+                if self._latched:
+                    self._clear()
+            elif value != state:
+                # the input moved on its own
+                self.unexpected += 1
+        self.check(now)
+
+    def commanded(self, state, now=None):
+        """note an edge the controller is about to make (called from on() and off())"""
+        now = now or time.time()
+        with self.lock:
+            previous = self._command[0]
+            if not self._followed:
+                self.missed += 1
+                if self.missed >= self.max_missed and not self._latched:
+                    self._latched = True
+                    self._raise("stuck_off" if previous else "stuck_on", now)
+            self._command = (state, now)
+            self._followed = self.value == state
+            # a new deadline, or an alert that may clear
+            wake = not self._followed or self.alert is not None
+        if wake and self.monitor is not None:
+            self.monitor.wake()
+
+    def deadline(self):
+        """when the input will have disagreed with the output for too long, or None"""
+        with self.lock:
+            return self._deadline()
+
+    def _deadline(self):
+        state, commanded_at = self._command
+        if self.value is None or self.value == state or self.alert is not None:
+            return None
+        return max(commanded_at, self._changed) + self.timeout
+
+    def check(self, now=None):
+        """raise or clear the stuck alert"""
+        now = now or time.time()
+        with self.lock:
+            if self.value is None:
+                return
+            if self.value == self._command[0]:
+                if self.alert is not None and not self._latched:
+                    self._clear()
+                return
+            deadline = self._deadline()
+            if deadline is not None and now >= deadline:
+                self._raise("stuck_on" if self.value else "stuck_off", now)
+
+    def _raise(self, alert, now):
+        if alert != self.alert:
+            self.alerts += 1
+        self.alert = alert
+        state, commanded_at = self._command
+        log.warn(
+            "|%s|output %s: commanded %s %.3f seconds ago, feedback still %s (%d edges missed)",
+            self.controller.name, alert.replace("_", " "),
+            "on" if state else "off", now - commanded_at, "on" if self.value else "off", self.missed
+        )
+
+    def _clear(self):
+        log.info("|%s|feedback agrees with the output again", self.controller.name)
+        self.alert = None
+        self._latched = False
+
+    def _latency(self):
+        if not self._latency_count:
+            return None
+        return {
+            "last": self._latency_last,
+            "mean": self._latency_total / self._latency_count,
+            "max": self._latency_max,
+            "count": self._latency_count,
+        }
+
+    @property
+    def latency(self):
+        """switching latency statistics, in seconds"""
+        with self.lock:
+            return self._latency()
+
+    @property
+    def commanded_state(self):
+        return self._command[0]
+
+    def __iter__(self):
+        with self.lock:
+            items = []
+            for k in self.ITERABLES:
+                if k == "commanded":
+                    items.append((k, self.commanded_state))
+                elif k == "latency":
+                    items.append((k, self._latency()))
+                else:
+                    items.append((k, getattr(self, k)))
+        return iter(items)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FeedbackMonitor(threading.Thread):
+    """Waits on every feedback input from one thread
+
+    The inputs' file descriptors are registered with one epoll (or poll, where epoll
+    isn't available) object, so the thread sleeps in the kernel until an input changes
+    or the next stuck-output deadline comes up; nothing is polled from Python.
+    Commanded edges wake it through a pipe so it can set the new deadline.
+
+    Parameters
+    ----------
+    inputs : list
+        The FeedbackInputs to watch.
+
+    """
+    def __init__(self, inputs=(), *args, **kwargs):
+        super(FeedbackMonitor, self).__init__(*args, **kwargs)
+        self.daemon = True
+        self.shutdown = False
+        self.inputs = {}
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            _set_nonblocking(fd)
+        if hasattr(select, "epoll"):
+            self._poller = select.epoll()
+            self._scale = 1.0
+        else:  # pragma: no cover
+            self._poller = select.poll()
+            self._scale = 1000.0
+        self._poller.register(self._wake_r, select.POLLIN)
+        for i in inputs:
+            self.add(i)
+
+    def add(self, feedback):
+        """watch feedback, and hook it into its controller's on() and off()"""
+        self.inputs[feedback.fd] = feedback
+        self._poller.register(feedback.fd, feedback.eventmask)
+        feedback.monitor = self
+        feedback.controller.feedback = feedback
+
+    def wake(self):
+        """make the thread recompute its deadlines"""
+        try:
+            os.write(self._wake_w, "x")
+        except OSError as e:
+            # it's full, so the thread is waking anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _timeout(self, now):
+        deadlines = [d for d in (i.deadline() for i in self.inputs.itervalues()) if d is not None]
+        if not deadlines:
+            return -1
+        return max(0, min(deadlines) - now) * self._scale
+
+    def step(self):
+        """wait for the next change or deadline and handle it"""
+        events = self._poller.poll(self._timeout(time.time()))
+        now = time.time()
+        for fd, event in events:
+            if fd == self._wake_r:
+                try:
+                    os.read(self._wake_r, 4096)
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                continue
+            feedback = self.inputs.get(fd)
+            if feedback is not None:
+                feedback._readings(feedback._read(), now)
+        for feedback in self.inputs.itervalues():
+            feedback.check(now)
+
+    def run(self):
+        while not self.shutdown:
+            self.step()
+
+    def stop(self):
+        self.shutdown = True
+        self.wake()
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def from_config(config, controllers=None, autostart=True):
+    """Initialize the feedback inputs defined in the ``feedback`` section of a configuration
+
+    The section looks like::
+
+        feedback:
+            timeout: 1
+            inputs:
+                boil:
+                    gpio_id: 25
+                    active_low: true
+
+    where each input is named after the controller whose output it feeds back, and
+    *timeout*, *active_low* and *sysfs_root* can be given for all inputs and
+    overridden per input.
+
+    Parameters
+    ----------
+    config : dict
+        The configuration, as returned by pi_pwm.controllers.load_config().
+    controllers : dict or None
+        The controllers returned by pi_pwm.controllers.from_config().
+    autostart : bool
+        If True (the default), the monitor will be started automatically.
+
+    Returns
+    -------
+    FeedbackMonitor or None
+        The monitor, or None if the configuration has no feedback section.
+
+    Raises
+    ------
+    ConfigurationError
+        If a content problem is encountered in the feedback section.
+
+    """
+    fcfg = config.get('feedback')
+    if fcfg is None:
+        return None
+    controllers = controllers or {}
+    if not isinstance(fcfg, dict) or not isinstance(fcfg.get('inputs'), dict):
+        raise ConfigurationError("feedback must be a dict with an 'inputs' dict")
+    defaults = dict((k, v) for k, v in fcfg.iteritems() if k != 'inputs')
+    inputs = []
+    for cname, icfg in sorted(fcfg['inputs'].iteritems()):
+        c = controllers.get(cname)
+        if c is None:
+            raise ConfigurationError("feedback controller '{}' not found".format(cname))
+        if not isinstance(c, BasePWMController):
+            # e.g. isolated in a process, where on() and off() can't be hooked
+            raise ConfigurationError("feedback controller '{}' must run in this process".format(cname))
+        if not isinstance(icfg, dict) or 'gpio_id' not in icfg:
+            raise ConfigurationError(
+                "feedback input '{}' must be a dict with a 'gpio_id'".format(cname)
+            )
+        try:
+            inputs.append(FeedbackInput(c, **dict(defaults, **icfg)))
+        except (TypeError, ValueError, OSError, IOError) as e:
+            raise ConfigurationError(
+                "invalid feedback input '{}': {}".format(cname, e)
+            )
+    monitor = FeedbackMonitor(inputs)
+    if autostart:
+        monitor.start()
+    return monitor
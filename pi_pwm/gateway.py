@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import os
+import threading
+import time
+
+import pi_pwm.controllers
+import pi_pwm.encoding
+
+from flask import Flask, request
+from werkzeug.wrappers import Response
+
+from pi_pwm.client import ClientError, ConnectionPool
+from pi_pwm.controllers import ConfigurationError
+
+DEFAULT_TIMEOUT = 2
+DEFAULT_CACHE_TTL = 1
+DEFAULT_MAX_IDLE = 4
+
+log = logging.getLogger(__name__)
+
+
+class Node(object):
+    """A pi_pwm.webservice on another machine, and a pool of connections to it
+
+    The node's index (GET /) is fetched by one background thread at a time and
+    cached for *cache_ttl* seconds, so any number of requests for it in that time
+    cost one fetch, and a node that stops answering ties up one thread, not the
+    callers.
+
+    Parameters
+    ----------
+    name : str
+        The node name.
+    url : str
+        The base URL of the node's webservice, e.g. http://kettle.local:8080.
+    timeout : float or int
+        The time, in seconds, to wait for the node to answer.
+    cache_ttl : float or int
+        The time, in seconds, the node's index is cached.
+    max_idle : int
+        The maximum number of idle connections kept open.
+
+    """
+    ITERABLES = ["url", "status", "age", "error", "index"]
+
+    def __init__(self, name, url, timeout=DEFAULT_TIMEOUT, cache_ttl=DEFAULT_CACHE_TTL, max_idle=DEFAULT_MAX_IDLE):
+        self.pool = ConnectionPool(url, timeout, max_idle)
+        self.name = name
+        self.url = url
+        self.timeout = self.pool.timeout
+        self.cache_ttl = float(cache_ttl)
+        self._lock = threading.Lock()
+        self._fetching = None
+        self._index = None
+        self._index_time = None
+        self.error = None
+
+    def _fetch(self):
+        try:
+            status, content_type, data = self.pool.request("GET", "/", headers={"Accept": "application/json"})
+            if status != 200:
+                raise ClientError("GET / on node '{}' returned {}".format(self.name, status))
+            index = json.loads(data)
+            with self._lock:
+                self._index, self._index_time, self.error = index, time.time(), None
+        except (ClientError, ValueError) as e:
+            log.warn("|%s|%s", self.name, e)
+            self.error = str(e)
+        finally:
+            with self._lock:
+                done, self._fetching = self._fetching, None
+            done.set()
+
+    def refresh(self):
+        """start fetching the node's index unless it is cached or already being fetched
+
+        Returns
+        -------
+        threading.Event
+            Set once the index is up to date (or the fetch failed).
+
+        """
+        with self._lock:
+            if self._fetching is not None:
+                return self._fetching
+            done = threading.Event()
+            if self._index_time is not None and time.time() - self._index_time < self.cache_ttl:
+                done.set()
+                return done
+            self._fetching = done
+        t = threading.Thread(target=self._fetch, name="gateway-{}".format(self.name))
+        t.daemon = True
+        t.start()
+        return done
+
+    def invalidate(self):
+        """drop the cached index, e.g. after changing one of the node's controllers"""
+        with self._lock:
+            self._index_time = None
+
+    @property
+    def age(self):
+        index_time = self._index_time
+        return None if index_time is None else time.time() - index_time
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def status(self):
+        """"ok", "stale" (the last fetch failed or is late, so the index is old) or "down" (no index)"""
+        if self._index is None:
+            return "down"
+        age = self.age
+        if self.error is not None or age is None or age >= self.cache_ttl + self.timeout:
+            return "stale"
+        return "ok"
+
+    def __iter__(self):
+        for k in self.ITERABLES:
+            yield (k, getattr(self, k))
+
+
+class Gateway(object):
+    """Many nodes behind one index
+
+    Parameters
+    ----------
+    nodes : dict
+        The Nodes, keyed by name.
+
+    """
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def index(self, names=None):
+        """fetch the index of every node (or those named) in parallel
+
+        Waits at most each node's timeout for it; nodes that are late or failed are
+        reported with their last index, if any.
+
+        """
+        nodes = [self.nodes[n] for n in sorted(names or self.nodes)]
+        start = time.time()
+        pending = [(node, node.refresh()) for node in nodes]
+        for node, done in pending:
+            done.wait(max(0, start + node.timeout - time.time()))
+        return dict((node.name, dict(node)) for node in nodes)
+
+
+def from_config(config):
+    """Initialize a Gateway from the ``gateway`` section of a configuration
+
+    The section looks like::
+
+        gateway:
+            timeout: 2
+            cache_ttl: 1
+            nodes:
+                kettle: http://kettle.local:8080
+                fermenter:
+                    url: http://fermenter.local:8080
+                    timeout: 5
+
+    where *timeout*, *cache_ttl* and *max_idle* can be given for all nodes and
+    overridden per node.
+
+    Parameters
+    ----------
+    config : dict
+        The configuration, as returned by pi_pwm.controllers.load_config().
+
+    Returns
+    -------
+    Gateway
+
+    Raises
+    ------
+    ConfigurationError
+        If the gateway section is missing or a content problem is encountered in it.
+
+    """
+    gcfg = config.get('gateway')
+    if not isinstance(gcfg, dict) or not isinstance(gcfg.get('nodes'), dict):
+        raise ConfigurationError("gateway must be a dict with a 'nodes' dict")
+    defaults = dict((k, v) for k, v in gcfg.iteritems() if k != 'nodes')
+    nodes = {}
+    for nname, ncfg in sorted(gcfg['nodes'].iteritems()):
+        if isinstance(ncfg, basestring):
+            ncfg = {'url': ncfg}
+        if not isinstance(ncfg, dict) or 'url' not in ncfg:
+            raise ConfigurationError(
+                "node '{}' must be a URL or a dict with a 'url'".format(nname)
+            )
+        try:
+            nodes[nname] = Node(nname, **dict(defaults, **ncfg))
+        except (TypeError, ValueError) as e:
+            raise ConfigurationError(
+                "invalid node '{}' configuration: {}".format(nname, e)
+            )
+    return Gateway(nodes)
+
+
+def create_app(config_file):
+    app = Flask("pi_pwm.gateway")
+    gateway = from_config(pi_pwm.controllers.load_config(config_file))
+    app.config['GATEWAY'] = gateway
+
+    def respond(r, status=200):
+        return pi_pwm.encoding.response(r, request, status)
+
+    def proxy(node, path):
+        n = gateway.nodes.get(node)
+        if n is None:
+            return respond({"error": "node {} not found".format(node)}, 404)
+        if request.method != "GET" and pi_pwm.encoding.canonical(request.content_type) not in pi_pwm.encoding.DECODERS:
+            return respond({"error": "Content-type must be {}, not {}".format(
+                " or ".join(pi_pwm.encoding.FORMATS), request.content_type
+            )}, 405)
+        headers = {}
+        if "Accept" in request.headers:
+            # the node answers in whatever format the client wants
+            headers["Accept"] = request.headers["Accept"]
+        try:
+            status, content_type, data = n.pool.request(
+                request.method, path,
+                request.get_data() if request.method != "GET" else None,
+                request.content_type,
+                headers,
+            )
+        except ClientError as e:
+            return respond({"error": str(e)}, 504)
+        if request.method != "GET" or path.endswith("/ping"):
+            n.invalidate()
+        return Response(data, status=status, content_type=content_type)
+
+    @app.route("/")
+    def index():
+        return respond(gateway.index())
+
+    @app.route("/<string:node>/", strict_slashes=False)
+    def node_index(node):
+        if node not in gateway.nodes:
+            return respond({"error": "node {} not found".format(node)}, 404)
+        return respond(gateway.index([node])[node])
+
+    @app.route("/<string:node>/<string:controller>/ping", methods=["GET"])
+    def ping(node, controller):
+        return proxy(node, "/{}/ping".format(controller))
+
+    @app.route("/<string:node>/<string:controller>/", methods=["GET", "POST"], strict_slashes=False)
+    def controller(node, controller):
+        return proxy(node, "/{}/".format(controller))
+
+    return app
+
+def init_app(config=None):
+    if not config:
+        config = os.environ.get("PWM_GATEWAY_CONFIG", "gateway.yaml")
+    return create_app(config)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import socket
+import threading
+import time
+
+try:
+    import paho.mqtt.client as paho
+except ImportError:  # pragma: no cover
+    paho = None
+
+from pi_pwm import audit
+from pi_pwm.controllers import ConfigurationError
+
+DEFAULT_PORT = 1883
+DEFAULT_PREFIX = "pi_pwm"
+DEFAULT_PUBLISH_INTERVAL = 1
+DEFAULT_KEEPALIVE = 60
+DEFAULT_MIN_BACKOFF = 1
+DEFAULT_MAX_BACKOFF = 60
+
+log = logging.getLogger(__name__)
+
+
+class MQTTBridge(threading.Thread):
+    """Bridges controllers to an MQTT broker
+
+    Messages to ``<prefix>/<controller>/set`` update the controller: the payload is a
+    JSON object with any of the controller's SETTABLE parameters (e.g. ``duty`` or
+    ``interval``), and ``"ping": true`` to ping it.  Updates count as pings just as
+    they do through the webservice.
+
+    Each controller's state (duty, interval, phase, whether the output is on and
+    whether the dead timer has expired) is published as JSON, retained, to
+    ``<prefix>/<controller>/state``.
+    Changes are collected and published together at most once every
+    *publish_interval* seconds, so a controller switching many times a second
+    costs one message per interval, and an unchanged controller costs nothing.
+    ``<prefix>/status`` is "online" while the bridge is connected and "offline"
+    (as its will) otherwise.
+
+    If the connection fails or drops, the bridge keeps retrying, waiting
+    *min_backoff* seconds at first and doubling the wait up to *max_backoff*.
+
+    Parameters
+    ----------
+    controllers : dict
+        The controllers (or groups) to bridge, keyed by name.
+    host : str
+        The broker's host name.
+    port : int
+        The broker's port.
+    prefix : str
+        The topic prefix.
+    publish_interval : float or int
+        The minimum time, in seconds, between publishes of a controller's state.
+    keepalive : int
+        The MQTT keepalive, in seconds.
+    client_id : str or None
+        The MQTT client id; by default the broker assigns one.
+    username, password : str or None
+        The broker credentials, if it needs them.
+    min_backoff, max_backoff : float or int
+        The range, in seconds, of the wait between connection attempts.
+    client_factory : callable or None
+        Called with client_id to create the client; by default a paho.mqtt.client.Client.
+        Anything with the same interface will do.
+
+    """
+    STATE = ["duty", "interval", "phase", "is_on"]
+
+    def __init__(
+            self,
+            controllers,
+            host="localhost",
+            port=DEFAULT_PORT,
+            prefix=DEFAULT_PREFIX,
+            publish_interval=DEFAULT_PUBLISH_INTERVAL,
+            keepalive=DEFAULT_KEEPALIVE,
+            client_id=None,
+            username=None,
+            password=None,
+            min_backoff=DEFAULT_MIN_BACKOFF,
+            max_backoff=DEFAULT_MAX_BACKOFF,
+            client_factory=None,
+            *args,
+            **kwargs
+        ):
+        super(MQTTBridge, self).__init__(*args, **kwargs)
+        if client_factory is None:
+            if paho is None:
+                raise ConfigurationError("the MQTT bridge needs paho-mqtt (pip install paho-mqtt)")
+            client_factory = lambda client_id: paho.Client(client_id=client_id or "")
+        self.controllers = controllers
+        self.host = host
+        self.port = port
+        self.prefix = prefix.rstrip("/")
+        self.publish_interval = float(publish_interval)
+        self.keepalive = keepalive
+        self.min_backoff = float(min_backoff)
+        self.max_backoff = float(max_backoff)
+        self.daemon = True
+        self.shutdown = False
+        self.connected = False
+        self.published = 0
+        self._backoff = self.min_backoff
+        self._last_state = {}
+        self._next_publish = 0
+        self.client = client_factory(client_id)
+        if username is not None:
+            self.client.username_pw_set(username, password)
+        self.client.will_set(self._topic("status"), "offline", retain=True)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_message = self._on_message
+
+    def _topic(self, *parts):
+        return "/".join((self.prefix,) + parts)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            log.warn("|mqtt|connection to %s:%s refused (%s)", self.host, self.port, rc)
+            return
+        log.info("|mqtt|connected to %s:%s", self.host, self.port)
+        self.connected = True
+        self._backoff = self.min_backoff
+        client.subscribe(self._topic("+", "set"))
+        client.publish(self._topic("status"), "online", retain=True)
+        # the broker may have lost our retained state, so send all of it again
+        self._last_state = {}
+        self._next_publish = 0
+
+    def _on_disconnect(self, client, userdata, rc):
+        if self.connected:
+            log.warn("|mqtt|disconnected from %s:%s (%s)", self.host, self.port, rc)
+        self.connected = False
+
+    def _on_message(self, client, userdata, msg):
+        parts = msg.topic.split("/")
+        name = parts[-2] if len(parts) >= 2 else None
+        c = self.controllers.get(name)
+        if c is None or parts[-1] != "set":
+            log.warn("|mqtt|no controller for %s", msg.topic)
+            return
+        try:
+            update = json.loads(msg.payload)
+            if not isinstance(update, dict):
+                raise ValueError("payload must be a JSON object")
+            with audit.source("mqtt"):
+                for k in c.SETTABLE:
+                    if k in update:
+                        setattr(c, k, update[k])
+                if update.get("ping"):
+                    c.ping()
+        except (TypeError, ValueError) as e:
+            log.warn("|%s|invalid update from %s: %s", name, msg.topic, e)
+        except Exception:
+            # anything raised here would stop paho's network loop, and the bridge with it
+            log.exception("|%s|unable to apply update from %s", name, msg.topic)
+
+    def state(self, c):
+        """what is published for c; dead rather than dead_timer, which changes every second"""
+        state = dict((k, getattr(c, k, None)) for k in self.STATE)
+        dead_timer = c.dead_timer
+        state["dead"] = dead_timer is not None and dead_timer <= 0
+        return state
+
+    def publish_changes(self):
+        """publish the state of every controller that changed since it was last published"""
+        for name in sorted(self.controllers):
+            state = self.state(self.controllers[name])
+            if self._last_state.get(name) == state:
+                continue
+            self.client.publish(self._topic(name, "state"), json.dumps(state, sort_keys=True), retain=True)
+            self._last_state[name] = state
+            self.published += 1
+
+    def _connect(self):
+        try:
+            self.client.connect(self.host, self.port, self.keepalive)
+            return True
+        except (socket.error, IOError, OSError) as e:
+            log.warn("|mqtt|unable to connect to %s:%s: %s; retrying in %s seconds", self.host, self.port, e, self._backoff)
+            return False
+
+    def _wait_backoff(self):
+        deadline = time.time() + self._backoff
+        while not self.shutdown and time.time() < deadline:
+            time.sleep(min(0.1, self._backoff))
+        self._backoff = min(self._backoff * 2, self.max_backoff)
+
+    def run(self):
+        connecting = False
+        while not self.shutdown:
+            if not self.connected and not connecting:
+                if not self._connect():
+                    self._wait_backoff()
+                    continue
+                connecting = True
+            now = time.time()
+            if self.connected:
+                connecting = False
+                if now >= self._next_publish:
+                    self.publish_changes()
+                    self._next_publish = now + self.publish_interval
+            rc = self.client.loop(timeout=max(0.01, min(0.1, self._next_publish - now)))
+            if rc:
+                # the connection failed or dropped
+                self._on_disconnect(self.client, None, rc)
+                connecting = False
+                self._wait_backoff()
+        if self.connected:
+            self.client.publish(self._topic("status"), "offline", retain=True)
+            self.client.loop(timeout=0.1)
+            self.client.disconnect()
+            self.connected = False
+
+    def stop(self):
+        self.shutdown = True
+
+
+def from_config(config, controllers, autostart=True):
+    """Initialize the MQTT bridge from the ``mqtt`` section of a configuration
+
+    The section holds the arguments for MQTTBridge, for example::
+
+        mqtt:
+            host: broker.local
+            prefix: brewery/pwm
+            publish_interval: 1
+
+    Parameters
+    ----------
+    config : dict
+        The configuration, as returned by pi_pwm.controllers.load_config().
+    controllers : dict
+        The controllers (and groups) to bridge.
+    autostart : bool
+        If True (the default), the bridge will be started automatically.
+
+    Returns
+    -------
+    MQTTBridge or None
+        The bridge, or None if the configuration has no mqtt section.
+
+    Raises
+    ------
+    ConfigurationError
+        If a content problem is encountered in the mqtt section, or paho-mqtt isn't
+        installed.
+
+    """
+    mcfg = config.get('mqtt')
+    if mcfg is None:
+        return None
+    if not isinstance(mcfg, dict):
+        raise ConfigurationError(
+            "mqtt must be a dict, not '{:s}'"
+            .format(type(mcfg))
+        )
+    try:
+        bridge = MQTTBridge(controllers, **mcfg)
+    except (TypeError, ValueError) as e:
+        raise ConfigurationError(
+            "invalid mqtt configuration: {}".format(e)
+        )
+    if autostart:
+        bridge.start()
+    return bridge
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+
+DEFAULT_FLUSH_INTERVAL = 30
+DEFAULT_MAX_AGE = 3600
+
+log = logging.getLogger(__name__)
+
+
+class StateJournal(threading.Thread):
+    """Write-behind persistence of controller state
+
+    Setters only mark the journal dirty, which costs an attribute assignment.  The
+    journal thread writes a snapshot of every registered controller at most once
+    every *flush_interval* seconds (and only if something changed), plus once more
+    on shutdown, so frequent duty updates turn into a bounded number of writes to
+    the SD card.  Each snapshot replaces the file atomically (write, fsync, rename),
+    so a power failure leaves either the old state or the new one.
+
+    Parameters
+    ----------
+    path : str
+        The state file.
+    flush_interval : float or int
+        The minimum time, in seconds, between writes.
+    max_age : float or int
+        State older than this many seconds is ignored by load().
+    fields : list of str
+        The controller attributes that are saved and restored.
+
+    """
+    FIELDS = ["interval", "duty", "profile"]
+
+    def __init__(self, path, flush_interval=DEFAULT_FLUSH_INTERVAL, max_age=DEFAULT_MAX_AGE, fields=None, *args, **kwargs):
+        super(StateJournal, self).__init__(*args, **kwargs)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_age = max_age
+        self.fields = list(fields or self.FIELDS)
+        self.controllers = {}
+        self.daemon = True
+        self.dirty = False
+        self.writes = 0
+        self._wake = threading.Event()
+        self._flush_lock = threading.Lock()
+        self.shutdown = False
+
+    def register(self, controller):
+        self.controllers[controller.name] = controller
+        controller.journal = self
+
+    def load(self):
+        """return the saved {controller name: {field: value}}, or {} if missing or too old"""
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            log.info("|journal|no usable state in %s: %s", self.path, e)
+            return {}
+        age = time.time() - state.get("saved_at", 0)
+        if age > self.max_age:
+            log.info("|journal|ignoring state saved %d seconds ago", age)
+            return {}
+        controllers = state.get("controllers", {})
+        # profiles keep running on the wall clock while we were down
+        for cstate in controllers.values():
+            profile = cstate.get("profile")
+            if isinstance(profile, dict) and profile.get("status") == "running":
+                profile["elapsed"] = profile.get("elapsed", 0) + age
+        return controllers
+
+    def restore(self, controller, state):
+        """apply saved state to controller without counting as a ping"""
+        for k in self.fields:
+            if k not in state:
+                continue
+            try:
+                if k == "duty":
+                    controller._apply_duty(state[k])
+                elif k == "profile":
+                    if state[k] is not None:
+                        controller.set_profile(state[k], ping=False)
+                else:
+                    setattr(controller, k, state[k])
+            except (TypeError, ValueError) as e:
+                log.warn("|%s|unable to restore %s: %s", controller.name, k, e)
+
+    def snapshot(self):
+        return {
+            "saved_at": time.time(),
+            "controllers": dict(
+                (name, dict((k, getattr(c, k)) for k in self.fields))
+                for name, c in self.controllers.iteritems()
+            ),
+        }
+
+    def flush(self):
+        """write a snapshot if anything changed since the last one"""
+        with self._flush_lock:
+            if not self.dirty:
+                return False
+            # clear first so a change made while we write is caught by the next flush
+            self.dirty = False
+            tmp = self.path + ".tmp"
+            try:
+                with open(tmp, "w") as f:
+                    json.dump(self.snapshot(), f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(tmp, self.path)
+            except (IOError, OSError):
+                self.dirty = True
+                log.exception("|journal|unable to write %s", self.path)
+                return False
+            self.writes += 1
+            return True
+
+    def run(self):
+        atexit.register(self.stop)
+        while not self.shutdown:
+            self._wake.wait(self.flush_interval)
+            self.flush()
+
+    def stop(self):
+        self.shutdown = True
+        self._wake.set()
+        self.flush()
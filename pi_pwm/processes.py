@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+import atexit
+import ctypes
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+from multiprocessing.sharedctypes import RawArray, RawValue
+
+DEFAULT_POLL_INTERVAL = 0.01
+DEFAULT_STOP_TIMEOUT = 2
+PR_SET_PDEATHSIG = 1
+
+log = logging.getLogger(__name__)
+
+_NAN = float("nan")
+
+
+def _encode(v):
+    return _NAN if v is None else float(v)
+
+
+def _decode(v):
+    return None if v != v else v
+
+
+def _same(a, b):
+    return a == b or (a != a and b != b)
+
+
+def _set_pdeathsig():
+    """ask the kernel to SIGTERM this process when its parent dies (Linux only)"""
+    try:
+        ctypes.CDLL(None).prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+    except (OSError, AttributeError):
+        pass
+
+
+class ProcessPWMController(object):
+    """Handle on a controller that runs in a ControllerProcess
+
+    The handle stands in for the controller in the webservice: its settable parameters
+    are validated against *shadow* (a never-started controller built from the same
+    arguments) and written straight into a block of shared memory, which the
+    controller's process polls every *poll_interval* seconds.  Reads come from the
+    values and status the process last wrote into the same block, so neither side ever
+    waits on the other.  Duty updates made between two polls are coalesced: only the
+    newest is applied, and the others are counted in *superseded*.
+
+    Parameters
+    ----------
+    name : str
+        The controller name.
+    cclass : type
+        The class of the controller run in the process.
+    cargs : dict
+        The arguments for cclass.
+    shadow : BasePWMController
+        A controller with the same parameters as the real one, used to validate updates.
+    process : ControllerProcess
+        The process running the controller.
+
+    Notes
+    -----
+    Profiles can't be kept in shared memory, so they aren't settable through a handle.
+
+    """
+    STATUS = ["is_on", "edges", "dead_timer", "heartbeat", "realtime_mask", "superseded"]
+
+    def __init__(self, name, cclass, cargs, shadow, process):
+        self.name = name
+        self.cclass = cclass
+        self.cargs = cargs
+        self.shadow = shadow
+        self.process = process
+        self.group = None
+        self._lock = threading.Lock()
+        self.SETTABLE = [k for k in shadow.SETTABLE if k != "profile"]
+        n = len(self.SETTABLE)
+        # requested values, their update counts, last ping, reported values, status
+        self._generation = n
+        self._ping = 2 * n
+        self._reported = 2 * n + 1
+        self._status = dict((k, 3 * n + 1 + i) for i, k in enumerate(self.STATUS))
+        self._shared = RawArray("d", 3 * n + 1 + len(self.STATUS))
+        for i, k in enumerate(self.SETTABLE):
+            self._shared[i] = self._shared[self._reported + i] = _encode(getattr(shadow, k))
+        self._shared[self._status["dead_timer"]] = _NAN
+        self._shared[self._status["realtime_mask"]] = _NAN
+        # set last, it switches on __setattr__
+        self._fields = dict((k, i) for i, k in enumerate(self.SETTABLE))
+
+    def __getattr__(self, k):
+        # only called for names that aren't ordinary attributes
+        fields = self.__dict__.get("_fields")
+        if fields is None:
+            raise AttributeError(k)
+        if k in fields:
+            return _decode(self._shared[self._reported + fields[k]])
+        if k in self._status:
+            v = _decode(self._shared[self._status[k]])
+            return bool(v) if k == "is_on" else v if k == "heartbeat" or v is None else int(v)
+        try:
+            return getattr(self.shadow, k)
+        except AttributeError:
+            if k in self.cargs:
+                return self.cargs[k]
+            raise
+
+    def __setattr__(self, k, v):
+        if k in self.__dict__.get("_fields", ()):
+            self.set(k, v)
+        else:
+            super(ProcessPWMController, self).__setattr__(k, v)
+
+    def __iter__(self):
+        for k in self.cclass.ITERABLES:
+            if isinstance(k, tuple):
+                k = k[0]
+            if k == "class":
+                yield (k, self.cclass.__name__)
+            elif k in ("thread_id", "group", "profile"):
+                yield (k, None)
+            elif k == "realtime":
+                yield (k, self.realtime_status)
+            else:
+                yield (k, getattr(self, k))
+        yield ("process", self.process.name)
+        yield ("pid", self.process.pid)
+        yield ("heartbeat", self.heartbeat)
+
+    @property
+    def realtime_status(self):
+        """the real-time settings in effect for the controller's thread, or None"""
+        mask = self.realtime_mask
+        if self.process.realtime is None or mask is None:
+            return None
+        return self.process.realtime.describe(mask)
+
+    def set(self, k, v):
+        """validate v against the shadow controller and hand it to the process"""
+        i = self._fields[k]
+        with self._lock:
+            setattr(self.shadow, k, v)
+            self._shared[i] = _encode(getattr(self.shadow, k))
+            self._shared[self._generation + i] += 1
+            self._shared[self._ping] = _encode(self.shadow._last_ping)
+
+    def ping(self):
+        with self._lock:
+            r = self.shadow.ping()
+            self._shared[self._ping] = _encode(self.shadow._last_ping)
+        return r
+
+    def start(self):
+        self.process.start()
+
+    def stop(self):
+        self.process.stop()
+
+    def join(self, timeout=None):
+        self.process.join(timeout)
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    # in the controller's process
+
+    def _apply(self, controller, seen):
+        """apply new requests to controller and report its state; seen is updated in place"""
+        shared = self._shared
+        for k, i in self._fields.iteritems():
+            generation, value = shared[self._generation + i], shared[i]
+            # the value is compared too, in case its write isn't visible yet alongside the count
+            if generation == seen[i][0] and _same(value, seen[i][1]):
+                continue
+            if k == "duty":
+                # only the newest of the updates since the last poll is applied
+                controller.superseded += max(0, int(generation - seen[i][0]) - 1)
+            seen[i] = (generation, value)
+            try:
+                if k == "duty":
+                    controller._apply_duty(value)
+                else:
+                    setattr(controller, k, _decode(value))
+            except (TypeError, ValueError) as e:
+                log.warn("|%s|unable to set %s: %s", self.name, k, e)
+        ping = shared[self._ping]
+        if not _same(ping, seen[-1]):
+            seen[-1] = ping
+            controller.ping()
+        for k, i in self._fields.iteritems():
+            shared[self._reported + i] = _encode(getattr(controller, k))
+        status = self._status
+        shared[status["is_on"]] = controller.is_on
+        shared[status["edges"]] = controller.edges
+        shared[status["dead_timer"]] = _encode(controller.dead_timer)
+        shared[status["realtime_mask"]] = _encode(controller._realtime_mask)
+        shared[status["superseded"]] = controller.superseded
+        shared[status["heartbeat"]] = time.time()
+
+
+class ControllerProcess(multiprocessing.Process):
+    """Runs one or more controllers in a child process
+
+    Each controller keeps its usual thread, but in a process of its own, so its edges
+    don't wait on the webservice (or anything else in the parent) for the GIL.  The
+    parent talks to the controllers through ProcessPWMController handles backed by
+    shared memory.
+
+    The outputs are turned off and the controllers' run() cleanup is done whenever the
+    process ends: on stop(), on SIGTERM, and when the parent dies (the kernel is asked
+    to send SIGTERM where that is supported, and the parent pid is polled everywhere
+    else).
+
+    The process applies the real-time settings in its *realtime* attribute (see
+    pi_pwm.realtime), if any, when it starts.
+
+    Parameters
+    ----------
+    name : str
+        The process name.
+    poll_interval : float or int
+        The time, in seconds, between checks for new parameters.
+
+    """
+    def __init__(self, name, poll_interval=DEFAULT_POLL_INTERVAL, *args, **kwargs):
+        super(ControllerProcess, self).__init__(name=name, *args, **kwargs)
+        self.poll_interval = poll_interval
+        self.daemon = True
+        self.handles = []
+        self.realtime = None
+        self._shutdown = RawValue("b", 0)
+        self._parent_pid = os.getpid()
+
+    def add(self, name, cclass, cargs, shadow):
+        """add a controller to be run by the process and return its handle"""
+        handle = ProcessPWMController(name, cclass, cargs, shadow, self)
+        self.handles.append(handle)
+        return handle
+
+    def start(self):
+        # called once for each handle by from_config()
+        if self._popen is None:
+            atexit.register(self.stop)
+            super(ControllerProcess, self).start()
+
+    def stop(self, timeout=DEFAULT_STOP_TIMEOUT):
+        self._shutdown.value = 1
+        if self._popen is None or os.getpid() != self._parent_pid:
+            return
+        self.join(timeout)
+        if self.is_alive():
+            log.warn("|%s|process did not stop; terminating", self.name)
+            self.terminate()
+            self.join(timeout)
+
+    def _terminate(self, signum, frame):
+        raise SystemExit(0)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._terminate)
+        _set_pdeathsig()
+        running = []
+        try:
+            if self.realtime is not None:
+                # memory locks aren't inherited from the parent
+                self.realtime.apply_process()
+            for h in self.handles:
+                c = h.cclass(name=h.name, **h.cargs)
+                c.realtime = self.realtime
+                running.append((h, c, [(0, _NAN)] * len(h.SETTABLE) + [_NAN]))
+            log.info("|%s|starting %d controllers in process %d", self.name, len(running), os.getpid())
+            for h, c, seen in running:
+                h._apply(c, seen)
+                c.start()
+            while not self._shutdown.value and os.getppid() == self._parent_pid:
+                for h, c, seen in running:
+                    h._apply(c, seen)
+                time.sleep(self.poll_interval)
+        finally:
+            for h, c, seen in running:
+                c.stop()
+            for h, c, seen in running:
+                if c.is_alive():
+                    c.join(DEFAULT_STOP_TIMEOUT)
+                c.off()
+                h._shared[h._status["is_on"]] = c.is_on
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+import collections
+import gc
+import marshal
+import sys
+import threading
+import time
+
+DEFAULT_SAMPLE_INTERVAL = 0.005
+MAX_SECONDS = 60
+
+FORMATS = ("json", "collapsed", "pstats")
+
+
+class SamplingProfiler(object):
+    """Statistical profiler for every thread in the process
+
+    Every *interval* seconds the calling thread takes a snapshot of the stack of every
+    other thread (sys._current_frames()) and counts it.  Nothing is hooked into the
+    interpreter, so the controllers pay nothing unless a profile is running, and only
+    the cost of the snapshots while one is.
+
+    Parameters
+    ----------
+    interval : float
+        The time, in seconds, between samples.
+    gc_pauses : bool
+        If True, also time the garbage collector.  Python 2 has no hook for this, so
+        while the profile runs automatic collection is switched off and the profiler
+        thread runs each collection itself as soon as the allocation counts pass the
+        usual thresholds, timing it.
+
+    """
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL, gc_pauses=False):
+        self.interval = float(interval)
+        if self.interval <= 0:
+            raise ValueError("interval must be positive")
+        self.gc_pauses = gc_pauses
+        # (thread name, ((filename, first line, function), ...) from the outermost frame)
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.duration = 0
+        self.pauses = []
+
+    def _sample(self, own, names):
+        for ident, frame in sys._current_frames().iteritems():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            stack.reverse()
+            if ident not in names:
+                names.update((t.ident, t.name) for t in threading.enumerate())
+            self.stacks[(names.get(ident, str(ident)), tuple(stack))] += 1
+        self.samples += 1
+
+    def _collect(self):
+        """run the collection the interpreter would have run by now, if any"""
+        counts, thresholds = gc.get_count(), gc.get_threshold()
+        if not thresholds[0] or counts[0] <= thresholds[0]:
+            return
+        generation = 0
+        for i in (1, 2):
+            if counts[i] > thresholds[i]:
+                generation = i
+        start = time.time()
+        gc.collect(generation)
+        self.pauses.append((generation, time.time() - start))
+
+    def run(self, seconds):
+        """profile for seconds, blocking the calling thread (which isn't sampled)"""
+        own = threading.current_thread().ident
+        names = {}
+        emulate_gc = self.gc_pauses and gc.isenabled()
+        if emulate_gc:
+            gc.disable()
+        start = time.time()
+        deadline = start + seconds
+        try:
+            now = start
+            while now < deadline:
+                self._sample(own, names)
+                if emulate_gc:
+                    self._collect()
+                time.sleep(max(0, self.interval - (time.time() - now)))
+                now = time.time()
+        finally:
+            if emulate_gc:
+                gc.enable()
+        self.duration = time.time() - start
+        return self
+
+    @staticmethod
+    def _frame(f):
+        return "{} ({}:{})".format(f[2], f[0], f[1])
+
+    def collapsed(self):
+        """the stacks in the collapsed format read by flamegraph.pl and speedscope"""
+        lines = [
+            "{};{} {}".format(thread, ";".join(self._frame(f) for f in stack), count)
+            for (thread, stack), count in self.stacks.iteritems()
+        ]
+        return "\n".join(sorted(lines)) + "\n"
+
+    def gc_report(self):
+        pauses = [p for g, p in self.pauses]
+        return {
+            "collections": [sum(1 for g, p in self.pauses if g == i) for i in range(3)],
+            "total": sum(pauses),
+            "max": max(pauses) if pauses else 0,
+            "pauses": pauses,
+        }
+
+    def report(self):
+        r = {
+            "duration": self.duration,
+            "interval": self.interval,
+            "samples": self.samples,
+            "stacks": dict(
+                ("{};{}".format(thread, ";".join(self._frame(f) for f in stack)), count)
+                for (thread, stack), count in self.stacks.iteritems()
+            ),
+        }
+        if self.gc_pauses:
+            r["gc"] = self.gc_report()
+        return r
+
+    def pstats(self):
+        """the samples as a marshalled stats dict, as loaded by pstats.Stats
+
+        Times are estimated as samples * interval.  Recursive calls are only counted
+        once per sample.
+
+        """
+        own = collections.Counter()
+        total = collections.Counter()
+        callers = collections.defaultdict(collections.Counter)
+        for (thread, stack), count in self.stacks.iteritems():
+            own[stack[-1]] += count
+            for f in set(stack):
+                total[f] += count
+            for caller, f in set(zip(stack, stack[1:])):
+                callers[f][caller] += count
+        stats = {}
+        for f, count in total.iteritems():
+            stats[f] = (
+                count, count, own[f] * self.interval, count * self.interval,
+                dict(
+                    (c, (n, n, 0.0, n * self.interval))
+                    for c, n in callers[f].iteritems()
+                ),
+            )
+        return marshal.dumps(stats)
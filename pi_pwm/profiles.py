@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+import bisect
+
+from array import array
+
+MAX_SEGMENTS = 10000
+# unrolled steps and repeat passes, which bounds compiling even when they add no segments
+MAX_STEPS = 10 * MAX_SEGMENTS
+
+
+class Profile(object):
+    """A duty profile compiled into a time-indexed table of linear segments
+
+    Parameters
+    ----------
+    spec : dict
+        The profile definition::
+
+            {
+                "start": 0.0,
+                "steps": [
+                    {"duty": 0.5, "hold": 600},
+                    {"ramp": 1.0, "duration": 300},
+                    {"repeat": 3, "steps": [
+                        {"duty": 0.2, "hold": 60},
+                        {"duty": 0.8, "hold": 60}
+                    ]},
+                    {"hold": 120}
+                ]
+            }
+
+        *start* is the duty the profile starts from (default 0).  Each step is one of:
+
+        - ``duty`` (optionally with ``hold``): jump to duty and hold it for hold seconds
+        - ``hold``: hold the current duty for hold seconds
+        - ``ramp`` with ``duration``: change linearly to ramp over duration seconds
+        - ``repeat`` with ``steps``: run steps repeat times
+
+    Raises
+    ------
+    ValueError
+        If spec is not a valid profile.
+
+    Notes
+    -----
+    Repeats are unrolled when the profile is compiled, so evaluation is a lookup in a
+    flat table of segments.  at() doesn't change the profile, so it can be called from
+    any thread; a caller evaluating it at steadily increasing times can pass the last
+    segment back in as a hint, which makes each lookup O(1) amortized.
+
+    """
+    def __init__(self, spec):
+        if not isinstance(spec, dict) or not isinstance(spec.get("steps"), list):
+            raise ValueError("profile must be a dict with a 'steps' list")
+        self.spec = spec
+        self.start_duty = self._duty(spec.get("start", 0))
+        # segment i runs from starts[i] to starts[i+1] (or duration) going from
+        # duty_from[i] to duty_to[i]
+        self.starts = array("d")
+        self.duty_from = array("d")
+        self.duty_to = array("d")
+        self.duration = 0.0
+        self._steps = 0
+        end = self._compile(spec["steps"], self.start_duty)
+        if not len(self.starts):
+            # nothing but instantaneous steps; a zero-length profile ending at end
+            self._append(0, end, end)
+        self.end_duty = end
+
+    @staticmethod
+    def _duty(value):
+        value = float(value)
+        if value < 0 or value > 1:
+            raise ValueError("profile duty must be between 0 and 1, inclusive")
+        return value
+
+    @staticmethod
+    def _seconds(step, key):
+        value = float(step[key])
+        if value < 0:
+            raise ValueError("profile {} must not be negative".format(key))
+        return value
+
+    def _append(self, duration, duty_from, duty_to):
+        if len(self.starts) >= MAX_SEGMENTS:
+            raise ValueError("profile has more than {} segments".format(MAX_SEGMENTS))
+        self.starts.append(self.duration)
+        self.duty_from.append(duty_from)
+        self.duty_to.append(duty_to)
+        self.duration += duration
+
+    def _count(self):
+        self._steps += 1
+        if self._steps > MAX_STEPS:
+            raise ValueError("profile has more than {} steps once repeats are unrolled".format(MAX_STEPS))
+
+    def _compile(self, steps, duty):
+        for step in steps:
+            self._count()
+            if not isinstance(step, dict):
+                raise ValueError("profile steps must be dicts")
+            if "repeat" in step:
+                if not isinstance(step.get("steps"), list):
+                    raise ValueError("profile repeat must have a 'steps' list")
+                repeat = int(step["repeat"])
+                if repeat < 0 or repeat > MAX_SEGMENTS:
+                    raise ValueError("profile repeat must be between 0 and {}".format(MAX_SEGMENTS))
+                for i in xrange(repeat):
+                    self._count()
+                    duty = self._compile(step["steps"], duty)
+            elif "ramp" in step:
+                if "duration" not in step:
+                    raise ValueError("profile ramp must have a duration")
+                target = self._duty(step["ramp"])
+                duration = self._seconds(step, "duration")
+                if duration:
+                    self._append(duration, duty, target)
+                duty = target
+            elif "duty" in step or "hold" in step:
+                if "duty" in step:
+                    duty = self._duty(step["duty"])
+                hold = self._seconds(step, "hold") if "hold" in step else 0
+                if hold:
+                    self._append(hold, duty, duty)
+            else:
+                raise ValueError(
+                    "unrecognized profile step {}".format(sorted(step))
+                )
+        return duty
+
+    @property
+    def segments(self):
+        return len(self.starts)
+
+    def at(self, elapsed, hint=None):
+        """return (duty, segment index) at elapsed seconds, or (end duty, None) once finished
+
+        *hint* is a segment index to search forward from, normally the one returned by
+        the previous call; without it (or if time went backwards) the table is bisected.
+
+        """
+        if elapsed >= self.duration:
+            return self.end_duty, None
+        starts = self.starts
+        last = len(starts) - 1
+        i = hint
+        if i is None or i > last or elapsed < starts[i]:
+            i = max(0, bisect.bisect_right(starts, elapsed) - 1)
+        while i < last and elapsed >= starts[i + 1]:
+            i += 1
+        end = starts[i + 1] if i < last else self.duration
+        length = end - starts[i]
+        d0, d1 = self.duty_from[i], self.duty_to[i]
+        if not length or d0 == d1:
+            return d1, i
+        return d0 + (d1 - d0) * (elapsed - starts[i]) / length, i
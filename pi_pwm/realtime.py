@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import threading
+
+POLICIES = {"other": 0, "fifo": 1, "rr": 2}
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+M_TRIM_THRESHOLD = -1
+M_MMAP_MAX = -4
+CPU_SETSIZE = 1024
+
+# bits of the mask describing the settings in effect for a thread
+POLICY = 1
+CPUS = 2
+MLOCKALL = 4
+PREFAULT = 8
+
+log = logging.getLogger(__name__)
+
+_libc = None
+
+
+def _function(name):
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    try:
+        return getattr(_libc, name)
+    except AttributeError:
+        raise OSError("{} is not available on this platform".format(name))
+
+
+def _call(name, *args):
+    """call a libc function, raising OSError if it fails or isn't available"""
+    if _function(name)(*args) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+def set_scheduler(policy, priority):
+    """set the scheduling policy and priority of the calling thread"""
+    _call("sched_setscheduler", 0, POLICIES[policy], ctypes.byref(ctypes.c_int(priority)))
+
+
+def set_affinity(cpus):
+    """restrict the calling thread to cpus"""
+    bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    mask = (ctypes.c_ulong * (CPU_SETSIZE // bits))()
+    for cpu in cpus:
+        mask[cpu // bits] |= 1 << (cpu % bits)
+    _call("sched_setaffinity", 0, ctypes.sizeof(mask), mask)
+
+
+def lock_memory():
+    """lock the process's current and future pages into RAM"""
+    _call("mlockall", MCL_CURRENT | MCL_FUTURE)
+
+
+def prefault(size):
+    """grow the heap by size bytes, touching every page, and keep it
+
+    malloc is told not to hand freed memory back to the kernel (or to serve large
+    requests from separate mappings), so later allocations reuse pages that are
+    already resident (and locked, after lock_memory()) instead of faulting in new ones.
+
+    """
+    # mallopt returns 1 on success, so it isn't checked like the others
+    mallopt = _function("mallopt")
+    if not mallopt(M_MMAP_MAX, 0) or not mallopt(M_TRIM_THRESHOLD, -1):
+        raise OSError("mallopt failed")
+    # zero-filled, so every page is written
+    ctypes.create_string_buffer(size)
+
+
+class Realtime(object):
+    """Real-time settings for the controller threads and the process running them
+
+    Every setting is optional and fails gracefully: if the process lacks the privilege
+    (CAP_SYS_NICE for the policy, CAP_IPC_LOCK or a large enough RLIMIT_MEMLOCK for
+    mlockall) a warning is logged and the controllers run without it.
+
+    Parameters
+    ----------
+    policy : string or None
+        "fifo" or "rr" for SCHED_FIFO or SCHED_RR, or "other" for the normal policy.
+    priority : int
+        The real-time priority (1 to 99) for fifo and rr.
+    cpus : list of int or None
+        The CPUs the controller threads are pinned to, e.g. a core reserved with
+        isolcpus.
+    mlockall : bool
+        If True, lock the process's memory so page faults can't stall an edge.
+    prefault : int
+        The number of bytes of heap to fault in (and keep) up front.  See prefault().
+    stack_size : int or None
+        The stack size, in bytes, for threads started afterwards.  With mlockall every
+        thread stack is locked in full, so the 8MB default adds up on a Pi.
+
+    """
+    ITERABLES = ["policy", "priority", "cpus", "mlockall", "prefault", "stack_size"]
+
+    def __init__(self, policy=None, priority=1, cpus=None, mlockall=False, prefault=0, stack_size=None):
+        if policy is not None and policy not in POLICIES:
+            raise ValueError(
+                "policy must be one of {}".format(", ".join(sorted(POLICIES)))
+            )
+        self.policy = policy
+        self.priority = int(priority) if policy in ("fifo", "rr") else 0
+        if policy in ("fifo", "rr") and not 1 <= self.priority <= 99:
+            raise ValueError("priority must be between 1 and 99, inclusive")
+        if cpus is not None:
+            cpus = [int(c) for c in cpus]
+            if not cpus or min(cpus) < 0 or max(cpus) >= CPU_SETSIZE:
+                raise ValueError("cpus must be a list of cpu numbers")
+        self.cpus = cpus
+        self.mlockall = bool(mlockall)
+        self.prefault = int(prefault)
+        self.stack_size = stack_size
+        self.process_mask = 0
+
+    def __iter__(self):
+        for k in self.ITERABLES:
+            yield (k, getattr(self, k))
+
+    def _try(self, what, function, *args):
+        try:
+            function(*args)
+            return True
+        except (OSError, ValueError) as e:
+            log.warn("|realtime|unable to set %s: %s", what, e)
+            return False
+
+    def apply_process(self):
+        """apply the process-wide settings; call before starting the controller threads"""
+        mask = 0
+        if self.stack_size:
+            self._try("stack_size", threading.stack_size, self.stack_size)
+        if self.mlockall and self._try("mlockall", lock_memory):
+            mask |= MLOCKALL
+        if self.prefault and self._try("prefault", prefault, self.prefault):
+            mask |= PREFAULT
+        self.process_mask = mask
+        return mask
+
+    def apply_thread(self):
+        """apply the per-thread settings to the calling thread and return the mask in effect"""
+        mask = self.process_mask
+        if self.cpus is not None and self._try("cpus", set_affinity, self.cpus):
+            mask |= CPUS
+        if self.policy is not None and self._try("policy", set_scheduler, self.policy, self.priority):
+            mask |= POLICY
+        return mask
+
+    def describe(self, mask):
+        """the settings in effect according to mask, as a dict"""
+        r = {}
+        if mask & POLICY:
+            r["policy"], r["priority"] = self.policy, self.priority
+        if mask & CPUS:
+            r["cpus"] = self.cpus
+        if mask & MLOCKALL:
+            r["mlockall"] = True
+        if mask & PREFAULT:
+            r["prefault"] = self.prefault
+        return r
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+import logging
+import os
+import threading
+import time
+import Queue
+
+from pi_pwm.controllers import ConfigurationError
+
+DEFAULT_W1_ROOT = "/sys/bus/w1/devices"
+DEFAULT_SENSOR_INTERVAL = 5
+DEFAULT_SENSOR_WORKERS = 4
+
+log = logging.getLogger(__name__)
+
+
+class SensorError(IOError):
+    pass
+
+
+def read_w1_slave(path):
+    """Read a DS18B20-style w1_slave file and return the temperature in degrees C
+
+    Raises
+    ------
+    IOError
+        If the file cannot be read.
+    SensorError
+        If the CRC check failed or the file is not in the expected format.
+
+    """
+    with open(path) as f:
+        lines = f.read().splitlines()
+    if len(lines) < 2 or not lines[0].rstrip().endswith("YES"):
+        raise SensorError("CRC check failed reading {}".format(path))
+    pos = lines[1].find("t=")
+    if pos < 0:
+        raise SensorError("no temperature found in {}".format(path))
+    return int(lines[1][pos + 2:]) / 1000.0
+
+
+class W1Sensor(object):
+    """A 1-Wire temperature probe and its most recent reading
+
+    Parameters
+    ----------
+    name : string
+        The sensor name.
+    id : string
+        The 1-Wire device id (the directory name under the w1 devices directory).
+    w1_root : str
+        The w1 devices directory.  Defaults to /sys/bus/w1/devices.
+    controller : BasePWMController or None
+        If given, every successful reading is written to the controller's measurement
+        (see PIDPWMController).
+
+    """
+    ITERABLES = ["id", "value", "timestamp", "age", "error", "controller"]
+
+    def __init__(self, name, id, w1_root=DEFAULT_W1_ROOT, controller=None):
+        self.name = name
+        self.id = id
+        self.path = os.path.join(w1_root, id, "w1_slave")
+        self.controller = controller
+        self.lock = threading.Lock()
+        self._value = None
+        self._timestamp = None
+        self.error = None
+
+    def __iter__(self):
+        for k in self.ITERABLES:
+            v = getattr(self, k)
+            if k == "controller" and v is not None:
+                v = v.name
+            yield (k, v)
+
+    @property
+    def reading(self):
+        """the latest (value, timestamp), or (None, None) if there hasn't been one"""
+        with self.lock:
+            return self._value, self._timestamp
+
+    @property
+    def value(self):
+        return self.reading[0]
+
+    @property
+    def timestamp(self):
+        return self.reading[1]
+
+    @property
+    def age(self):
+        timestamp = self.timestamp
+        if timestamp is None:
+            return None
+        return time.time() - timestamp
+
+    def read(self):
+        """read the probe (blocking for the conversion) and update the cached value"""
+        try:
+            value = read_w1_slave(self.path)
+        except (IOError, OSError) as e:
+            if str(e) != self.error:
+                log.warn("|%s|unable to read sensor: %s", self.name, e)
+            self.error = str(e)
+            return None
+        with self.lock:
+            self._value, self._timestamp = value, time.time()
+        self.error = None
+        if self.controller is not None:
+            self.controller.measurement = value
+        return value
+
+
+class SensorPool(threading.Thread):
+    """Reads a set of sensors concurrently every *interval* seconds
+
+    Each round hands every sensor to a fixed pool of worker threads, so a dozen probes
+    that each block for most of a second are read in roughly the time of
+    len(sensors) / workers conversions rather than all of them back to back.
+
+    Parameters
+    ----------
+    sensors : dict
+        The sensors to read, keyed by name.
+    interval : float or int
+        The time, in seconds, between the start of each round of readings.
+    workers : int
+        The maximum number of sensors read at the same time.
+
+    """
+    def __init__(self, sensors, interval=DEFAULT_SENSOR_INTERVAL, workers=DEFAULT_SENSOR_WORKERS, *args, **kwargs):
+        super(SensorPool, self).__init__(*args, **kwargs)
+        self.sensors = sensors
+        self.interval = interval
+        self.workers = max(1, min(int(workers), len(sensors) or 1))
+        self.daemon = True
+        self.shutdown = False
+        self._queue = Queue.Queue()
+        self._threads = []
+
+    def __getitem__(self, name):
+        return self.sensors[name]
+
+    def __iter__(self):
+        for name in sorted(self.sensors):
+            yield (name, dict(self.sensors[name]))
+
+    def _worker(self):
+        while True:
+            sensor = self._queue.get()
+            try:
+                if sensor is None:
+                    return
+                sensor.read()
+            except Exception:
+                log.exception("|%s|unexpected error reading sensor", sensor.name)
+            finally:
+                self._queue.task_done()
+
+    def _start_workers(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name="{}-{}".format(self.name, i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def read_all(self):
+        """read every sensor once, concurrently, and wait for the round to finish"""
+        self._start_workers()
+        for name in sorted(self.sensors):
+            self._queue.put(self.sensors[name])
+        self._queue.join()
+
+    def run(self):
+        log.info("|sensors|starting %d sensors with %d workers", len(self.sensors), self.workers)
+        self.shutdown = False
+        try:
+            while not self.shutdown:
+                start = time.time()
+                self.read_all()
+                time.sleep(max(0, start + self.interval - time.time()))
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.shutdown = True
+        for t in self._threads:
+            self._queue.put(None)
+        self._threads = []
+
+
+def from_config(config, controllers=None, autostart=True):
+    """Initialize the sensors defined in the ``sensors`` section of a configuration
+
+    The section looks like::
+
+        sensors:
+            interval: 5
+            workers: 4
+            w1_root: /sys/bus/w1/devices
+            probes:
+                mash_temp:
+                    id: 28-000005e2fdc3
+                    controller: mash
+
+    where *controller* optionally names a controller whose measurement is updated
+    with every reading.
+
+    Parameters
+    ----------
+    config : dict
+        The configuration, as returned by pi_pwm.controllers.load_config().
+    controllers : dict or None
+        The controllers returned by pi_pwm.controllers.from_config().
+    autostart : bool
+        If True (the default), the sensor pool will be started automatically.
+
+    Returns
+    -------
+    SensorPool or None
+        The sensor pool, or None if the configuration has no sensors section.
+
+    Raises
+    ------
+    ConfigurationError
+        If a content problem is encountered in the sensors section.
+
+    """
+    scfg = config.get('sensors')
+    if scfg is None:
+        return None
+    controllers = controllers or {}
+    if not isinstance(scfg, dict) or not isinstance(scfg.get('probes'), dict):
+        raise ConfigurationError("sensors must be a dict with a 'probes' dict")
+    w1_root = scfg.get('w1_root', DEFAULT_W1_ROOT)
+    sensors = {}
+    for sname, pcfg in sorted(scfg['probes'].iteritems()):
+        if not isinstance(pcfg, dict) or 'id' not in pcfg:
+            raise ConfigurationError(
+                "sensor '{}' must be a dict with an 'id'".format(sname)
+            )
+        controller = None
+        if pcfg.get('controller') is not None:
+            controller = controllers.get(pcfg['controller'])
+            if controller is None:
+                raise ConfigurationError(
+                    "sensor '{}' controller '{}' not found"
+                    .format(sname, pcfg['controller'])
+                )
+            if not hasattr(controller, 'measurement'):
+                raise ConfigurationError(
+                    "sensor '{}' controller '{}' does not take measurements"
+                    .format(sname, pcfg['controller'])
+                )
+        sensors[sname] = W1Sensor(sname, pcfg['id'], w1_root, controller)
+    pool = SensorPool(
+        sensors,
+        interval=scfg.get('interval', DEFAULT_SENSOR_INTERVAL),
+        workers=scfg.get('workers', DEFAULT_SENSOR_WORKERS),
+    )
+    if autostart:
+        pool.start()
+    return pool
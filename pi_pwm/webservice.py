@@ -3,20 +3,32 @@
 import logging
 import atexit
 import functools
-import json
 import os
+import threading
+import yaml
 
+import pi_pwm.audit
 import pi_pwm.controllers
+import pi_pwm.encoding
+import pi_pwm.feedback
+import pi_pwm.mqtt
+import pi_pwm.profiler
+import pi_pwm.sensors
 
-from flask import Flask, request
+from flask import Flask, g, request
 from werkzeug.wrappers import Response
 
 log = logging.getLogger(__name__)
 
 controllers = {}
+groups = {}
+sensors = None
+audit_log = None
+mqtt_bridge = None
+feedback = None
 initialized = False
 
-def create_app(config_file):
+def create_app(config_file, realtime=None):
     app = Flask("pi_pwm")
     app.config['DEBUG'] = True
 
@@ -24,11 +36,46 @@ def create_app(config_file):
     app.logger.setLevel(logging.INFO)
 
     def start():
-        global controllers
-        controllers = pi_pwm.controllers.from_config(config_file)
+        global controllers, groups, sensors, audit_log, mqtt_bridge, feedback
+        config = pi_pwm.controllers.load_config(config_file)
+        if realtime:
+            # settings from the command line override the file's
+            overrides = yaml.safe_load(realtime)
+            if not isinstance(overrides, dict):
+                raise pi_pwm.controllers.ConfigurationError(
+                    "realtime settings must be a dict, not '{}'".format(realtime)
+                )
+            config['realtime'] = dict(config.get('realtime') or {}, **overrides)
+        controllers = pi_pwm.controllers.from_config(config)
+        for section in ('sensors', 'groups', 'audit'):
+            if config.get(section) is not None and section in controllers:
+                # these are listed under their section name in the index
+                raise pi_pwm.controllers.ConfigurationError(
+                    "controller name '{}' is reserved when {} are configured"
+                    .format(section, section)
+                )
+        groups = pi_pwm.controllers.groups_from_config(config, controllers)
+        sensors = pi_pwm.sensors.from_config(config, controllers)
+        audit_log = None
+        for c in controllers.itervalues():
+            audit_log = getattr(c, 'audit_log', None) or audit_log
+        mqtt_bridge = pi_pwm.mqtt.from_config(config, dict(groups, **controllers))
+        feedback = pi_pwm.feedback.from_config(config, controllers)
+
+    def lookup(name):
+        """find a controller or, failing that, a group"""
+        return controllers.get(name) or groups.get(name)
 
     def stop(): # pragma: no cover
         global controllers
+        if sensors is not None:
+            sensors.stop()
+        if audit_log is not None:
+            audit_log.stop()
+        if mqtt_bridge is not None:
+            mqtt_bridge.stop()
+        if feedback is not None:
+            feedback.stop()
         for c, o in controllers.iteritems():
             try:
                 o.stop()
@@ -38,55 +85,147 @@ def create_app(config_file):
     def json_io(wrapped_function):
         @functools.wraps(wrapped_function)
         def decorated_function(*args, **kwargs):
-            if request.method != "GET" and request.content_type != "application/json":
-                return Response(
-                    json.dumps(
-                        {"error": "Content-type must be application/json, not {}".format(request.content_type)},
-                        indent=4
-                    ),
-                    status=405,
-                    mimetype="application/json"
-                )
+            g.body = None
+            if request.method != "GET":
+                try:
+                    g.body = pi_pwm.encoding.decode(request.content_type, request.get_data())
+                except KeyError:
+                    return pi_pwm.encoding.response(
+                        {"error": "Content-type must be {}, not {}".format(
+                            " or ".join(pi_pwm.encoding.FORMATS), request.content_type or ""
+                        )},
+                        request,
+                        405
+                    )
+                except ValueError as exc:
+                    return pi_pwm.encoding.response({"error": str(exc)}, request, 400)
             r = wrapped_function(*args, **kwargs)
+            if isinstance(r, Response):
+                return r
             if isinstance(r, dict):
-                return Response(
-                    json.dumps(r, indent=4),
-                    mimetype="application/json"
-                )
+                return pi_pwm.encoding.response(r, request)
             if isinstance(r, tuple):
                 if len(r) == 1 and isinstance(r[0], dict):
-                    return Response(
-                        json.dumps(r[0], indent=4),
-                        mimetype="application/json"
-                    )
+                    return pi_pwm.encoding.response(r[0], request)
                 if len(r) == 2 and isinstance(r[0], dict):
-                    return Response(
-                        json.dumps(r[0], indent=4),
-                        status=r[1],
-                        mimetype="application/json"
-                    )
+                    return pi_pwm.encoding.response(r[0], request, r[1])
             return Response(r, mimetype="application/json")
         return decorated_function
 
-    @app.route("/")
+    def update(c, values):
+        """set values on c, all of them or (if one is invalid) none"""
+        old_values = {}
+        new_values = {}
+        with pi_pwm.audit.source("api"):
+            for k in c.SETTABLE:
+                if k in values:
+                    old, new = getattr(c, k), values[k]
+                    old_values[k] = old
+                    new_values[k] = new
+                    try:
+                        setattr(c, k, new)
+                    except Exception as exc:
+                        for k, v in old_values.iteritems():
+                            setattr(c, k, v)
+                        return ({"error": exc.message}, 400)
+        return ({"old": old_values, "new": new_values}, 200)
+
+    @app.route("/", methods=["GET", "POST"])
     @json_io
     def index():
         global controllers
-        return {c: dict(controllers[c]) for c in controllers}
+        if request.method == "POST":
+            return bulk_update()
+        r = {c: dict(controllers[c]) for c in controllers}
+        if groups:
+            r["groups"] = {g: dict(groups[g]) for g in groups}
+        if sensors is not None:
+            r["sensors"] = dict(sensors)
+        return r
+
+    def bulk_update():
+        """update several controllers at once: {controller: {parameter: value, ...}, ...}
+
+        Each controller is updated as by POST /<controller>/, and pinged if its values
+        include "ping": true.  The result for each carries its own status.
+
+        """
+        if not isinstance(g.body, dict):
+            return ({"error": "bulk updates must be a dict of controller updates"}, 400)
+        results = {}
+        for name, values in g.body.iteritems():
+            c = lookup(name)
+            if not c:
+                r, status = {"error": "controller {} not found".format(name)}, 404
+            elif not isinstance(values, dict):
+                r, status = {"error": "update for {} must be a dict".format(name)}, 400
+            else:
+                r, status = update(c, values)
+                if status == 200 and values.get("ping"):
+                    with pi_pwm.audit.source("api"):
+                        r["dead_timer"] = c.ping()
+            r["status"] = status
+            results[name] = r
+        return results
 
     @app.route("/echo/", methods=["POST"], strict_slashes=False)
     @json_io
     def echo():
         return {
             "content_type": request.content_type,
-            "content": request.json
+            "content": g.body
         }
 
+    @app.route("/audit", methods=["GET"])
+    @json_io
+    def audit():
+        if audit_log is None:
+            return ({"error": "audit log not configured"}, 404)
+        try:
+            since = request.args.get("since", type=float)
+            limit = int(request.args.get("limit", 1000))
+        except ValueError as exc:
+            return ({"error": exc.message}, 400)
+        # include whatever is still waiting to be written
+        audit_log.flush()
+        return {"records": pi_pwm.audit.read(audit_log.path, since, limit)}
+
+    # one profile at a time; they would only sample each other
+    profiling = threading.Lock()
+
+    @app.route("/admin/profile", methods=["GET"])
+    @json_io
+    def profile():
+        fmt = request.args.get("format", "json")
+        try:
+            seconds = float(request.args.get("seconds", 5))
+            profiler = pi_pwm.profiler.SamplingProfiler(
+                float(request.args.get("interval", pi_pwm.profiler.DEFAULT_SAMPLE_INTERVAL)),
+                request.args.get("gc", "0") not in ("0", "false", ""),
+            )
+        except ValueError as exc:
+            return ({"error": exc.message}, 400)
+        if not 0 < seconds <= pi_pwm.profiler.MAX_SECONDS:
+            return ({"error": "seconds must be between 0 and {}".format(pi_pwm.profiler.MAX_SECONDS)}, 400)
+        if fmt not in pi_pwm.profiler.FORMATS:
+            return ({"error": "format must be one of {}".format(", ".join(pi_pwm.profiler.FORMATS))}, 400)
+        if not profiling.acquire(False):
+            return ({"error": "a profile is already running"}, 409)
+        try:
+            profiler.run(seconds)
+        finally:
+            profiling.release()
+        if fmt == "collapsed":
+            return Response(profiler.collapsed(), mimetype="text/plain")
+        if fmt == "pstats":
+            return Response(profiler.pstats(), mimetype="application/octet-stream")
+        return profiler.report()
+
     @app.route("/<string:controller>/ping", methods=["GET"])
     @json_io
     def ping(controller):
         global controllers
-        c = controllers.get(controller)
+        c = lookup(controller)
         if not c:
             return (
                 {
@@ -94,36 +233,23 @@ def create_app(config_file):
                 },
                 404
             )
-        return {
-            "old_dead_timer": c.dead_timer,
-            "dead_timer": c.ping()
-        }
+        with pi_pwm.audit.source("api"):
+            return {
+                "old_dead_timer": c.dead_timer,
+                "dead_timer": c.ping()
+            }
 
     @app.route("/<string:controller>/", methods=["GET", "POST"], strict_slashes=False)
     @json_io
     def controller(controller):
         global controllers
-        c = controllers.get(controller)
+        c = lookup(controller)
         if not c:
             return ({"error": "controller {} not found".format(controller)}, 404)
         if request.method == "GET":
             return dict(c)
         elif request.method == "POST":
-            old_values = {}
-            new_values = {}
-            for k in ('interval', 'duty'):
-                if k in request.json:
-                    old, new = getattr(c, k), request.json[k]
-                    old_values[k] = old
-                    new_values[k] = new
-                    try:
-                        setattr(c, k, new)
-                    except Exception as exc:
-                        for k, v in old_values.iteritems():
-                            setattr(c, k, v)
-                        return ({"error": exc.message}, 400)
-
-            return {"old": old_values, "new": new_values}
+            return update(c, g.body)
 
     start()
     atexit.register(stop)
@@ -132,7 +258,7 @@ def create_app(config_file):
 def init_app(config=None):
     if not config:
         config = os.environ.get("PWM_CONFIG", "config.yaml")
-    app = create_app(config)
+    app = create_app(config, os.environ.get("PWM_REALTIME"))
     app.debug = True
     return app
 
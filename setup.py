@@ -38,12 +38,20 @@ setup(
         'pyyaml>=3.10',
         'flask>=0.8'
     ],
+    extras_require = {
+        'mqtt': ['paho-mqtt>=1.1'],
+        'msgpack': ['msgpack>=0.5.2'],
+        'cbor': ['cbor2'],
+    },
     packages = ['pi_pwm'],
     tests_require = [
         'pytest>=2.5.2',
         'pytest-cov>=1.6',
         'nose>=1.1.2',
-        'mock>=1.0.1'
+        'mock>=1.0.1',
+        # so the binary response formats are tested too
+        'msgpack>=0.5.2',
+        'cbor2',
     ],
     cmdclass = {
         'test': PyTest,
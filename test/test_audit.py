@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+import pytest
+import mock
+import tempfile
+import shutil
+import os
+import sys
+import threading
+import time
+import itertools
+
+from nose.tools import assert_raises
+from pi_pwm import audit, controllers
+from pi_pwm.audit import AuditLog
+from pi_pwm.controllers import ConfigurationError
+
+
+@pytest.fixture
+def log_path(request):
+    d = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(d))
+    return os.path.join(d, "audit.log")
+
+
+def test_record_and_read(log_path):
+    log = AuditLog(log_path)
+    c = controllers.BasePWMController(name="boil")
+    c.audit_log = log
+    c.duty = .5
+    c.duty = .5
+    c.interval = 5
+    with audit.source("api"):
+        c.phase = .25
+    c.max_edge_rate = 10
+    # nothing is written until the log is flushed
+    assert not os.path.exists(log_path)
+    log.flush()
+    assert os.path.getsize(log_path) == 4 * audit.RECORD.size
+    records = audit.read(log_path)
+    assert [(r["event"], r["old"], r["new"], r["source"]) for r in records] == [
+        ("duty", 0, .5, "local"),
+        ("interval", 1, 5, "local"),
+        ("phase", None, .25, "api"),
+        ("max_edge_rate", None, 10, "local"),
+    ]
+    assert all(r["controller"] == "boil" for r in records)
+    assert audit.read(log_path, limit=2) == records[:2]
+
+
+def test_read_since(log_path):
+    log = AuditLog(log_path)
+    with mock.patch("pi_pwm.audit.time.time", mock.Mock()) as time_time:
+        time_time.side_effect = itertools.count(1000)
+        for i in range(100):
+            log.record("duty", "boil", None, i / 100.0)
+    log.flush()
+    records = audit.read(log_path, since=1090.5)
+    assert [r["time"] for r in records] == range(1091, 1100)
+    assert audit.read(log_path, since=2000) == []
+    assert len(audit.read(log_path, since=0)) == 100
+    assert audit.read(log_path + ".missing") == []
+
+
+def test_record_order(log_path):
+    """records from many threads are queued in time order, as read() relies on"""
+    log = AuditLog(log_path)
+    def record():
+        for i in range(2000):
+            log.record("duty", "boil", None, i / 2000.0)
+    interval = sys.getcheckinterval()
+    # switch threads as often as possible
+    sys.setcheckinterval(1)
+    try:
+        threads = [threading.Thread(target=record) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        sys.setcheckinterval(interval)
+    log.flush()
+    times = [r["time"] for r in audit.read(log_path, limit=None)]
+    assert len(times) == 8000
+    assert times == sorted(times)
+
+
+def test_rotation(log_path):
+    log = AuditLog(log_path, max_bytes=10 * audit.RECORD.size, backups=2)
+    for i in range(35):
+        log.record("duty", "boil", None, i)
+    log.flush()
+    assert os.path.getsize(log_path) == 5 * audit.RECORD.size
+    assert os.path.getsize(log_path + ".1") == 10 * audit.RECORD.size
+    assert os.path.getsize(log_path + ".2") == 10 * audit.RECORD.size
+    assert not os.path.exists(log_path + ".3")
+    # the oldest 10 rotated away; the rest come back in order across the files
+    assert [r["new"] for r in audit.read(log_path)] == range(10, 35)
+
+
+def test_sources(log_path):
+    log = AuditLog(log_path)
+    bank = controllers.PIDBank(interval=1)
+    c = controllers.PIDPWMController(name="mash", setpoint=60, kp=.1, pid_bank=bank)
+    c.audit_log = log
+    c.kp = .2
+    c.measurement = 50
+    bank.step(1)
+    c.profile = {"steps": [{"duty": .3, "hold": 600}]}
+    log.flush()
+    assert [(r["event"], r["source"]) for r in audit.read(log_path)] == [
+        ("kp", "local"),
+        ("duty", "pid"),
+        ("profile", "local"),
+        ("duty", "profile"),
+    ]
+    assert audit.current_source() == "local"
+
+
+def test_group_and_deadman(log_path):
+    log = AuditLog(log_path)
+    boil = controllers.BasePWMController(name="boil", dead_interval=10)
+    hlt = controllers.BasePWMController(name="hlt")
+    for c in boil, hlt:
+        c.audit_log = log
+    controllers.ControllerGroup("kettles", boil, [(hlt, "ratio", .5)])
+    with audit.source("api"):
+        boil.duty = .8
+    boil._dead_time = time.time() - 1
+    boil._body()
+    boil.ping()
+    log.flush()
+    assert [(r["controller"], r["event"], r["new"], r["source"]) for r in audit.read(log_path)] == [
+        ("boil", "duty", .8, "api"),
+        ("hlt", "duty", .4, "group"),
+        ("boil", "dead", None, "local"),
+        ("boil", "alive", None, "local"),
+    ]
+
+
+def test_run_and_stop(log_path):
+    log = AuditLog(log_path, flush_interval=.01)
+    with mock.patch("pi_pwm.audit.atexit.register", mock.Mock()):
+        log.start()
+    log.record("on", "boil")
+    log.stop()
+    log.join(1)
+    assert not log.is_alive()
+    assert [r["event"] for r in audit.read(log_path)] == ["on"]
+
+
+def test_from_config(log_path):
+    config = {
+        "controllers": {"boil": {"class": "BasePWMController"}},
+        "audit": {"path": log_path, "max_bytes": 4096},
+    }
+    cons = controllers.from_config(config, autostart=False)
+    cons["boil"].duty = .4
+    cons["boil"].audit_log.flush()
+    assert [(r["event"], r["source"]) for r in audit.read(log_path)] == [
+        ("reload", "config"), ("duty", "local"),
+    ]
+    with assert_raises(ConfigurationError):
+        controllers.from_config(dict(config, audit={"nopath": 1}), autostart=False)
+    with assert_raises(ConfigurationError):
+        controllers.from_config(dict(config, audit={"path": log_path, "bogus": 1}), autostart=False)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+import pytest
+import decimal
+import mock
+import StringIO
+import threading
+import time
+import yaml
+
+from nose.tools import assert_raises
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+import pi_pwm.webservice
+from pi_pwm.client import Client, ClientError, RemoteError
+
+TEST_CONFIG = {
+    'controllers': {
+        'boil': {'class': 'BasePWMController', 'args': {'dead_interval': 60}},
+        'hlt': {'class': 'BasePWMController', 'args': {'dead_interval': 60}},
+        'mash': {'class': 'BasePWMController'},
+    }
+}
+
+
+class KeepAliveHandler(WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+
+class Server(object):
+    """the webservice on localhost, counting the requests it serves"""
+
+    def __init__(self):
+        app = pi_pwm.webservice.create_app(StringIO.StringIO(yaml.dump(TEST_CONFIG)))
+        self.requests = []
+        def counting_app(environ, start_response):
+            self.requests.append((environ["REQUEST_METHOD"], environ["PATH_INFO"]))
+            return app(environ, start_response)
+        self.server = make_server("127.0.0.1", 0, counting_app, threaded=True, request_handler=KeepAliveHandler)
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self.server.shutdown()
+        for c in pi_pwm.webservice.controllers.values():
+            c.stop()
+
+
+@pytest.fixture(scope='module')
+def server(request):
+    server = Server()
+    request.addfinalizer(server.stop)
+    return server
+
+
+@pytest.fixture
+def client(request, server):
+    for c in pi_pwm.webservice.controllers.values():
+        c.duty = 0
+    del server.requests[:]
+    client = Client(server.url, timeout=2, batch_window=.05)
+    request.addfinalizer(client.close)
+    return client
+
+
+def test_controller(client, server):
+    boil = client['boil']
+    assert boil.duty == 0
+    boil.duty = .5
+    assert pi_pwm.webservice.controllers['boil'].duty == .5
+    assert dict(boil)['duty'] == .5
+    with assert_raises(RemoteError) as cm:
+        boil.duty = 2
+    assert cm.exception.status == 400
+    with assert_raises(AttributeError):
+        boil.nope
+    assert boil.update(duty=.25, interval=2) == {'old': {'duty': .5, 'interval': 1}, 'new': {'duty': .25, 'interval': 2}}
+    assert boil.ping() == 60
+    with assert_raises(RemoteError) as cm:
+        client['nope'].ping()
+    assert cm.exception.status == 404
+    assert sorted(client.index()) == ['boil', 'hlt', 'mash']
+    # one connection for all of it
+    assert client.pool.connections == 1
+    client['boil'].interval = 1
+
+
+def test_batching(client, server):
+    pending = [client.set_async(name, duty=.1) for name in ('boil', 'hlt', 'mash')]
+    pending.append(client.set_async('boil', duty=.2))
+    pending.append(client.ping_async('hlt'))
+    results = [p.result(5) for p in pending]
+    # the second boil update conflicts with the first, so it follows in a request of its own
+    assert server.requests == [('POST', '/'), ('POST', '/')]
+    assert client.batches == 2
+    assert results[0] == {'old': {'duty': 0}, 'new': {'duty': .1}}
+    assert results[3] == {'old': {'duty': .1}, 'new': {'duty': .2}}
+    # the ping shared hlt's request, but each caller only sees its own part
+    assert results[1] == {'old': {'duty': 0}, 'new': {'duty': .1}}
+    assert results[4] == {'old': {}, 'new': {}, 'dead_timer': 60}
+    assert pi_pwm.webservice.controllers['boil'].duty == .2
+    assert pi_pwm.webservice.controllers['mash'].duty == .1
+
+
+def test_batching_refused(client, server):
+    pending = [
+        client.set_async('boil', duty=.5),
+        client.set_async('boil', interval=-1),
+        client.set_async('boil', duty=.6),
+    ]
+    assert pending[0].result(5) == {'old': {'duty': 0}, 'new': {'duty': .5}}
+    with assert_raises(RemoteError) as cm:
+        pending[1].result(5)
+    assert cm.exception.status == 400
+    assert pending[2].result(5) == {'old': {'duty': .5}, 'new': {'duty': .6}}
+    assert pi_pwm.webservice.controllers['boil'].duty == .6
+    assert pi_pwm.webservice.controllers['boil'].interval == 1
+
+
+def test_batching_errors(client, server):
+    # json can't encode a Decimal; that batch fails, but the client carries on
+    with assert_raises(TypeError):
+        client.set('boil', duty=decimal.Decimal('.5'))
+    assert client.set('boil', duty=.5) == {'old': {'duty': 0}, 'new': {'duty': .5}}
+    with mock.patch.object(client, "request", mock.Mock(return_value=["not", "a", "dict"])):
+        with assert_raises(RemoteError):
+            client.set('boil', duty=.6)
+    # set() doesn't wait forever
+    with mock.patch.object(client, "_send", mock.Mock()):
+        client.result_timeout = .1
+        with assert_raises(ClientError):
+            client.set('boil', duty=.7)
+
+
+def test_batching_threads(client, server):
+    errors = []
+    def set_duty(name, duty):
+        try:
+            client[name].duty = duty
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=set_duty, args=(name, .3)) for name in ('boil', 'hlt', 'mash', 'nope')]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(errors) == 1 and errors[0].status == 404
+    assert [c.duty for n, c in sorted(pi_pwm.webservice.controllers.items())] == [.3, .3, .3]
+    assert client.batches == 1
+
+
+def test_callbacks(client):
+    done = []
+    p = client.set_async('boil', duty=.4)
+    p.add_done_callback(done.append)
+    assert not p.done()
+    p.result(5)
+    assert done == [p]
+    p.add_done_callback(done.append)
+    assert done == [p, p]
+
+
+def test_retries(server):
+    client = Client("http://127.0.0.1:1", timeout=1, retries=2, backoff=.01)
+    start = time.time()
+    with assert_raises(ClientError):
+        client.index()
+    assert time.time() - start >= .03
+    with assert_raises(ClientError):
+        client['boil'].duty = .5
+    client.close()
+    with assert_raises(ClientError):
+        client.set_async('boil', duty=.5)
+    with assert_raises(ValueError):
+        Client("kettle.local")
+
+
+def test_heartbeat(client, server):
+    boil = pi_pwm.webservice.controllers['boil']
+    boil._dead_time = time.time() + 1
+    heartbeat = client.heartbeat(['boil', 'hlt', 'nope'], interval=.1)
+    try:
+        deadline = time.time() + 5
+        while heartbeat.beats < 3 and time.time() < deadline:
+            time.sleep(.01)
+    finally:
+        heartbeat.stop()
+        heartbeat.join(5)
+    assert boil.dead_timer > 30
+    assert sorted(heartbeat.errors) == ['nope']
+    # every beat pings them all in one request
+    assert len(server.requests) == heartbeat.beats
@@ -6,6 +6,8 @@ import tempfile
 import StringIO
 import itertools
 import time
+import os
+import shutil
 
 import yaml
 
@@ -13,7 +15,7 @@ from textwrap import dedent
 from nose.tools import (
     assert_dict_equal, assert_dict_contains_subset, assert_raises
 )
-from pi_pwm import controllers
+from pi_pwm import audit, controllers
 from pi_pwm.controllers import ConfigurationError
 
 def is_exception(v):
@@ -37,6 +39,14 @@ def test_dict(test_controller):
         },
         dict(test_controller)
     )
+    assert dict(test_controller)['group'] is None
+
+
+def test_dict_property_error(test_controller):
+    """a bug in a reported property isn't hidden as None"""
+    with mock.patch.object(controllers.BasePWMController, "realtime_status", property(lambda self: self.nope)):
+        with assert_raises(AttributeError):
+            dict(test_controller)
 
 
 def test_on_off(test_controller):
@@ -285,6 +295,470 @@ def test_body_shutoff_on_deadman(test_controller):
             assert test_controller.dead_timer == 10
             assert test_controller.is_on
 
+@pytest.mark.parametrize(
+    ["duty", "phase", "expected"],
+    [
+        [.25, 0, [(False, 0), (True, 2.5), (False, 7.5)]],
+        [.25, .5, [(False, 5), (True, 2.5), (False, 2.5)]],
+        # on-window wraps around the end of the cycle
+        [.5, .75, [(True, 2.5), (False, 5), (True, 2.5)]],
+        [1, .5, [(True, 5), (False, 0), (True, 5)]],
+    ]
+)
+def test_calculate_segments(test_controller, duty, phase, expected):
+    test_controller.interval = 10
+    test_controller.duty = duty
+    assert test_controller._calculate_segments(phase) == expected
+
+
+def test_body_phased(test_controller):
+    """verify that phased cycles line up with the epoch and skip segments already past"""
+    test_controller.interval = 10
+    test_controller.duty = .25
+    test_controller.phase = .5
+    assert dict(test_controller)['phase'] == .5
+    calls = []
+    with mock.patch("pi_pwm.controllers.BasePWMController.on", mock.Mock()) as on:
+        with mock.patch("pi_pwm.controllers.BasePWMController.off", mock.Mock()) as off:
+            with mock.patch('pi_pwm.controllers.time.time', mock.Mock()) as time_time:
+                with mock.patch('pi_pwm.controllers.time.sleep', mock.Mock()) as time_sleep:
+                    on.side_effect = lambda: calls.append("on")
+                    off.side_effect = lambda: calls.append("off")
+                    time_sleep.side_effect = lambda d: calls.append(d)
+                    # joined the cycle at 1006: the leading off segment is partly done
+                    time_time.side_effect = itertools.repeat(1006.0)
+                    test_controller._body()
+    # sleeps run to absolute deadlines (1007.5, 1010) and time is frozen at 1006
+    assert calls == ["on", 1.5, "off", 4.0]
+
+
+def test_sigma_delta_min_times():
+    """the output is never held for less than min_on_time/min_off_time"""
+    c = controllers.BasePWMController(
+        modulation="sigma_delta", tick=.1, min_on_time=.5, min_off_time=.3
+    )
+    c.duty = .2
+    states = [c._sigma_delta_step() for i in xrange(1000)]
+    runs = [(k, len(list(g))) for k, g in itertools.groupby(states)][1:-1]
+    assert min(n for k, n in runs if k) >= 5
+    assert min(n for k, n in runs if not k) >= 3
+    assert abs(sum(states) / 1000.0 - .2) < .01
+    with assert_raises(ValueError):
+        controllers.BasePWMController(modulation="bogus")
+
+
+@pytest.mark.parametrize("duty", [.013, .05, .1234, .37, .5, .815, .97])
+def test_sigma_delta_duty_error(duty):
+    """sigma-delta beats per-interval PWM on long-run duty error at the same switching rate
+
+    Both are limited to the same timing resolution (tick) and shortest pulse (min on
+    and off time), which bounds both to at most two edges per second.
+
+    """
+    tick, min_time, seconds = .1, .5, 1000
+    sd = controllers.BasePWMController(
+        modulation="sigma_delta", tick=tick, min_on_time=min_time, min_off_time=min_time
+    )
+    sd.duty = duty
+    sd_on = sum(sd._sigma_delta_step() for i in xrange(int(seconds / tick)))
+    sd_error = abs(sd_on * tick / seconds - duty)
+    pwm = controllers.BasePWMController(interval=1)
+    pwm.duty = duty
+    on_duration, off_duration = pwm._calculate_durations()
+    on_duration = round(on_duration / tick) * tick
+    # pulses shorter than the relay allows can't be produced
+    if on_duration < min_time:
+        on_duration = 0
+    elif pwm.interval - on_duration < min_time:
+        on_duration = pwm.interval
+    pwm_error = abs(on_duration / pwm.interval - duty)
+    assert sd_error <= pwm_error
+    assert sd_error < 1e-3
+
+
+def test_body_sigma_delta(test_controller):
+    test_controller.modulation = "sigma_delta"
+    test_controller.duty = .5
+    with mock.patch('pi_pwm.controllers.time.time', mock.Mock()) as time_time:
+        with mock.patch('pi_pwm.controllers.time.sleep', mock.Mock()) as time_sleep:
+            time_time.side_effect = itertools.repeat(100.0)
+            test_controller._body()
+            assert test_controller.is_on
+            test_controller._body()
+            assert not test_controller.is_on
+            # sleeps target absolute deadlines one tick apart
+            assert time_sleep.call_args_list == [mock.call(pytest.approx(.1)), mock.call(pytest.approx(.2))]
+
+
+def test_max_edge_rate(test_controller):
+    test_controller.duty = .25
+    assert test_controller.effective_interval == 1
+    # 12 edges a minute is one cycle every 10 seconds
+    test_controller.max_edge_rate = 12
+    assert test_controller.effective_interval == 10
+    assert test_controller._calculate_durations() == [2.5, 7.5]
+    assert dict(test_controller)['effective_interval'] == 10
+    # a longer interval already meets the budget
+    test_controller.interval = 10
+    test_controller.max_edge_rate = 60
+    assert test_controller.effective_interval == 10
+    with assert_raises(ValueError):
+        test_controller.max_edge_rate = 0
+
+
+def test_max_edge_rate_edges(test_controller):
+    """the delivered energy still matches duty with fewer edges"""
+    test_controller.duty = .3
+    test_controller.max_edge_rate = 6
+    with mock.patch('pi_pwm.controllers.time.sleep', mock.Mock()) as time_sleep:
+        for i in range(3):
+            test_controller._body()
+    assert test_controller.edges == 6
+    assert time_sleep.call_args_list == [mock.call(pytest.approx(6)), mock.call(pytest.approx(14))] * 3
+
+
+def test_max_edge_rate_global():
+    scheduler = controllers.LoadScheduler(max_edge_rate=24)
+    cons = [controllers.BasePWMController(name=str(i)) for i in range(4)]
+    for c in cons:
+        scheduler.register(c)
+    cons[0].duty = cons[1].duty = .5
+    cons[2].duty = 1
+    # only the two switching controllers share the budget
+    assert cons[0].effective_interval == 10
+    # phases aren't managed without a load cap
+    cons[0].phase = .5
+    assert cons[0].phase == .5
+    cons[3].duty = .5
+    assert cons[0].effective_interval == 15
+    cons[3].max_edge_rate = 4
+    assert cons[3].effective_interval == 30
+
+
+def test_sigma_delta_max_edge_rate():
+    c = controllers.BasePWMController(modulation="sigma_delta", tick=.1, max_edge_rate=60)
+    c.duty = .5
+    states = [c._sigma_delta_step() for i in xrange(600)]
+    edges = sum(1 for a, b in zip(states, states[1:]) if a != b)
+    assert edges <= 60
+    assert abs(sum(states) / 600.0 - .5) < .01
+
+
+def schedule_peak(controllers_, resolution=100, weight=lambda c: 1):
+    load = [0] * resolution
+    for c in controllers_:
+        start = int(round(c.phase * resolution))
+        for i in xrange(int(round(c.duty * resolution))):
+            load[(start + i) % resolution] += weight(c)
+    return max(load)
+
+
+def test_load_scheduler_max_on():
+    scheduler = controllers.LoadScheduler(max_on=2)
+    cons = [controllers.BasePWMController(name=str(i)) for i in range(4)]
+    for c in cons:
+        scheduler.register(c)
+        c.duty = .5
+    # unstaggered, all four would be on together
+    assert schedule_peak(cons) == 2
+    assert sorted(c.phase for c in cons) == [0.0, 0.0, .5, .5]
+    # duty changes reschedule
+    cons[0].duty = .9
+    assert schedule_peak(cons) == 3
+    cons[0].duty = .2
+    assert schedule_peak(cons) == 2
+
+
+def test_load_scheduler_max_watts():
+    scheduler = controllers.LoadScheduler(max_watts=3000)
+    cons = [
+        controllers.BasePWMController(name="boil", watts=2000),
+        controllers.BasePWMController(name="hlt", watts=1500),
+        controllers.BasePWMController(name="pump", watts=0),
+    ]
+    for c in cons:
+        scheduler.register(c)
+        c.duty = .4
+    assert schedule_peak(cons, weight=lambda c: c.watts) == 2000
+    assert cons[0].phase == 0.0
+    assert cons[1].phase == .4
+    with assert_raises(ConfigurationError):
+        controllers.LoadScheduler()
+
+
+def test_pid_bank():
+    bank = controllers.PIDBank(interval=1)
+    hot = controllers.PIDPWMController(name="hot", setpoint=100, kp=.1, pid_bank=bank)
+    cold = controllers.PIDPWMController(name="cold", setpoint=50, kp=.01, ki=.001, pid_bank=bank)
+    idle = controllers.PIDPWMController(name="idle", setpoint=50, kp=1, pid_bank=bank)
+    assert len(bank.setpoint) == 3
+    hot.measurement = 95
+    cold.measurement = 40
+    bank.step(1)
+    assert hot.duty == pytest.approx(.5)
+    assert cold.duty == pytest.approx(.11)
+    # loops without a measurement are left alone
+    assert idle.duty == 0
+    assert idle.measurement is None
+    # proportional term alone saturates; the integral must not wind up while it does
+    hot.measurement = 0
+    for i in range(10):
+        bank.step(1)
+    assert hot.duty == 1
+    cold.kp = 0
+    cold.measurement = -1000
+    for i in range(10):
+        bank.step(1)
+    assert cold.duty == 1
+    # unchanged while saturated (cold was still integrating during the steps above)
+    assert bank.integral[1] == pytest.approx(.11)
+    # with no wound-up integral the output follows as soon as the error shrinks
+    cold.measurement = 49
+    bank.step(1)
+    assert cold.duty == pytest.approx(.111)
+
+
+def test_pid_derivative():
+    c = controllers.PIDPWMController(setpoint=50, kp=.1, kd=1)
+    c.measurement = 45
+    c.pid_bank.step(1)
+    assert c.duty == pytest.approx(.5)
+    # rising quickly toward the setpoint: the derivative term backs off
+    c.measurement = 49.8
+    c.pid_bank.step(1)
+    assert c.duty == pytest.approx(0)
+    assert dict(c)['setpoint'] == 50
+
+
+def test_pid_measurement_is_ping():
+    DEAD_INTERVAL = 10
+    t = time.time()
+    c = controllers.PIDPWMController(setpoint=50, kp=.1, dead_interval=DEAD_INTERVAL)
+    with mock.patch('pi_pwm.controllers.time.time', mock.Mock()) as time_time:
+        time_time.side_effect = itertools.repeat(t)
+        c.measurement = 45
+        assert c.dead_timer == DEAD_INTERVAL
+        time_time.side_effect = itertools.repeat(t + 5)
+        # PID output doesn't keep the controller alive by itself
+        c.pid_bank.step(1)
+        assert c.dead_timer == 5
+        c.measurement = 46
+        assert c.dead_timer == DEAD_INTERVAL
+
+
+def test_pid_bank_run():
+    c = controllers.PIDPWMController(setpoint=50, kp=.1)
+    c.measurement = 45
+    with mock.patch("pi_pwm.controllers.BasePWMController.run", mock.Mock()) as run:
+        with mock.patch("pi_pwm.controllers.PIDBank.start", mock.Mock()) as start:
+            c.run()
+    assert start.called
+    assert run.called
+    assert c.pid_bank.shutdown
+    bank = controllers.PIDBank(interval=.01)
+    with mock.patch("pi_pwm.controllers.PIDBank.step", mock.Mock()) as step:
+        step.side_effect = lambda dt: bank.stop()
+        bank.run()
+    step.assert_called_once_with(.01)
+
+
+def test_profile(test_controller):
+    t = time.time()
+    spec = {"steps": [{"ramp": 1, "duration": 100}, {"duty": .5}]}
+    with mock.patch('pi_pwm.controllers.time.time', mock.Mock()) as time_time:
+        time_time.side_effect = itertools.repeat(t)
+        test_controller.profile = spec
+        assert test_controller.duty == 0
+        time_time.side_effect = itertools.repeat(t + 25)
+        test_controller._run_profile()
+        assert test_controller.duty == .25
+        progress = dict(test_controller)['profile']
+        assert progress['status'] == 'running'
+        assert progress['elapsed'] == 25
+        assert progress['segment'] == 0
+        assert progress['steps'] == spec['steps']
+        # progress can be fed back in to resume where it left off
+        test_controller.profile = None
+        assert test_controller.profile is None
+        test_controller.profile = progress
+        assert test_controller.duty == .25
+        time_time.side_effect = itertools.repeat(t + 200)
+        test_controller._run_profile()
+        assert test_controller.duty == .5
+        assert test_controller.profile['status'] == 'finished'
+        # once finished, the profile no longer overrides manual updates
+        test_controller.duty = .8
+        time_time.side_effect = itertools.repeat(t + 300)
+        test_controller._run_profile()
+        assert test_controller.duty == .8
+        assert test_controller.profile['status'] == 'finished'
+
+
+def test_profile_keepalive():
+    DEAD_INTERVAL = 10
+    t = time.time()
+    c = controllers.BasePWMController(dead_interval=DEAD_INTERVAL, profile_keepalive=60)
+    with mock.patch('pi_pwm.controllers.time.time', mock.Mock()) as time_time:
+        time_time.side_effect = itertools.repeat(t)
+        c.profile = {"steps": [{"duty": .5, "hold": 1000}]}
+        assert c.dead_timer == DEAD_INTERVAL
+        # the running profile keeps the controller alive ...
+        time_time.side_effect = itertools.repeat(t + 45)
+        c._run_profile()
+        assert c.dead_timer == DEAD_INTERVAL
+        # ... but no more than profile_keepalive seconds past the last ping
+        time_time.side_effect = itertools.repeat(t + 55)
+        c._run_profile()
+        assert c.dead_timer == 5
+        time_time.side_effect = itertools.repeat(t + 61)
+        c._run_profile()
+        assert c.dead_timer == -1
+        assert not c.on()
+        c.ping()
+        assert c.dead_timer == DEAD_INTERVAL
+    # without profile_keepalive a profile needs pings like anything else
+    c = controllers.BasePWMController(dead_interval=DEAD_INTERVAL)
+    with mock.patch('pi_pwm.controllers.time.time', mock.Mock()) as time_time:
+        time_time.side_effect = itertools.repeat(t)
+        c.profile = {"steps": [{"duty": .5, "hold": 1000}]}
+        time_time.side_effect = itertools.repeat(t + 5)
+        c._run_profile()
+        assert c.dead_timer == 5
+
+
+@pytest.fixture
+def test_group():
+    cons = dict(
+        (name, controllers.BasePWMController(name=name, dead_interval=10))
+        for name in ("boil1", "boil2", "boil3", "boil4")
+    )
+    config = {
+        "groups": {
+            "bank": {
+                "master": "boil1",
+                "members": {
+                    "boil2": None,
+                    "boil3": {"mode": "ratio", "value": .6},
+                    "boil4": {"mode": "offset", "value": -.1},
+                }
+            }
+        }
+    }
+    return cons, controllers.groups_from_config(config, cons)["bank"]
+
+
+def test_group_duty(test_group):
+    cons, group = test_group
+    group.duty = .5
+    assert [cons[n].duty for n in sorted(cons)] == [.5, .5, .3, pytest.approx(.4)]
+    # updating the master directly fans out too, clamped to 0..1
+    cons["boil1"].duty = .05
+    assert [cons[n].duty for n in sorted(cons)] == [.05, .05, pytest.approx(.03), 0]
+    # so does output from a profile
+    cons["boil1"].profile = {"steps": [{"duty": 1}]}
+    assert [cons[n].duty for n in sorted(cons)] == [1, 1, .6, .9]
+    # members can be set on their own
+    cons["boil2"].duty = .2
+    assert cons["boil1"].duty == 1
+    d = dict(group)
+    assert d["master"] == "boil1"
+    assert d["members"]["boil3"] == {"mode": "ratio", "value": .6, "duty": .6}
+    assert dict(cons["boil3"])["group"] == "bank"
+    with assert_raises(ValueError):
+        group.duty = 2
+
+
+def test_group_atomic(test_group):
+    """no controller in the group can be read while the update is half done"""
+    cons, group = test_group
+    seen = []
+    cons["boil2"].scheduler = mock.Mock()
+    def check():
+        # all of the new values are in place before the locks are released
+        seen.append([cons[n]._duty for n in sorted(cons)])
+        assert all(not cons[n].lock.locked() for n in cons)
+    cons["boil2"].scheduler.invalidate.side_effect = check
+    group.duty = .5
+    assert seen == [[.5, .5, .3, pytest.approx(.4)]]
+
+
+def test_group_ping(test_group):
+    cons, group = test_group
+    t = time.time()
+    with mock.patch('pi_pwm.controllers.time.time', mock.Mock()) as time_time:
+        time_time.side_effect = itertools.repeat(t + 100)
+        assert group.ping() == 10
+        assert all(cons[n].dead_timer == 10 for n in cons)
+        assert group.dead_timer == 10
+
+
+@pytest.mark.parametrize(
+    ["gcfg", "extra"],
+    [
+        ["nope", "groups must be a dict"],
+        [{"boil1": {"master": "boil2", "members": {}}}, "same name as a controller"],
+        [{"bank": {"master": "boil1"}}, "must be a dict with a 'master' and a 'members' dict"],
+        [{"bank": {"master": "missing", "members": {}}}, "controller 'missing' not found"],
+        [{"bank": {"master": "boil1", "members": {"boil2": {"mode": "bogus"}}}}, "mode must be one of"],
+        [
+            {
+                "bank": {"master": "boil1", "members": {"boil2": None}},
+                "bank2": {"master": "boil3", "members": {"boil2": None}},
+            },
+            "'boil2' is already in group 'bank'"
+        ],
+    ]
+)
+def test_groups_from_config_errors(gcfg, extra):
+    cons = dict((name, controllers.BasePWMController(name=name)) for name in ("boil1", "boil2", "boil3"))
+    with assert_raises(ConfigurationError) as ar:
+        controllers.groups_from_config({"groups": gcfg}, cons)
+    assert extra in str(ar.exception)
+
+
+def test_mailbox():
+    c = controllers.BasePWMController(name="boil", mailbox=True, dead_interval=60)
+    c.audit_log = audit.AuditLog("unused")
+    # not running, so updates apply at once
+    c.duty = .1
+    assert c._duty == .1
+    assert len(c.audit_log._pending) == 1
+    c._last_ping = None
+    with mock.patch.object(c, "is_alive", return_value=True):
+        with audit.source("api"):
+            for duty in (.2, .3, .4):
+                c.duty = duty
+        with assert_raises(ValueError):
+            c.duty = 2
+        assert c.duty == .4
+        assert c._duty == .1
+        assert c.superseded == 2
+        assert len(c.audit_log._pending) == 1
+        assert c._last_ping is None
+        # the loop's next decision point applies the newest
+        c._empty_mailbox()
+        assert c._duty == .4
+        assert c._mailbox is None
+        assert c._last_ping is not None
+        record = audit.RECORD.unpack(c.audit_log._pending[-1])
+        assert record[2] == audit.SOURCES.index("api")
+        assert (record[4], record[5]) == (.1, .4)
+        # one arriving while another is applied waits for the next decision point
+        apply_duty = c._apply_duty
+        def racing_apply_duty(duty):
+            apply_duty(duty)
+            c.duty = .6
+        c.duty = .5
+        with mock.patch.object(c, "_apply_duty", side_effect=racing_apply_duty):
+            c._empty_mailbox()
+        assert c._duty == .5
+        assert c.duty == .6
+        assert c.superseded == 2
+        c._empty_mailbox()
+        assert c._duty == .6
+    assert dict(c)["superseded"] == 2
+
+
 def test_run_normal_shutdown(test_controller):
     """verify that we exit correctly when stop() is called"""
     def body_side_effect(controller, off):
@@ -321,23 +795,163 @@ def test_run_unclean_shutdown(test_controller):
             assert not test_controller.is_on
 
 
-def test_SysFSPWMController():
-    f = StringIO.StringIO()
-    with mock.patch("__builtin__.file", mock.Mock()) as m_file:
-        m_file.side_effect = [f]
-        controller = controllers.SysFSPWMController(gpio_id=24)
-        m_file.assert_called_once_with(
-            "/sys/class/gpio/gpio24/value",
-            "w+",
-            buffering=0
-        )
-        controller._on()
-        f.seek(0)
-        assert f.read() == "1"
-        f.seek(0)
-        controller._off()
-        f.seek(0)
-        assert f.read() == "0"
+@pytest.fixture
+def fake_sysfs(request):
+    """a temporary directory standing in for /sys/class/gpio"""
+    root = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(root))
+    for f in ("export", "unexport"):
+        open(os.path.join(root, f), "w").close()
+    return root
+
+
+def fake_udev(root, gpio_ids):
+    """create the per-pin files the kernel and udev would have created on export"""
+    for g in gpio_ids:
+        d = os.path.join(root, "gpio{}".format(g))
+        if not os.path.exists(d):
+            os.mkdir(d)
+        for f in ("value", "direction"):
+            open(os.path.join(d, f), "w").close()
+
+
+def test_export_gpios(fake_sysfs):
+    fake_udev(fake_sysfs, [4])
+    with mock.patch("pi_pwm.controllers.time.sleep", mock.Mock()) as time_sleep:
+        # pins only become writable once we've had to wait for them
+        time_sleep.side_effect = lambda d: fake_udev(fake_sysfs, [24, 25])
+        exported = controllers.export_gpios([25, 24, 4], fake_sysfs, timeout=5, initial_value=1)
+    # gpio4 was already exported; it's configured but not claimed
+    assert exported == [24, 25]
+    assert time_sleep.call_count == 1
+    assert open(os.path.join(fake_sysfs, "export")).read() == "2425"
+    for g in (4, 24, 25):
+        assert open(os.path.join(fake_sysfs, "gpio{}".format(g), "direction")).read() == "high"
+    controllers.unexport_gpios(exported, fake_sysfs)
+    assert open(os.path.join(fake_sysfs, "unexport")).read() == "25"
+
+
+def test_export_gpios_timeout(fake_sysfs):
+    with assert_raises(IOError) as ar:
+        controllers.export_gpios([24], fake_sysfs, timeout=0.05)
+    assert "24 not writable" in str(ar.exception)
+
+
+def test_SysFSPWMController_export(fake_sysfs):
+    fake_udev(fake_sysfs, [24])
+    with mock.patch("pi_pwm.controllers.os.path.exists", mock.Mock()) as exists:
+        # make the pin look unexported until export_gpios() has checked for it
+        exists.side_effect = [False]
+        controller = controllers.SysFSPWMController(gpio_id=24, export=True, sysfs_root=fake_sysfs)
+    assert controller._exported == [24]
+    assert open(os.path.join(fake_sysfs, "gpio24", "direction")).read() == "low"
+    controller.on()
+    assert open(os.path.join(fake_sysfs, "gpio24", "value")).read() == "1"
+    with mock.patch("pi_pwm.controllers.BasePWMController._body", mock.Mock()) as body:
+        body.side_effect = lambda: controller.stop()
+        controller.run()
+    # every write replaces the value, even in a regular file
+    assert open(os.path.join(fake_sysfs, "gpio24", "value")).read() == "0"
+    assert controller.gpio_fd is None
+    assert controller._exported == []
+    assert open(os.path.join(fake_sysfs, "unexport")).read() == "24"
+
+
+def test_SysFSPWMController(fake_sysfs):
+    fake_udev(fake_sysfs, [24])
+    value = os.path.join(fake_sysfs, "gpio24", "value")
+    with open(value, "w") as f:
+        f.write("1")
+    controller = controllers.SysFSPWMController(gpio_id=24, sysfs_root=fake_sysfs)
+    # the current pin state is picked up at startup ...
+    assert controller.is_on
+    # ... so an output left on is turned off, even at duty 0
+    with mock.patch("pi_pwm.controllers.BasePWMController._body", mock.Mock()) as body:
+        body.side_effect = lambda: controller.stop()
+        controller.run()
+    assert open(value).read() == "0"
+    controller.on()
+    assert open(value).read() == "1"
+    controller.off()
+    assert open(value).read() == "0"
+
+
+def test_SysFSPWMController_verify(fake_sysfs):
+    fake_udev(fake_sysfs, [24])
+    controller = controllers.SysFSPWMController(gpio_id=24, sysfs_root=fake_sysfs, verify=True)
+    controller._on()
+    with mock.patch("pi_pwm.controllers.os.write", mock.Mock()):
+        # the write is lost somewhere between us and the pin
+        with assert_raises(IOError) as ar:
+            controller._off()
+    assert "reads back '1' after writing '0'" in str(ar.exception)
+
+
+def test_from_config_batch_export(fake_sysfs):
+    config = dedent("""\
+        controllers:
+            boil:
+                class: SysFSPWMController
+                args: {{gpio_id: 24, export: true, sysfs_root: {root}}}
+            mash:
+                class: SysFSPWMController
+                args: {{gpio_id: 25, export: true, sysfs_root: {root}}}
+    """).format(root=fake_sysfs)
+    with mock.patch("pi_pwm.controllers.time.sleep", mock.Mock()) as time_sleep:
+        time_sleep.side_effect = lambda d: fake_udev(fake_sysfs, [24, 25])
+        cons = controllers.from_config(StringIO.StringIO(config), autostart=False)
+    assert open(os.path.join(fake_sysfs, "export")).read() == "2425"
+    assert cons["boil"]._exported == [24]
+    assert cons["mash"]._exported == [25]
+
+
+def test_from_config_batch_export_once(fake_sysfs):
+    fake_udev(fake_sysfs, [24, 25])
+    config = {"controllers": {
+        "boil": {"class": "SysFSPWMController", "args": {"gpio_id": 24, "export": True, "sysfs_root": fake_sysfs}},
+        "mash": {"class": "SysFSPWMController", "args": {"gpio_id": 25, "export": True, "sysfs_root": fake_sysfs}},
+    }}
+    with mock.patch("pi_pwm.controllers.export_gpios", wraps=controllers.export_gpios) as export_gpios:
+        controllers.from_config(config, autostart=False)
+    # the controllers don't export (and configure) their pins again
+    export_gpios.assert_called_once_with([24, 25], fake_sysfs, controllers.DEFAULT_EXPORT_TIMEOUT)
+
+
+def test_from_config_batch_export_failure(fake_sysfs):
+    config = {"controllers": {
+        "boil": {"class": "SysFSPWMController", "args": {"gpio_id": 24, "export": True, "sysfs_root": fake_sysfs}},
+        "mash": {"class": "SysFSPWMController", "args": {"gpio_id": 25, "export": True, "sysfs_root": fake_sysfs, "bogus": 1}},
+    }}
+    with mock.patch("pi_pwm.controllers.time.sleep", mock.Mock()) as time_sleep:
+        time_sleep.side_effect = lambda d: fake_udev(fake_sysfs, [24, 25])
+        with mock.patch("pi_pwm.controllers.unexport_gpios", mock.Mock()) as unexport_gpios:
+            with assert_raises(TypeError):
+                controllers.from_config(config, autostart=False)
+    # both pins are released even though only mash failed
+    assert unexport_gpios.call_args_list == [mock.call([24], fake_sysfs), mock.call([25], fake_sysfs)]
+
+
+def test_from_config_batch_export_config_error(fake_sysfs):
+    fake_udev(fake_sysfs, [24])
+    config = {
+        "controllers": {
+            "boil": {"class": "SysFSPWMController", "args": {"gpio_id": 24, "export": True, "sysfs_root": fake_sysfs}},
+        },
+        "scheduler": "bogus",
+    }
+    opened = []
+    real_open = os.open
+    def record_open(*args):
+        opened.append(real_open(*args))
+        return opened[-1]
+    with mock.patch("pi_pwm.controllers.os.path.exists", mock.Mock(side_effect=[False])), \
+            mock.patch("pi_pwm.controllers.os.open", record_open):
+        with assert_raises(ConfigurationError):
+            controllers.from_config(config, autostart=False)
+    # a bad section after the controllers were built still releases the pin and its fd
+    assert open(os.path.join(fake_sysfs, "unexport")).read() == "24"
+    with assert_raises(OSError):
+        os.fstat(opened[-1])
 
 
 @pytest.mark.parametrize(
@@ -402,6 +1016,78 @@ def test_SysFSPWMController():
             ConfigurationError,
             "args must be a dict"
         ],
+        [
+            dedent("""\
+                controllers:
+                    boil:
+                        class: BasePWMController
+                scheduler: nope
+            """),
+            ConfigurationError,
+            "scheduler must be a dict"
+        ],
+        [
+            dedent("""\
+                controllers:
+                    boil:
+                        class: BasePWMController
+                scheduler:
+                    max_volts: 3
+            """),
+            ConfigurationError,
+            "invalid scheduler configuration"
+        ],
+        [
+            dedent("""\
+                controllers:
+                    boil:
+                        class: PIDPWMController
+                pid: nope
+            """),
+            ConfigurationError,
+            "pid must be a dict"
+        ],
+        [
+            dedent("""\
+                controllers:
+                    boil:
+                        class: PIDPWMController
+                pid:
+                    gain: 1
+            """),
+            ConfigurationError,
+            "invalid pid configuration"
+        ],
+        [
+            dedent("""\
+                controllers:
+                    boil:
+                        class: PIDPWMController
+                        args: {setpoint: 100, kp: .1}
+                    mash:
+                        class: PIDPWMController
+                        args: {setpoint: 67, kp: .1}
+                pid:
+                    interval: 2
+            """),
+            None,
+            None
+        ],
+        [
+            dedent("""\
+                controllers:
+                    boil:
+                        class: BasePWMController
+                        args: {watts: 2000}
+                    mash:
+                        class: BasePWMController
+                        args: {watts: 2000}
+                scheduler:
+                    max_watts: 3000
+            """),
+            None,
+            None
+        ],
         [
             dedent("""\
                 controllers:
@@ -436,4 +1122,6 @@ def test_from_config(config, expected, extra):
         cf_fh.seek(0)
         cons = controllers.from_config(cf_fh)
         assert sorted(cons) == sorted(cf['controllers'])
+        banks = set(getattr(c, 'pid_bank', None) for c in cons.values())
+        assert len(banks) == 1
 
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import pytest
+import mock
+import gzip
+import json
+import StringIO
+
+from nose.tools import assert_raises
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+from pi_pwm import encoding
+
+# a stand-in binary format, so negotiation can be tested without msgpack or cbor2
+FAKE = {
+    encoding.MSGPACK: lambda obj: "packed:" + json.dumps(obj),
+}
+FAKE_DECODERS = {
+    encoding.MSGPACK: lambda data: json.loads(data[len("packed:"):]),
+}
+
+
+@pytest.fixture
+def fake_msgpack():
+    with mock.patch.dict(encoding.ENCODERS, FAKE), mock.patch.dict(encoding.DECODERS, FAKE_DECODERS):
+        with mock.patch.object(encoding, "FORMATS", [encoding.JSON, encoding.MSGPACK]):
+            yield
+
+
+def accept(header):
+    return parse_accept_header(header, MIMEAccept)
+
+
+@pytest.mark.parametrize(["header", "mimetype", "dumps"], [
+    ["", encoding.JSON, encoding.dumps_pretty],
+    ["*/*", encoding.JSON, encoding.dumps_pretty],
+    ["text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8", encoding.JSON, encoding.dumps_pretty],
+    ["application/json", encoding.JSON, encoding.dumps_compact],
+    ["application/json;q=0.5, text/html", encoding.JSON, encoding.dumps_compact],
+    ["application/msgpack, application/json;q=0.5", encoding.MSGPACK, FAKE[encoding.MSGPACK]],
+    ["application/x-msgpack", encoding.MSGPACK, FAKE[encoding.MSGPACK]],
+    ["application/cbor", encoding.JSON, encoding.dumps_pretty],
+])
+def test_negotiate(fake_msgpack, header, mimetype, dumps):
+    assert encoding.negotiate(accept(header)) == (mimetype, dumps)
+
+
+def test_unavailable():
+    with mock.patch.object(encoding, "FORMATS", [encoding.JSON]):
+        assert encoding.negotiate(accept("application/msgpack")) == (encoding.JSON, encoding.dumps_pretty)
+
+
+def test_decode(fake_msgpack):
+    assert encoding.decode("application/json; charset=utf-8", '{"duty": 0.5}') == {"duty": .5}
+    assert encoding.decode("application/x-msgpack", 'packed:{"duty": 0.5}') == {"duty": .5}
+    with assert_raises(ValueError):
+        encoding.decode("application/json", '{"duty"')
+    with assert_raises(KeyError):
+        encoding.decode("text/plain", "duty=0.5")
+    with assert_raises(KeyError):
+        encoding.decode(None, "")
+
+
+def test_response():
+    big = {"c{}".format(i): {"duty": .5} for i in range(100)}
+    request = Request(EnvironBuilder(headers={"Accept": "application/json", "Accept-Encoding": "gzip"}).get_environ())
+    resp = encoding.response(big, request, 201)
+    assert resp.status_code == 201
+    assert resp.headers["Content-Type"] == "application/json"
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert set(resp.vary) == set(["Accept", "Accept-Encoding"])
+    data = gzip.GzipFile(fileobj=StringIO.StringIO(resp.get_data())).read()
+    assert data == encoding.dumps_compact(big)
+    # too small to be worth it
+    resp = encoding.response({"duty": .5}, request)
+    assert "Content-Encoding" not in resp.headers
+    assert resp.get_data() == '{"duty":0.5}'
+
+
+@pytest.mark.parametrize("mimetype", [encoding.MSGPACK, encoding.CBOR])
+def test_binary(mimetype):
+    if mimetype not in encoding.ENCODERS:
+        pytest.skip("{} needs msgpack or cbor2".format(mimetype))
+    obj = {"boil": {"duty": .5, "name": "boil", "phase": None, "is_on": True, "edges": [1, 2]}}
+    decoded = encoding.decode(mimetype, encoding.ENCODERS[mimetype](obj))
+    assert decoded == obj
+    # names and strings go out as text, not as bytes
+    assert all(type(k) is unicode for k in decoded["boil"])
+    assert type(decoded["boil"]["name"]) is unicode
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+import pytest
+import mock
+import os
+import select
+import shutil
+import tempfile
+import time
+
+from nose.tools import assert_raises
+from pi_pwm import controllers, feedback
+from pi_pwm.controllers import ConfigurationError
+from pi_pwm.feedback import FeedbackInput, FeedbackMonitor
+
+
+class Pin(object):
+    """a pipe standing in for a GPIO input; each write is a reading"""
+
+    def __init__(self, value="0"):
+        self.r, self.w = os.pipe()
+        feedback._set_nonblocking(self.r)
+        self.set(value)
+
+    def set(self, value):
+        os.write(self.w, value + "\n")
+
+    def close(self):
+        os.close(self.r)
+        os.close(self.w)
+
+
+@pytest.fixture
+def pin(request):
+    pin = Pin()
+    request.addfinalizer(pin.close)
+    return pin
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise AssertionError("timed out waiting for {}".format(predicate))
+        time.sleep(.005)
+
+
+def test_latency(pin):
+    c = controllers.BasePWMController(name="boil")
+    fb = FeedbackInput(c, fd=pin.r, timeout=.5)
+    c.feedback = fb
+    assert fb.value is False
+    c.on()
+    start = fb._command[1]
+    assert fb.commanded_state is True
+    assert fb.deadline() == start + .5
+    pin.set("1")
+    fb._readings(fb._read(), start + .02)
+    assert fb.value is True
+    assert fb.deadline() is None
+    c.off()
+    pin.set("0")
+    fb._readings(fb._read(), fb._command[1] + .04)
+    assert fb.latency["count"] == 2
+    assert fb.latency["last"] == pytest.approx(.04)
+    assert fb.latency["mean"] == pytest.approx(.03)
+    assert fb.latency["max"] == pytest.approx(.04)
+    assert fb.unexpected == 0
+    assert fb.alert is None
+    status = dict(c)["feedback"]
+    assert status["value"] is False
+    assert status["commanded"] is False
+    assert status["latency"]["count"] == 2
+
+
+def test_stuck(pin):
+    c = controllers.BasePWMController(name="boil")
+    fb = FeedbackInput(c, fd=pin.r, timeout=.5, active_low=True)
+    c.feedback = fb
+    # active low: "0" is on
+    pin.set("1")
+    fb._readings(fb._read())
+    assert fb.value is False
+    c.on()
+    start = fb._command[1]
+    fb.check(start + .4)
+    assert fb.alert is None
+    fb.check(start + .5)
+    assert fb.alert == "stuck_off"
+    assert fb.deadline() is None
+    fb.check(start + 1)
+    assert fb.alerts == 1
+    # the relay catches up late
+    pin.set("0")
+    fb._readings(fb._read(), start + 1.2)
+    assert fb.alert is None
+    assert fb.latency["last"] == pytest.approx(1.2)
+    # then welds shut (the clock runs from the later of the command and the last change)
+    c.off()
+    start = fb._command[1]
+    fb.check(start + 1.8)
+    assert fb.alert == "stuck_on"
+    assert fb.alerts == 2
+    # and drops out on its own once the output is back on
+    c.on()
+    assert fb.alert == "stuck_on"
+    fb.check()
+    assert fb.alert is None
+    pin.set("1")
+    fb._readings(fb._read(), fb._command[1] + 1)
+    assert fb.unexpected == 1
+    fb.check(fb._command[1] + 1.4)
+    assert fb.alert is None
+    fb.check(fb._command[1] + 1.5)
+    assert fb.alert == "stuck_off"
+
+
+def test_missed_edges(pin):
+    """a relay welded shut under PWM cycles shorter than the timeout"""
+    c = controllers.BasePWMController(name="boil")
+    fb = FeedbackInput(c, fd=pin.r, timeout=1, max_missed=3)
+    pin.set("1")
+    fb._readings(fb._read())
+    t = time.time()
+    for cycle in range(20):
+        # on for .5s, off for .5s; the input never leaves "1"
+        fb.commanded(True, t)
+        fb.check(t + .4)
+        fb.commanded(False, t + .5)
+        fb.check(t + .9)
+        t += 1
+        if cycle < 2:
+            assert fb.alert is None
+    assert fb.alert == "stuck_on"
+    # raised once, not once per cycle
+    assert fb.alerts == 1
+    # the last off edge only counts as missed once the next edge is commanded
+    assert fb.missed == 19
+    # the agreement during each on phase doesn't clear it; following an edge does
+    fb.commanded(True, t)
+    fb.check(t + .1)
+    assert fb.alert == "stuck_on"
+    fb.commanded(False, t + .5)
+    pin.set("0")
+    fb._readings(fb._read(), t + .52)
+    assert fb.alert is None
+    assert fb.missed == 0
+    assert fb.latency["last"] == pytest.approx(.02)
+
+
+def test_monitor():
+    pins = [Pin(), Pin()]
+    cons = [controllers.BasePWMController(name="c{}".format(i)) for i in range(2)]
+    monitor = FeedbackMonitor([FeedbackInput(c, fd=p.r, timeout=.2) for c, p in zip(cons, pins)])
+    monitor.start()
+    try:
+        assert cons[0].feedback.monitor is monitor
+        cons[0].on()
+        cons[1].on()
+        time.sleep(.05)
+        pins[0].set("1")
+        wait_for(lambda: cons[0].feedback.value)
+        assert .04 < cons[0].feedback.latency["last"] < .15
+        # no edge arrives for the other; the monitor wakes up for its deadline
+        wait_for(lambda: cons[1].feedback.alert == "stuck_off")
+        assert cons[0].feedback.alert is None
+        # turning the output off ends the disagreement; the monitor is woken to clear it
+        cons[1].off()
+        wait_for(lambda: cons[1].feedback.alert is None)
+        cons[1].on()
+        pins[1].set("1")
+        wait_for(lambda: cons[1].feedback.value)
+        assert cons[1].feedback.alert is None
+    finally:
+        monitor.stop()
+        monitor.join(5)
+        for p in pins:
+            p.close()
+    assert not monitor.is_alive()
+
+
+def test_from_config(request):
+    root = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(root))
+    os.mkdir(os.path.join(root, "gpio25"))
+    for f, v in (("edge", "none"), ("value", "1")):
+        with open(os.path.join(root, "gpio25", f), "w") as fp:
+            fp.write(v)
+    cons = {"boil": controllers.BasePWMController(name="boil"), "hlt": object()}
+    assert feedback.from_config({}, cons) is None
+    config = {"feedback": {"sysfs_root": root, "timeout": 2, "inputs": {"boil": {"gpio_id": 25, "active_low": True}}}}
+    # epoll refuses regular files
+    with mock.patch.object(select, "epoll", select.poll):
+        monitor = feedback.from_config(config, cons, autostart=False)
+    fb = cons["boil"].feedback
+    assert fb in monitor.inputs.values()
+    assert fb.timeout == 2
+    assert fb.value is False
+    assert fb.eventmask == select.POLLPRI | select.POLLERR
+    with open(os.path.join(root, "gpio25", "edge")) as fp:
+        assert fp.read() == "both"
+    for bad, extra in (
+            ({"inputs": []}, "must be a dict"),
+            ({"inputs": {"nope": {"gpio_id": 1}}}, "not found"),
+            ({"inputs": {"hlt": {"gpio_id": 1}}}, "must run in this process"),
+            ({"inputs": {"boil": {}}}, "gpio_id"),
+            ({"inputs": {"boil": {"gpio_id": 26}}, "sysfs_root": root}, "invalid feedback input"),
+            ({"inputs": {"boil": {"gpio_id": 25, "bogus": 1}}, "sysfs_root": root}, "invalid feedback input"),
+        ):
+        with assert_raises(ConfigurationError) as ar:
+            feedback.from_config({"feedback": bad}, cons, autostart=False)
+        assert extra in str(ar.exception)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+import pytest
+import json
+import multiprocessing
+import StringIO
+import time
+import yaml
+
+from nose.tools import assert_raises
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+import pi_pwm.gateway
+import pi_pwm.webservice
+from pi_pwm.controllers import ConfigurationError
+
+NODE_CONFIG = {
+    'controllers': {
+        'boil': {'class': 'BasePWMController', 'args': {'dead_interval': 3600}},
+        'hlt': {'class': 'BasePWMController'},
+    }
+}
+
+
+class KeepAliveHandler(WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+
+def serve_node(ports, delay):
+    """run a webservice in this (child) process, answering after delay seconds"""
+    app = pi_pwm.webservice.create_app(StringIO.StringIO(yaml.dump(NODE_CONFIG)))
+    def slow_app(environ, start_response):
+        time.sleep(delay.value)
+        return app(environ, start_response)
+    server = make_server("127.0.0.1", 0, slow_app, threaded=True, request_handler=KeepAliveHandler)
+    ports.put(server.server_port)
+    server.serve_forever()
+
+
+class Nodes(object):
+    def __init__(self, names):
+        self.delays = {}
+        self.processes = []
+        self.urls = {}
+        for name in names:
+            ports = multiprocessing.Queue()
+            delay = multiprocessing.Value("d", 0)
+            p = multiprocessing.Process(target=serve_node, args=(ports, delay))
+            p.daemon = True
+            p.start()
+            self.processes.append(p)
+            self.delays[name] = delay
+            self.urls[name] = "http://127.0.0.1:{}".format(ports.get(timeout=10))
+
+    def stop(self):
+        for p in self.processes:
+            p.terminate()
+            p.join()
+
+
+@pytest.fixture(scope='module')
+def nodes(request):
+    nodes = Nodes(["kettle", "fermenter", "cellar"])
+    request.addfinalizer(nodes.stop)
+    return nodes
+
+
+@pytest.fixture
+def gateway(nodes):
+    for delay in nodes.delays.values():
+        delay.value = 0
+    config = {
+        'gateway': {
+            'timeout': .5,
+            'cache_ttl': .2,
+            # one that refuses connections
+            'nodes': dict(nodes.urls, attic='http://127.0.0.1:1'),
+        }
+    }
+    return pi_pwm.gateway.create_app(StringIO.StringIO(yaml.dump(config))).test_client()
+
+
+def index(gateway):
+    return json.loads(gateway.get('/').data)
+
+
+def test_index(gateway):
+    data = index(gateway)
+    assert sorted(data) == ['attic', 'cellar', 'fermenter', 'kettle']
+    for name in ('cellar', 'fermenter', 'kettle'):
+        assert data[name]['status'] == 'ok'
+        assert sorted(data[name]['index']) == ['boil', 'hlt']
+    assert data['attic']['status'] == 'down'
+    assert 'refused' in data['attic']['error']
+
+
+def test_keep_alive(gateway):
+    node = gateway.application.config['GATEWAY'].nodes['kettle']
+    for i in range(5):
+        assert gateway.get('/kettle/boil').status_code == 200
+    assert node.pool.connections == 1
+
+
+def test_cache(gateway):
+    node = gateway.application.config['GATEWAY'].nodes['kettle']
+    index(gateway)
+    connections, fetched = node.pool.connections, node._index_time
+    age = index(gateway)['kettle']['age']
+    assert node._index_time == fetched
+    assert 0 <= age < node.cache_ttl
+    time.sleep(node.cache_ttl)
+    index(gateway)
+    assert node._index_time > fetched
+    assert node.pool.connections == connections
+
+
+def test_degraded(gateway, nodes):
+    index(gateway)
+    time.sleep(.2)
+    nodes.delays['cellar'].value = 2
+    start = time.time()
+    data = index(gateway)
+    # the others answer at once, the slow one is given its timeout and no more
+    assert time.time() - start < .8
+    assert data['kettle']['status'] == 'ok'
+    assert data['cellar']['status'] == 'stale'
+    assert sorted(data['cellar']['index']) == ['boil', 'hlt']
+    # while its fetch is outstanding it holds up nothing
+    start = time.time()
+    assert gateway.post('/kettle/boil', content_type='application/json', data=json.dumps({'duty': .1})).status_code == 200
+    assert time.time() - start < .3
+    resp = gateway.get('/cellar/boil')
+    assert resp.status_code == 504
+    assert 'timed out' in json.loads(resp.data)['error']
+
+
+def test_route(gateway):
+    resp = gateway.post('/fermenter/hlt', content_type='application/json', data=json.dumps({'duty': .3}))
+    assert resp.status_code == 200
+    assert json.loads(resp.data) == {'old': {'duty': 0}, 'new': {'duty': .3}}
+    # the cached index reflects the change straight away
+    assert index(gateway)['fermenter']['index']['hlt']['duty'] == .3
+    assert json.loads(gateway.get('/kettle/hlt').data)['duty'] == 0
+    assert json.loads(gateway.get('/fermenter/boil/ping').data)['dead_timer'] == 3600
+    assert json.loads(gateway.get('/fermenter').data)['index']['hlt']['duty'] == .3
+    resp = gateway.post('/fermenter/hlt', content_type='application/json', data=json.dumps({'duty': 3}))
+    assert resp.status_code == 400
+    assert gateway.get('/fermenter/nope').status_code == 404
+    assert gateway.get('/nope/hlt').status_code == 404
+    assert gateway.get('/nope').status_code == 404
+    assert gateway.post('/fermenter/hlt', data='{}').status_code == 405
+    assert gateway.get('/attic/hlt').status_code == 504
+
+
+def test_from_config():
+    gw = pi_pwm.gateway.from_config({'gateway': {'timeout': 3, 'nodes': {
+        'a': 'http://a.local:8080', 'b': {'url': 'https://b.local/pwm', 'timeout': 1},
+    }}})
+    assert gw.nodes['a'].timeout == 3
+    assert gw.nodes['b'].timeout == 1
+    assert gw.nodes['b'].pool.base == '/pwm'
+    for bad in (None, {'nodes': []}, {'nodes': {'a': {}}}, {'nodes': {'a': 'ftp://a'}},
+                {'nodes': {'a': {'url': 'http://a', 'bogus': 1}}}, {'timeout': 0, 'nodes': {'a': 'http://a'}}):
+        with assert_raises(ConfigurationError):
+            pi_pwm.gateway.from_config({'gateway': bad})
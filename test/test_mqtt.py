@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+import pytest
+import mock
+import json
+import socket
+import threading
+import time
+
+from nose.tools import assert_raises
+from pi_pwm import audit, controllers, mqtt
+from pi_pwm.controllers import ConfigurationError
+from pi_pwm.mqtt import MQTTBridge
+
+
+class Message(object):
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+def matches(pattern, topic):
+    p, t = pattern.split("/"), topic.split("/")
+    return len(p) == len(t) and all(a in ("+", b) for a, b in zip(p, t))
+
+
+class Broker(object):
+    """an in-process stand-in for an MQTT broker, with clients like paho's"""
+
+    def __init__(self):
+        self.up = True
+        self.lock = threading.Lock()
+        self.retained = {}
+        self.clients = []
+        self.log = []
+
+    def client(self, client_id=None):
+        c = Client(self)
+        self.clients.append(c)
+        return c
+
+    def route(self, topic, payload, retain):
+        with self.lock:
+            self.log.append((topic, payload))
+            if retain:
+                self.retained[topic] = payload
+            for c in self.clients:
+                if c.connected and any(matches(s, topic) for s in c.subscriptions):
+                    c.inbox.append(Message(topic, payload))
+
+    def drop(self):
+        """cut every connection, as if the broker restarted"""
+        for c in self.clients:
+            if c.connected:
+                c.dropped = True
+
+
+class Client(object):
+    def __init__(self, broker):
+        self.broker = broker
+        self.connected = False
+        self.dropped = False
+        self.subscriptions = set()
+        self.inbox = []
+        self.pending = []
+        self.will = None
+        self.connects = 0
+        self.on_connect = self.on_disconnect = self.on_message = None
+
+    def username_pw_set(self, username, password=None):
+        self.credentials = (username, password)
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        self.will = (topic, payload, retain)
+
+    def connect(self, host, port=1883, keepalive=60):
+        if not self.broker.up:
+            raise socket.error(111, "Connection refused")
+        self.connects += 1
+        self.connected = True
+        self.dropped = False
+        self.subscriptions = set()
+        self.pending.append(lambda: self.on_connect(self, None, {}, 0))
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions.add(topic)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.broker.route(topic, payload, retain)
+
+    def disconnect(self):
+        self.connected = False
+
+    def loop(self, timeout=1.0):
+        if self.dropped:
+            self.connected = self.dropped = False
+            self.broker.route(*self.will)
+            self.on_disconnect(self, None, 7)
+            return 7
+        if not self.connected:
+            return 4
+        while self.pending:
+            self.pending.pop(0)()
+        with self.broker.lock:
+            inbox, self.inbox = self.inbox, []
+        for msg in inbox:
+            self.on_message(self, None, msg)
+        time.sleep(min(timeout, .01))
+        return 0
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise AssertionError("timed out waiting for {}".format(predicate))
+        time.sleep(.01)
+
+
+@pytest.fixture
+def broker():
+    return Broker()
+
+
+@pytest.fixture
+def bridge(request, broker):
+    boil = controllers.BasePWMController(name="boil", dead_interval=60)
+    bridge = MQTTBridge(
+        {"boil": boil}, prefix="brewery/", publish_interval=.2,
+        min_backoff=.01, max_backoff=.04, client_factory=broker.client,
+    )
+    def finish():
+        bridge.stop()
+        bridge.join(5)
+    request.addfinalizer(finish)
+    return bridge
+
+
+def state(broker, name="boil"):
+    payload = broker.retained.get("brewery/{}/state".format(name))
+    return payload and json.loads(payload)
+
+
+def test_set(broker, bridge):
+    boil = bridge.controllers["boil"]
+    log = audit.AuditLog("unused")
+    boil.audit_log = log
+    bridge.start()
+    wait_for(lambda: bridge.connected)
+    assert broker.retained["brewery/status"] == "online"
+    wait_for(lambda: state(broker) is not None)
+    assert state(broker) == {"duty": 0, "interval": 1, "phase": None, "is_on": False, "dead": False}
+    sender = broker.client()
+    sender.connect("broker")
+    sender.publish("brewery/boil/set", json.dumps({"duty": .5, "interval": 2}))
+    wait_for(lambda: (state(broker) or {}).get("duty") == .5)
+    assert boil.interval == 2
+    assert audit.RECORD.unpack(log._pending[0])[2] == audit.SOURCES.index("mqtt")
+    # bad updates are logged and dropped
+    sender.publish("brewery/boil/set", "[1]")
+    sender.publish("brewery/boil/set", json.dumps({"duty": 5}))
+    sender.publish("brewery/nope/set", json.dumps({"duty": .1}))
+    boil._dead_time = time.time() - 1
+    wait_for(lambda: state(broker)["dead"])
+    sender.publish("brewery/boil/set", json.dumps({"ping": True}))
+    wait_for(lambda: not state(broker)["dead"])
+    assert boil.duty == .5
+
+
+def test_set_error(broker, bridge):
+    boil = bridge.controllers["boil"]
+    bridge.start()
+    wait_for(lambda: state(broker) is not None)
+    sender = broker.client()
+    sender.connect("broker")
+    with mock.patch.object(boil, "ping", mock.Mock(side_effect=RuntimeError("boom"))) as ping:
+        sender.publish("brewery/boil/set", json.dumps({"ping": True}))
+        wait_for(lambda: ping.called)
+    # the bridge keeps going
+    sender.publish("brewery/boil/set", json.dumps({"duty": .3}))
+    wait_for(lambda: (state(broker) or {}).get("duty") == .3)
+    assert bridge.is_alive()
+
+
+def test_batched(broker, bridge):
+    boil = bridge.controllers["boil"]
+    bridge.start()
+    wait_for(lambda: state(broker) is not None)
+    published = bridge.published
+    start = time.time()
+    for i in range(100):
+        boil.duty = i / 100.0
+        time.sleep(.005)
+    wait_for(lambda: state(broker)["duty"] == .99)
+    elapsed = time.time() - start
+    # at most one publish per interval, however many changes there were
+    assert bridge.published - published <= elapsed / bridge.publish_interval + 1
+    assert len([t for t, p in broker.log if t == "brewery/boil/state"]) == bridge.published
+
+
+def test_reconnect(broker, bridge):
+    broker.up = False
+    bridge.start()
+    time.sleep(.1)
+    assert not bridge.connected
+    assert bridge._backoff == bridge.max_backoff
+    broker.up = True
+    wait_for(lambda: bridge.connected)
+    assert bridge._backoff == bridge.min_backoff
+    wait_for(lambda: state(broker) is not None)
+    broker.drop()
+    wait_for(lambda: broker.retained["brewery/status"] == "offline")
+    # the broker lost its retained state while it was down
+    broker.retained.clear()
+    wait_for(lambda: broker.retained.get("brewery/status") == "online")
+    wait_for(lambda: state(broker) is not None)
+    assert bridge.client.connects == 2
+    assert bridge.client.subscriptions == set(["brewery/+/set"])
+
+
+def test_stop(broker, bridge):
+    bridge.start()
+    wait_for(lambda: bridge.connected)
+    bridge.stop()
+    bridge.join(5)
+    assert not bridge.is_alive()
+    assert broker.retained["brewery/status"] == "offline"
+
+
+def test_from_config(broker):
+    assert mqtt.from_config({}, {}) is None
+    bridge = mqtt.from_config({"mqtt": {"host": "broker", "client_factory": broker.client}}, {}, autostart=False)
+    assert bridge.host == "broker"
+    assert bridge.prefix == "pi_pwm"
+    for bad in ("nope", {"bogus": 1}, {"publish_interval": "x", "client_factory": broker.client}):
+        with assert_raises(ConfigurationError):
+            mqtt.from_config({"mqtt": bad}, {}, autostart=False)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+import pytest
+import mock
+import tempfile
+import shutil
+import os
+import json
+import time
+import itertools
+
+from nose.tools import assert_raises
+from pi_pwm import controllers
+from pi_pwm.controllers import ConfigurationError
+from pi_pwm.persistence import StateJournal
+
+
+@pytest.fixture
+def state_path(request):
+    d = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(d))
+    return os.path.join(d, "state.json")
+
+
+def test_flush_coalesces(state_path):
+    journal = StateJournal(state_path)
+    c = controllers.BasePWMController(name="boil")
+    journal.register(c)
+    assert not journal.flush()
+    for i in range(100):
+        c.duty = i / 100.0
+    c.interval = 5
+    assert journal.flush()
+    assert not journal.flush()
+    assert journal.writes == 1
+    with open(state_path) as f:
+        state = json.load(f)
+    assert state["controllers"]["boil"] == {"interval": 5, "duty": .99, "profile": None}
+    assert not os.path.exists(state_path + ".tmp")
+
+
+def test_flush_error(state_path):
+    journal = StateJournal(os.path.join(state_path, "missing", "state.json"))
+    journal.register(controllers.BasePWMController(name="boil"))
+    journal.dirty = True
+    assert not journal.flush()
+    # still dirty, so the next flush tries again
+    assert journal.dirty
+
+
+def test_run_and_stop(state_path):
+    journal = StateJournal(state_path, flush_interval=.01)
+    c = controllers.BasePWMController(name="boil")
+    journal.register(c)
+    with mock.patch("pi_pwm.persistence.atexit.register", mock.Mock()):
+        journal.start()
+    c.duty = .5
+    journal.stop()
+    journal.join(1)
+    assert not journal.is_alive()
+    with open(state_path) as f:
+        assert json.load(f)["controllers"]["boil"]["duty"] == .5
+
+
+def test_load(state_path):
+    journal = StateJournal(state_path, max_age=60)
+    assert journal.load() == {}
+    t = time.time()
+    c = controllers.BasePWMController(name="boil")
+    journal.register(c)
+    with mock.patch('pi_pwm.controllers.time.time', mock.Mock()) as time_time:
+        time_time.side_effect = itertools.repeat(t)
+        c.profile = {"steps": [{"duty": .5, "hold": 100}]}
+        with mock.patch('pi_pwm.persistence.time.time', mock.Mock()) as jtime:
+            jtime.side_effect = itertools.repeat(t)
+            journal.flush()
+            jtime.side_effect = itertools.repeat(t + 30)
+            state = journal.load()
+            # running profiles move on by the time we were down
+            assert state["boil"]["profile"]["elapsed"] == 30
+            jtime.side_effect = itertools.repeat(t + 61)
+            assert journal.load() == {}
+
+
+def test_restore():
+    journal = StateJournal("unused")
+    c = controllers.BasePWMController(name="boil", dead_interval=10)
+    journal.restore(c, {"interval": 5, "duty": .3, "bogus": 1})
+    assert c.interval == 5
+    assert c.duty == .3
+    journal.restore(c, {"profile": {"steps": [{"duty": .7, "hold": 100}], "elapsed": 50}})
+    assert c.duty == .7
+    assert c.profile["elapsed"] >= 50
+    # bad values are logged and skipped
+    journal.restore(c, {"interval": 500, "duty": .1})
+    assert c.interval == 5
+
+
+def test_from_config(state_path):
+    config = {
+        "controllers": {"boil": {"class": "BasePWMController"}},
+        "persistence": {"path": state_path, "max_age": 60},
+    }
+    cons = controllers.from_config(config, autostart=False)
+    cons["boil"].duty = .4
+    cons["boil"].journal.flush()
+    cons = controllers.from_config(config, autostart=False)
+    assert cons["boil"].duty == .4
+    with assert_raises(ConfigurationError):
+        controllers.from_config(dict(config, persistence={"nopath": 1}), autostart=False)
+    with assert_raises(ConfigurationError):
+        controllers.from_config(dict(config, persistence={"path": state_path, "bogus": 1}), autostart=False)
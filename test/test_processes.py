@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+import pytest
+import mock
+import tempfile
+import shutil
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from textwrap import dedent
+from nose.tools import assert_raises
+from pi_pwm import controllers
+from pi_pwm.controllers import ConfigurationError
+from pi_pwm.processes import ProcessPWMController
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise AssertionError("timed out waiting for {}".format(predicate))
+        time.sleep(.01)
+
+
+def pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    # a zombie is as good as gone
+    with open("/proc/{}/stat".format(pid)) as f:
+        return f.read().split(")")[-1].split()[0] != "Z"
+
+
+@pytest.fixture
+def fake_gpio(request):
+    """a temporary /sys/class/gpio with gpio24 already exported"""
+    root = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(root))
+    os.mkdir(os.path.join(root, "gpio24"))
+    with open(os.path.join(root, "gpio24", "value"), "w") as f:
+        f.write("0")
+    return root
+
+
+def last_value(root):
+    # regular files append rather than overwrite, so the pin state is the last write
+    with open(os.path.join(root, "gpio24", "value")) as f:
+        return f.read()[-1]
+
+
+def test_set_and_report():
+    cons = controllers.from_config({"controllers": {
+        "boil": {
+            "class": "BasePWMController",
+            "process": "heaters",
+            "args": {"min_interval": .1, "interval": .2, "dead_interval": 60},
+        },
+        "hlt": {"class": "BasePWMController", "process": "heaters", "args": {"min_interval": .1, "interval": .2}},
+        "local": {"class": "BasePWMController"},
+    }})
+    boil, hlt = cons["boil"], cons["hlt"]
+    try:
+        assert isinstance(boil, ProcessPWMController)
+        assert not isinstance(cons["local"], ProcessPWMController)
+        assert boil.process is hlt.process
+        assert boil.process.pid != os.getpid()
+        assert boil.SETTABLE == ["interval", "duty", "phase", "max_edge_rate"]
+        boil.duty = .5
+        boil.phase = 1.0
+        wait_for(lambda: boil.edges >= 2)
+        data = dict(boil)
+        assert data["duty"] == .5
+        assert data["phase"] == 0
+        assert data["class"] == "BasePWMController"
+        assert data["process"] == "heaters"
+        assert data["dead_timer"] > 55
+        assert data["min_interval"] == .1
+        # validated here, before it gets anywhere near the process
+        with assert_raises(ValueError):
+            boil.interval = 20
+        assert boil.interval == .2
+        assert boil.ping() == 60
+        # updates faster than the process polls are coalesced
+        for i in range(50):
+            boil.duty = i / 100.0
+        wait_for(lambda: boil.duty == .49)
+        assert boil.superseded > 0
+        assert dict(boil)["superseded"] == boil.superseded
+    finally:
+        for c in cons.values():
+            c.stop()
+    assert not boil.is_alive()
+    assert not boil.is_on
+
+
+def test_pid():
+    cons = controllers.from_config({"controllers": {"mash": {
+        "class": "PIDPWMController",
+        "process": True,
+        "args": {"min_interval": .1, "interval": .2, "setpoint": 60, "kp": .1},
+    }}})
+    mash = cons["mash"]
+    try:
+        assert mash.process.name == "mash"
+        mash.measurement = 55
+        # the loop runs in the other process and its output comes back
+        wait_for(lambda: mash.duty == .5)
+        # asking for the same duty again still reaches the process
+        mash.duty = .5
+        mash.kp = 0
+        wait_for(lambda: mash.duty == 0)
+    finally:
+        mash.stop()
+
+
+def test_sigterm(fake_gpio):
+    cons = controllers.from_config({"controllers": {"boil": {
+        "class": "SysFSPWMController",
+        "process": True,
+        "args": {"gpio_id": 24, "sysfs_root": fake_gpio, "min_interval": .1, "interval": .2},
+    }}})
+    boil = cons["boil"]
+    boil.duty = 1
+    wait_for(lambda: last_value(fake_gpio) == "1")
+    os.kill(boil.process.pid, signal.SIGTERM)
+    boil.join(5)
+    assert not boil.is_alive()
+    assert last_value(fake_gpio) == "0"
+
+
+def test_parent_death(fake_gpio, tmpdir):
+    script = tmpdir.join("parent.py")
+    script.write(dedent("""
+        import sys, time
+        from pi_pwm import controllers
+        cons = controllers.from_config({"controllers": {"boil": {
+            "class": "SysFSPWMController",
+            "process": True,
+            "args": {"gpio_id": 24, "sysfs_root": %r, "min_interval": .1, "interval": .2},
+        }}})
+        cons["boil"].duty = 1
+        print cons["boil"].process.pid
+        sys.stdout.flush()
+        time.sleep(60)
+    """ % fake_gpio))
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(controllers.__file__)))
+    parent = subprocess.Popen([sys.executable, str(script)], stdout=subprocess.PIPE, env=env)
+    try:
+        child = int(parent.stdout.readline())
+        wait_for(lambda: last_value(fake_gpio) == "1")
+    finally:
+        parent.kill()
+        parent.wait()
+    wait_for(lambda: not pid_exists(child))
+    assert last_value(fake_gpio) == "0"
+
+
+def test_config_errors():
+    config = {"controllers": {"boil": {"class": "BasePWMController", "process": 5}}}
+    with assert_raises(ConfigurationError):
+        controllers.from_config(config, autostart=False)
+    config["controllers"]["boil"]["process"] = True
+    cons = controllers.from_config(config, autostart=False)
+    with assert_raises(ConfigurationError):
+        controllers.groups_from_config({"groups": {"g": {"master": "boil", "members": {}}}}, cons)
+
+
+def test_autostart_order(tmpdir):
+    """processes fork before the audit log, PID bank or any controller thread starts"""
+    config = {
+        "controllers": {
+            "a_local": {"class": "BasePWMController"},
+            "pid": {"class": "PIDPWMController"},
+            "z_isolated": {"class": "BasePWMController", "process": True},
+        },
+        "audit": {"path": str(tmpdir.join("audit.log"))},
+    }
+    started = []
+    record = lambda self: started.append(type(self).__name__)
+    with mock.patch("pi_pwm.processes.ControllerProcess.start", record), \
+            mock.patch("threading.Thread.start", record):
+        controllers.from_config(config)
+    assert started[0] == "ControllerProcess"
+    assert started.count("ControllerProcess") == 1
+    assert sorted(started[1:]) == ["AuditLog", "BasePWMController", "PIDBank", "PIDPWMController"]
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+import pytest
+import gc
+import os
+import pstats
+import tempfile
+import threading
+
+from nose.tools import assert_raises
+from pi_pwm.profiler import SamplingProfiler
+
+
+def spin(stop):
+    while not stop.is_set():
+        sum(xrange(100))
+
+
+def make_garbage(stop):
+    while not stop.is_set():
+        a = []
+        a.append(a)
+
+
+@pytest.fixture
+def busy(request):
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=spin, args=(stop,), name="spinner"),
+        threading.Thread(target=make_garbage, args=(stop,), name="garbage"),
+    ]
+    for t in threads:
+        t.start()
+    def finish():
+        stop.set()
+        for t in threads:
+            t.join()
+    request.addfinalizer(finish)
+    return threads
+
+
+def test_collapsed(busy):
+    profiler = SamplingProfiler(interval=.002).run(.2)
+    assert profiler.samples > 10
+    assert profiler.duration >= .2
+    lines = profiler.collapsed().splitlines()
+    spinner = [l for l in lines if l.startswith("spinner;")]
+    assert spinner
+    stack, count = spinner[0].rsplit(" ", 1)
+    assert "spin (" in stack
+    assert int(count) > 0
+    # the sampling thread leaves itself out
+    assert not any("SamplingProfiler" in l or "_sample (" in l for l in lines)
+    report = profiler.report()
+    assert report["samples"] == profiler.samples
+    assert sum(report["stacks"].values()) == sum(profiler.stacks.values())
+    assert "gc" not in report
+
+
+def test_pstats(busy):
+    profiler = SamplingProfiler(interval=.002).run(.1)
+    fd, path = tempfile.mkstemp()
+    try:
+        os.write(fd, profiler.pstats())
+        os.close(fd)
+        stats = pstats.Stats(path)
+    finally:
+        os.remove(path)
+    spins = [k for k in stats.stats if k[2] == "spin"]
+    assert spins
+    cc, nc, tt, ct, callers = stats.stats[spins[0]]
+    assert 0 < tt <= ct
+    assert any(k[2] == "run" for k in callers)
+
+
+def test_gc_pauses(busy):
+    assert gc.isenabled()
+    profiler = SamplingProfiler(interval=.002, gc_pauses=True).run(.2)
+    assert gc.isenabled()
+    report = profiler.report()["gc"]
+    assert report["collections"][0] > 0
+    assert report["max"] >= 0
+    assert len(report["pauses"]) == sum(report["collections"])
+
+
+def test_invalid():
+    with assert_raises(ValueError):
+        SamplingProfiler(interval=0)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import pytest
+
+from nose.tools import assert_raises
+from pi_pwm.profiles import Profile
+
+MASH = {
+    "start": 0.2,
+    "steps": [
+        {"ramp": 1.0, "duration": 100},
+        {"hold": 50},
+        {"repeat": 2, "steps": [
+            {"duty": 0.5, "hold": 10},
+            {"duty": 0.0, "hold": 10},
+        ]},
+        {"duty": 0.3},
+    ]
+}
+
+
+def test_compile():
+    p = Profile(MASH)
+    assert p.segments == 6
+    assert p.duration == 190
+    assert list(p.starts) == [0, 100, 150, 160, 170, 180]
+    assert p.end_duty == 0.3
+
+
+@pytest.mark.parametrize(
+    ["elapsed", "duty", "segment"],
+    [
+        [0, 0.2, 0],
+        [50, 0.6, 0],
+        [100, 1.0, 1],
+        [149.9, 1.0, 1],
+        [155, 0.5, 2],
+        [165, 0.0, 3],
+        [175, 0.5, 4],
+        [185, 0.0, 5],
+        # finished: holds the final duty
+        [190, 0.3, None],
+        [1000, 0.3, None],
+    ]
+)
+def test_at(elapsed, duty, segment):
+    p = Profile(MASH)
+    assert p.at(elapsed) == (pytest.approx(duty), segment)
+
+
+def test_at_hint():
+    """lookups search forward from the hint, and still work if time goes backwards"""
+    p = Profile(MASH)
+    segment = None
+    for t in range(0, 190, 5):
+        segment = p.at(t, segment)[1] or segment
+    assert segment == 5
+    assert p.at(20, segment) == (pytest.approx(0.36), 0)
+    # a stale hint from another caller doesn't matter
+    assert p.at(185, 0) == p.at(185, 5) == p.at(185) == (pytest.approx(0.0), 5)
+    assert p.at(20, 99) == (pytest.approx(0.36), 0)
+
+
+@pytest.mark.parametrize(
+    ["spec", "extra"],
+    [
+        [[], "must be a dict with a 'steps' list"],
+        [{"steps": ["nope"]}, "steps must be dicts"],
+        [{"steps": [{"duty": 2}]}, "duty must be between 0 and 1"],
+        [{"steps": [{"ramp": 1}]}, "ramp must have a duration"],
+        [{"steps": [{"hold": -1}]}, "hold must not be negative"],
+        [{"steps": [{"repeat": 2}]}, "repeat must have a 'steps' list"],
+        [{"steps": [{"bogus": 1}]}, "unrecognized profile step"],
+        [{"steps": [{"repeat": 100000, "steps": [{"hold": 1}]}]}, "repeat must be between 0 and"],
+        [{"steps": [{"repeat": 10000, "steps": [{"hold": 1}, {"hold": 1}]}]}, "more than 10000 segments"],
+        [{"steps": [{"repeat": -1, "steps": [{"hold": 1}]}]}, "repeat must be between 0 and"],
+        [{"steps": [{"repeat": 3 * 10 ** 7, "steps": []}]}, "repeat must be between 0 and"],
+        # repeats that add no segments are still bounded
+        [{"steps": [{"repeat": 10000, "steps": [{"repeat": 10000, "steps": []}]}]}, "steps once repeats are unrolled"],
+        [{"steps": [{"repeat": 10000, "steps": [{"duty": .5}] * 20}]}, "steps once repeats are unrolled"],
+    ]
+)
+def test_invalid(spec, extra):
+    with assert_raises(ValueError) as ar:
+        Profile(spec)
+    assert extra in str(ar.exception)
+
+
+def test_instantaneous_only():
+    p = Profile({"steps": [{"duty": 0.4}]})
+    assert p.duration == 0
+    assert p.at(0) == (0.4, None)
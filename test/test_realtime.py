@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+import pytest
+import mock
+import threading
+import time
+
+from nose.tools import assert_raises
+from pi_pwm import controllers, realtime
+from pi_pwm.controllers import ConfigurationError
+from pi_pwm.realtime import Realtime
+
+
+def allowed_cpu():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("Cpus_allowed_list:"):
+                return int(line.split(":")[1].strip().split(",")[0].split("-")[0])
+
+
+def in_thread(function, *args):
+    errors = []
+    def target():
+        try:
+            function(*args)
+        except Exception as e:
+            errors.append(e)
+    t = threading.Thread(target=target)
+    t.start()
+    t.join()
+    if errors:
+        raise errors[0]
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"policy": "deadline"},
+    {"policy": "fifo", "priority": 0},
+    {"policy": "rr", "priority": 100},
+    {"cpus": []},
+    {"cpus": [-1]},
+])
+def test_invalid(kwargs):
+    with assert_raises(ValueError):
+        Realtime(**kwargs)
+
+
+def test_apply():
+    rt = Realtime(policy="fifo", priority=50, cpus=[3], mlockall=True, prefault=1024)
+    with mock.patch.multiple(
+        "pi_pwm.realtime",
+        lock_memory=mock.DEFAULT, prefault=mock.DEFAULT,
+        set_affinity=mock.DEFAULT, set_scheduler=mock.DEFAULT,
+    ) as calls:
+        assert rt.apply_process() == realtime.MLOCKALL | realtime.PREFAULT
+        mask = rt.apply_thread()
+    calls["prefault"].assert_called_once_with(1024)
+    calls["set_affinity"].assert_called_once_with([3])
+    calls["set_scheduler"].assert_called_once_with("fifo", 50)
+    assert rt.describe(mask) == {
+        "policy": "fifo", "priority": 50, "cpus": [3], "mlockall": True, "prefault": 1024,
+    }
+
+
+def test_apply_unprivileged():
+    rt = Realtime(policy="rr", cpus=[3], mlockall=True, prefault=1024)
+    eperm = OSError(1, "Operation not permitted")
+    with mock.patch.multiple(
+        "pi_pwm.realtime",
+        lock_memory=mock.Mock(side_effect=eperm), prefault=mock.Mock(side_effect=eperm),
+        set_affinity=mock.Mock(side_effect=eperm), set_scheduler=mock.Mock(side_effect=eperm),
+    ):
+        assert rt.apply_process() == 0
+        assert rt.apply_thread() == 0
+    assert rt.describe(0) == {}
+
+
+def test_syscalls():
+    cpu = allowed_cpu()
+    # in their own threads, since these stick to the calling thread
+    in_thread(realtime.set_affinity, [cpu])
+    in_thread(realtime.set_scheduler, "other", 0)
+    with assert_raises(OSError):
+        in_thread(realtime.set_affinity, [realtime.CPU_SETSIZE - 1])
+
+
+def test_controller_status():
+    rt = Realtime(policy="fifo", priority=10)
+    c = controllers.BasePWMController(name="boil")
+    assert dict(c)["realtime"] is None
+    c.realtime = rt
+    with mock.patch("pi_pwm.realtime.set_scheduler") as set_scheduler:
+        with mock.patch.object(c, "_body", side_effect=c.stop):
+            c.run()
+    set_scheduler.assert_called_once_with("fifo", 10)
+    assert dict(c)["realtime"] == {"policy": "fifo", "priority": 10}
+
+
+def test_from_config():
+    config = {
+        "controllers": {
+            "boil": {"class": "BasePWMController"},
+            "hlt": {"class": "BasePWMController", "process": True, "args": {"min_interval": .1, "interval": .2}},
+        },
+        "realtime": {"cpus": [allowed_cpu()], "stack_size": 1024 * 1024},
+    }
+    cons = controllers.from_config(config, autostart=False)
+    assert cons["boil"].realtime is cons["hlt"].process.realtime
+    assert dict(cons["boil"].realtime)["cpus"] == [allowed_cpu()]
+    hlt = cons["hlt"]
+    hlt.start()
+    try:
+        deadline = time.time() + 5
+        while dict(hlt)["realtime"] is None and time.time() < deadline:
+            time.sleep(.01)
+        assert dict(hlt)["realtime"] == {"cpus": [allowed_cpu()]}
+    finally:
+        hlt.stop()
+    for bad in ("nope", {"policy": "deadline"}, {"bogus": 1}):
+        with assert_raises(ConfigurationError):
+            controllers.from_config(dict(config, realtime=bad), autostart=False)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+import pytest
+import mock
+import tempfile
+import shutil
+import os
+import threading
+import time
+
+from nose.tools import assert_raises
+from pi_pwm import controllers, sensors
+from pi_pwm.controllers import ConfigurationError
+
+W1_SLAVE = "72 01 4b 46 7f ff 0e 10 57 : crc=57 {}\n72 01 4b 46 7f ff 0e 10 57 t={}\n"
+
+
+@pytest.fixture
+def fake_w1(request):
+    """a temporary directory standing in for /sys/bus/w1/devices"""
+    root = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(root))
+    return root
+
+
+def write_probe(root, id, millidegrees, crc="YES"):
+    d = os.path.join(root, id)
+    if not os.path.exists(d):
+        os.mkdir(d)
+    with open(os.path.join(d, "w1_slave"), "w") as f:
+        f.write(W1_SLAVE.format(crc, millidegrees))
+
+
+def test_read_w1_slave(fake_w1):
+    write_probe(fake_w1, "28-1", 23125)
+    assert sensors.read_w1_slave(os.path.join(fake_w1, "28-1", "w1_slave")) == 23.125
+    write_probe(fake_w1, "28-1", -1500)
+    assert sensors.read_w1_slave(os.path.join(fake_w1, "28-1", "w1_slave")) == -1.5
+    write_probe(fake_w1, "28-1", 23125, crc="NO")
+    with assert_raises(sensors.SensorError):
+        sensors.read_w1_slave(os.path.join(fake_w1, "28-1", "w1_slave"))
+
+
+def test_sensor_read(fake_w1):
+    write_probe(fake_w1, "28-1", 66500)
+    c = controllers.PIDPWMController(setpoint=67, kp=.1)
+    s = sensors.W1Sensor("mash", "28-1", fake_w1, controller=c)
+    assert s.reading == (None, None)
+    assert s.age is None
+    assert s.read() == 66.5
+    assert s.value == 66.5
+    assert s.age >= 0
+    assert c.measurement == 66.5
+    # a bad read keeps the previous value and records the error
+    write_probe(fake_w1, "28-1", 0, crc="NO")
+    assert s.read() is None
+    assert s.value == 66.5
+    assert "CRC check failed" in s.error
+    assert dict(s)['controller'] == c.name
+
+
+def test_pool_reads_concurrently(fake_w1):
+    ids = ["28-{}".format(i) for i in range(8)]
+    for i, id in enumerate(ids):
+        write_probe(fake_w1, id, i * 1000)
+    pool = sensors.SensorPool(
+        dict((id, sensors.W1Sensor(id, id, fake_w1)) for id in ids),
+        workers=4
+    )
+    active = []
+    peak = []
+    lock = threading.Lock()
+    real_read = sensors.read_w1_slave
+    def slow_read(path):
+        with lock:
+            active.append(path)
+            peak.append(len(active))
+        time.sleep(.05)
+        with lock:
+            active.remove(path)
+        return real_read(path)
+    with mock.patch("pi_pwm.sensors.read_w1_slave", slow_read):
+        start = time.time()
+        pool.read_all()
+        elapsed = time.time() - start
+    pool.stop()
+    # bounded by the pool size, and faster than reading one after another
+    assert max(peak) == 4
+    assert elapsed < .05 * len(ids)
+    assert [pool[id].value for id in ids] == [float(i) for i in range(8)]
+    assert dict(pool)[ids[3]]['value'] == 3.0
+
+
+def test_pool_run(fake_w1):
+    write_probe(fake_w1, "28-1", 1000)
+    pool = sensors.SensorPool({"a": sensors.W1Sensor("a", "28-1", fake_w1)}, interval=.01)
+    with mock.patch("pi_pwm.sensors.SensorPool.read_all", mock.Mock()) as read_all:
+        read_all.side_effect = lambda: pool.stop()
+        pool.run()
+    assert read_all.call_count == 1
+
+
+@pytest.mark.parametrize(
+    ["scfg", "extra"],
+    [
+        ["nope", "must be a dict with a 'probes' dict"],
+        [{"probes": {"a": "nope"}}, "must be a dict with an 'id'"],
+        [{"probes": {"a": {"id": "28-1", "controller": "missing"}}}, "controller 'missing' not found"],
+        [{"probes": {"a": {"id": "28-1", "controller": "base"}}}, "does not take measurements"],
+    ]
+)
+def test_from_config_errors(scfg, extra):
+    cons = {"base": controllers.BasePWMController(name="base")}
+    with assert_raises(ConfigurationError) as ar:
+        sensors.from_config({"sensors": scfg}, cons)
+    assert extra in str(ar.exception)
+
+
+def test_from_config(fake_w1):
+    write_probe(fake_w1, "28-1", 64000)
+    config = {
+        "controllers": {"mash": {"class": "PIDPWMController", "args": {"setpoint": 67}}},
+        "sensors": {
+            "w1_root": fake_w1,
+            "workers": 2,
+            "probes": {"mash_temp": {"id": "28-1", "controller": "mash"}},
+        },
+    }
+    assert sensors.from_config({"controllers": {}}) is None
+    cons = controllers.from_config(config, autostart=False)
+    pool = sensors.from_config(config, cons, autostart=False)
+    assert pool.workers == 1
+    pool.read_all()
+    pool.stop()
+    assert cons["mash"].measurement == 64.0
@@ -4,13 +4,19 @@ import pytest
 import mock
 import StringIO
 
+import gzip
 import json
+import time
 import yaml
 
 from textwrap import dedent
 from nose.tools import *
 
+import pi_pwm.audit
+import pi_pwm.encoding
 import pi_pwm.webservice
+import pi_pwm.controllers
+import pi_pwm.sensors
 
 TEST_CONFIG = {
     'controllers': {
@@ -128,6 +134,8 @@ def test_controller_get(test_app, controller, expected, status):
     [
         # Happy Path
         ['boil', {'interval': 5, 'duty': 0.5}, None],
+        ['boil', {'max_edge_rate': 6}, None],
+        ['boil', {'profile': {'steps': 'nope'}}, {'status_code': 400, 'error': "profile must be a dict with a 'steps' list"}],
         # If additional things are passed in, they don't 'take'
         ['boil', {'interval': 5, 'min_interval':20}, None],
         # If throw error for invalid values
@@ -138,7 +146,7 @@ def test_controller_get(test_app, controller, expected, status):
     ]
 )
 def test_controller_post(test_app, controller, input, error):
-    checklist = ['name','interval','min_interval','max_interval','duty','dead_interval', 'class']
+    checklist = ['name','interval','min_interval','max_interval','duty','dead_interval', 'class', 'max_edge_rate']
     before = test_app.get('/{}'.format(controller))
     before_data = json.loads(before.data)
 
@@ -160,7 +168,7 @@ def test_controller_post(test_app, controller, input, error):
     else:
         assert resp.status_code == 200
         for key in checklist:
-            if key in ['duty', 'interval'] and key in input:
+            if key in ['duty', 'interval', 'max_edge_rate'] and key in input:
                 assert data['old'][key] == before_data[key]
                 assert data['new'][key] == input[key]
                 assert data['new'][key] == after_data[key]
@@ -172,6 +180,143 @@ def test_jason_io_content_type_error(test_app):
     assert resp.status_code == 405
     assert resp.headers['Content-Type'] == 'application/json'
     data = json.loads(resp.data)
-    assert data['error'] == 'Content-type must be application/json, not '
+    assert data['error'] == 'Content-type must be {}, not '.format(' or '.join(pi_pwm.encoding.FORMATS))
 
 
+
+def test_controller_post_pid(test_app):
+    c = pi_pwm.controllers.PIDPWMController(name='pid')
+    pi_pwm.webservice.controllers['pid'] = c
+    try:
+        resp = test_app.post('/pid', content_type='application/json', data=json.dumps({'setpoint': 67, 'kp': .2, 'measurement': 60}))
+        assert resp.status_code == 200
+        data = json.loads(resp.data)
+        assert data['old'] == {'setpoint': 0, 'kp': 0, 'measurement': None}
+        assert data['new'] == {'setpoint': 67, 'kp': .2, 'measurement': 60}
+        assert c.setpoint == 67
+        assert c.measurement == 60
+    finally:
+        del pi_pwm.webservice.controllers['pid']
+
+def test_root_get_sensors(test_app):
+    s = pi_pwm.sensors.W1Sensor('mash_temp', '28-1')
+    pi_pwm.webservice.sensors = pi_pwm.sensors.SensorPool({'mash_temp': s})
+    try:
+        data = json.loads(test_app.get('/').data)
+        assert_items_equal(['boil', 'sousvide', 'sensors'], data.keys())
+        assert data['sensors']['mash_temp']['id'] == '28-1'
+        assert data['sensors']['mash_temp']['value'] is None
+    finally:
+        pi_pwm.webservice.sensors = None
+
+def test_controller_post_profile(test_app):
+    profile = {'steps': [{'duty': 0.5, 'hold': 600}, {'ramp': 1, 'duration': 60}]}
+    resp = test_app.post('/sousvide', content_type='application/json', data=json.dumps({'profile': profile}))
+    assert resp.status_code == 200
+    try:
+        data = json.loads(test_app.get('/sousvide').data)
+        assert data['duty'] == 0.5
+        assert data['profile']['status'] == 'running'
+        assert data['profile']['segments'] == 2
+        assert data['profile']['duration'] == 660
+    finally:
+        test_app.post('/sousvide', content_type='application/json', data=json.dumps({'profile': None, 'duty': 0}))
+    assert json.loads(test_app.get('/sousvide').data)['profile'] is None
+
+def test_group(test_app):
+    bank = pi_pwm.controllers.groups_from_config(
+        {'groups': {'bank': {'master': 'boil', 'members': {'sousvide': {'mode': 'ratio', 'value': .5}}}}},
+        pi_pwm.webservice.controllers
+    )
+    pi_pwm.webservice.groups.update(bank)
+    try:
+        resp = test_app.post('/bank', content_type='application/json', data=json.dumps({'duty': .8}))
+        assert resp.status_code == 200
+        data = json.loads(test_app.get('/').data)
+        assert data['boil']['duty'] == .8
+        assert data['sousvide']['duty'] == .4
+        assert data['groups']['bank']['members']['sousvide']['duty'] == .4
+        data = json.loads(test_app.get('/bank/ping').data)
+        assert data['dead_timer'] == 3600
+    finally:
+        pi_pwm.webservice.groups.clear()
+        for c in pi_pwm.webservice.controllers.values():
+            c.group = None
+            c.duty = 0
+
+def test_audit(test_app, tmpdir):
+    resp = test_app.get('/audit')
+    assert resp.status_code == 404
+    log = pi_pwm.audit.AuditLog(str(tmpdir.join('audit.log')))
+    pi_pwm.webservice.audit_log = log
+    pi_pwm.webservice.controllers['boil'].audit_log = log
+    try:
+        start = time.time()
+        resp = test_app.post('/boil', content_type='application/json', data=json.dumps({'duty': .6}))
+        assert resp.status_code == 200
+        records = json.loads(test_app.get('/audit?since={!r}'.format(start)).data)['records']
+        assert [(r['controller'], r['event'], r['new'], r['source']) for r in records] == [
+            ('boil', 'duty', .6, 'api'),
+        ]
+        assert json.loads(test_app.get('/audit?limit=0').data)['records'] == []
+        assert test_app.get('/audit?limit=x').status_code == 400
+    finally:
+        pi_pwm.webservice.audit_log = None
+        pi_pwm.webservice.controllers['boil'].audit_log = None
+        pi_pwm.webservice.controllers['boil'].duty = 0
+
+def test_profile(test_app):
+    data = json.loads(test_app.get('/admin/profile?seconds=.1&interval=.01&gc=1').data)
+    assert data['samples'] > 0
+    assert data['stacks']
+    assert 'gc' in data
+    resp = test_app.get('/admin/profile?seconds=.05&format=collapsed')
+    assert resp.status_code == 200
+    assert resp.headers['Content-Type'].startswith('text/plain')
+    resp = test_app.get('/admin/profile?seconds=.05&format=pstats')
+    assert resp.headers['Content-Type'] == 'application/octet-stream'
+    for query in ('seconds=0', 'seconds=x', 'format=svg', 'interval=-1'):
+        assert test_app.get('/admin/profile?' + query).status_code == 400
+
+def test_bulk_post(test_app):
+    update = {'boil': {'duty': .3, 'ping': True}, 'sousvide': {'duty': 3}, 'nope': {'duty': .1}}
+    resp = test_app.post('/', content_type='application/json', data=json.dumps(update))
+    assert resp.status_code == 200
+    data = json.loads(resp.data)
+    try:
+        assert data['boil'] == {'old': {'duty': 0}, 'new': {'duty': .3}, 'dead_timer': 3600, 'status': 200}
+        assert data['sousvide'] == {'error': 'duty cycle must be between 0 and 1, inclusive', 'status': 400}
+        assert data['nope'] == {'error': 'controller nope not found', 'status': 404}
+        assert pi_pwm.webservice.controllers['sousvide'].duty == 0
+        assert test_app.post('/', content_type='application/json', data='[]').status_code == 400
+    finally:
+        pi_pwm.webservice.controllers['boil'].duty = 0
+
+def test_content_negotiation(test_app):
+    resp = test_app.get('/')
+    assert resp.headers['Content-Type'] == 'application/json'
+    assert '\n    ' in resp.data
+    with mock.patch.object(pi_pwm.encoding, 'GZIP_MIN_SIZE', 100):
+        resp = test_app.get('/', headers={'Accept': 'application/json', 'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    data = gzip.GzipFile(fileobj=StringIO.StringIO(resp.data)).read()
+    assert '\n' not in data
+    assert_items_equal(['boil', 'sousvide'], json.loads(data).keys())
+    resp = test_app.post('/boil', content_type='application/json; charset=utf-8', data='{"duty": 0.1',
+                         headers={'Accept': 'application/json'})
+    assert resp.status_code == 400
+    assert json.loads(resp.data)['error'].startswith('invalid application/json body')
+    resp = test_app.post('/boil', content_type='text/plain', data='duty=0.1')
+    assert resp.status_code == 405
+
+def test_content_negotiation_binary(test_app):
+    mimetype = next((f for f in (pi_pwm.encoding.MSGPACK, pi_pwm.encoding.CBOR) if f in pi_pwm.encoding.ENCODERS), None)
+    if mimetype is None:
+        pytest.skip("needs msgpack or cbor2")
+    try:
+        resp = test_app.post('/boil', content_type=mimetype, data=pi_pwm.encoding.ENCODERS[mimetype]({'duty': .2}),
+                             headers={'Accept': mimetype})
+        assert resp.headers['Content-Type'] == mimetype
+        assert pi_pwm.encoding.decode(mimetype, resp.data) == {'old': {'duty': 0}, 'new': {'duty': .2}}
+    finally:
+        pi_pwm.webservice.controllers['boil'].duty = 0